@@ -6,11 +6,129 @@ OUTPUT_DIR = f"{ROOT_DIR}/output"
 QUICK_START_DIR = f"{ROOT_DIR}/quick_start_output"
 # Your folder path for TCGA Meta Data
 META_DATA_DIR = "/abs/path/to/TCGA_pancancer_clinical_data.csv"
+# Columnar (Feather) cache of META_DATA_DIR, one file per CSV path/size/mtime next to this name
+METADATA_CACHE_PATH = f"{OUTPUT_DIR}/cache/clinical_metadata.feather"
 # Your folder path for ground-truth reports
 VQA_META_DATA_DIR = f"{ROOT_DIR}/aws_response"
+# Persistent index of the SVS files under DATA_DIR (refreshed incrementally by directory mtime)
+SLIDE_CATALOG_PATH = f"{OUTPUT_DIR}/cache/slide_catalog.sqlite"
+# Sample-ID index over data/question_list/WsiVQA_*.json (rebuilt when the JSON files change)
+VQA_INDEX_CACHE_PATH = f"{OUTPUT_DIR}/cache/wsivqa_index.pkl"
+# Slide overview / thumbnail store (disk tier + number of overviews kept in memory per process)
+OVERVIEW_CACHE_DIR = f"{OUTPUT_DIR}/cache/overviews"
+OVERVIEW_CACHE_MEMORY_ITEMS = 16
+# Number of per-slide tissue masks kept in memory per process
+TISSUE_MASK_CACHE_ITEMS = 8
+# OpenSlide handle pool: open slides kept per process, and the shared tile-cache budget in bytes
+SLIDE_POOL_SIZE = 8
+SLIDE_CACHE_BYTES = 256 * 1024 * 1024
+# Decoded ROI tile cache: tile edge in pixels, in-memory hot tier (per process) and on-disk LRU
+# budgets in bytes (shared by all processes), zlib-compressed tiles on disk
+TILE_CACHE_ENABLED = True
+TILE_CACHE_DIR = f"{OUTPUT_DIR}/cache/tiles"
+TILE_CACHE_TILE_SIZE = 512
+TILE_CACHE_MEMORY_BYTES = 128 * 1024 * 1024
+TILE_CACHE_DISK_BYTES = 20 * 1024 * 1024 * 1024
+TILE_CACHE_COMPRESS = True
+# Speculative ROI reads while ROIAgent waits on the LLM: reader threads, regions kept per slide,
+# and whether the neighbours of the current ROI are read besides the prompt's candidates
+ROI_PREFETCH_ENABLED = True
+ROI_PREFETCH_WORKERS = 4
+ROI_PREFETCH_MAX_REGIONS = 32
+ROI_PREFETCH_NEIGHBOURS = True
+
+# LLM backend: "azure" (utils/openai_client settings) or "stub" (local server, python -m utils.llm_stub_server)
+LLM_BACKEND = "azure"
+LLM_STUB_URL = "http://127.0.0.1:8000/v1"
+# LLM client: concurrent requests per process for the async client, HTTP connection pool size, request timeout (s)
+LLM_MAX_CONCURRENCY = 64
+LLM_MAX_CONNECTIONS = 100
+LLM_REQUEST_TIMEOUT = 600
+# LLM response cache: "readwrite" / "readonly" / "bypass", on-disk size and age limits. Requests at
+# every temperature use it; with LLM_CACHE_ALL_TEMPERATURES = False only temperature 0 (or cache=True)
+LLM_CACHE_MODE = "readwrite"
+LLM_CACHE_ALL_TEMPERATURES = True
+LLM_CACHE_PATH = f"{OUTPUT_DIR}/cache/llm_responses.sqlite"
+LLM_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+LLM_CACHE_MAX_AGE_DAYS = 90
+# Encoded image payloads: in-memory budget in bytes, optional disk tier
+IMAGE_PAYLOAD_CACHE_BYTES = 256 * 1024 * 1024
+IMAGE_PAYLOAD_DISK_CACHE = False
+IMAGE_PAYLOAD_CACHE_DIR = f"{OUTPUT_DIR}/cache/image_payloads"
+# Image payload policy per task: format ("original" / "png" / "jpeg" / "webp"), quality, and size limits.
+# 2048 px long side / 768 px short side is the resolution GPT-4o works at in high-detail mode.
+IMAGE_PAYLOAD_POLICIES = {
+    "default": {"format": "original"},
+    "subtyping": {"format": "jpeg", "quality": 90, "max_side": 2048, "max_short_side": 768},
+    "vqa": {"format": "jpeg", "quality": 90, "max_side": 2048, "max_short_side": 768},
+    "report": {"format": "jpeg", "quality": 90, "max_side": 2048, "max_short_side": 768},
+    "survival": {"format": "jpeg", "quality": 85, "max_side": 2048, "max_short_side": 768},
+}
+# LLM rate limits per deployment, shared by all processes on this machine (set to the deployment's quota),
+# reserved completion tokens per request, retries after a 429, and retries of connection errors,
+# timeouts and 5xx per deployment (when its config entry has no "max_retries") with their longest backoff (s)
+LLM_RPM_LIMIT = 2700
+LLM_TPM_LIMIT = 450000
+LLM_RATE_STATE_PATH = f"{OUTPUT_DIR}/cache/llm_rate_limit.json"
+LLM_ESTIMATED_COMPLETION_TOKENS = 512
+LLM_RATE_LIMIT_MAX_RETRIES = 10
+LLM_TRANSIENT_MAX_RETRIES = 2
+LLM_TRANSIENT_MAX_BACKOFF = 30
+# LLM deployment routing: consecutive failures before a deployment is paused, and pause length (s)
+LLM_CIRCUIT_FAILURES = 5
+LLM_CIRCUIT_COOLDOWN = 30
+# Hedged LLM requests: send a duplicate after this latency percentile of the last LLM_HEDGE_WINDOW
+# calls, hedge at most LLM_HEDGE_MAX_RATE of requests, and only while the rate limiter keeps
+# LLM_HEDGE_MIN_HEADROOM of its RPM/TPM budget free
+LLM_HEDGE_ENABLED = False
+LLM_HEDGE_PERCENTILE = 95
+LLM_HEDGE_WINDOW = 500
+LLM_HEDGE_MIN_SAMPLES = 20
+LLM_HEDGE_MAX_RATE = 0.1
+LLM_HEDGE_MIN_HEADROOM = 0.2
+# Offline batch mode: backend ("local" / "openai"), working directory, batch deployment name
+# (None = request model), status poll interval (s), and per-file limits of the Batch API
+LLM_BATCH_BACKEND = "local"
+LLM_BATCH_DIR = f"{OUTPUT_DIR}/batches"
+LLM_BATCH_MODEL = None
+LLM_BATCH_POLL_INTERVAL = 60
+LLM_BATCH_MAX_REQUESTS = 50000
+LLM_BATCH_MAX_BYTES = 190 * 1024 * 1024
+# LLM call ledger (append-only JSONL) and prices in USD per 1M tokens for its cost summary
+LLM_LEDGER_ENABLED = True
+LLM_LEDGER_PATH = f"{OUTPUT_DIR}/llm_ledger.jsonl"
+LLM_PRICE_INPUT_PER_M = 2.5
+LLM_PRICE_OUTPUT_PER_M = 10.0
+# Singleflight: identical concurrent requests share one upstream call (temperature 0 by default,
+# every temperature with LLM_COALESCE_ALL_TEMPERATURES, or per call with coalesce=True); the
+# lock directory is the cross-process registry, waits longer than the timeout (s) send their own call
+LLM_COALESCE_ENABLED = True
+LLM_COALESCE_ALL_TEMPERATURES = False
+LLM_COALESCE_DIR = f"{OUTPUT_DIR}/cache/inflight"
+LLM_COALESCE_WAIT_TIMEOUT = 600
+
+# Import-time budget per module for utils/import_benchmark.py (cold start of pool workers and scripts)
+IMPORT_TIME_BUDGET_SECONDS = 0.5
 
 # n_iters
 NUM_ITER = 10
+# ROIAgent early stopping (src/subtyping/stopping_policy.py): rules checked after every reply, how many
+# consecutive proposals a rule must flag, duplicate offset as a fraction of the ROI size, IoU that counts
+# as a revisit, reply similarity that counts as stabilised reasoning, and per-slide wall-clock (s) and
+# cost (USD) budgets (None = no limit)
+ROI_STOP_RULES = ("duplicate", "revisit", "stable_reasoning", "budget")
+ROI_STOP_PATIENCE = 1
+ROI_STOP_DUPLICATE_DISTANCE = 0.1
+ROI_STOP_REVISIT_IOU = 0.7
+ROI_STOP_REASONING_SIMILARITY = 0.95
+ROI_STOP_MAX_SECONDS = None
+ROI_STOP_MAX_COST_USD = None
+# ROIAgent conversation compaction (src/subtyping/conversation_compaction.py): image turns re-sent in
+# full, whether the slide overview stays in every request, and reasoning kept from older replies (chars)
+ROI_COMPACT_ENABLED = True
+ROI_COMPACT_KEEP_IMAGE_TURNS = 2
+ROI_COMPACT_PIN_OVERVIEW = True
+ROI_COMPACT_REASONING_CHARS = 300
 
 # Cancer types
 CANCER_SUBTYPE_MAP = {
@@ -1,8 +1,3 @@
-import torch, timm
-from torchvision import transforms
-from timm.data import resolve_data_config
-from timm.data.transforms_factory import create_transform
-from timm.layers import SwiGLUPacked
 from PIL import Image
 import os
 import glob
@@ -18,6 +13,11 @@ MODELS = [
 MODEL_ID = {m["name"]: m["id"] for m in MODELS}
 
 def build_encoder_and_transform(model_name: str):
+    # torch / timm are imported here so importing this module stays cheap
+    import torch, timm
+    from timm.data import resolve_data_config
+    from timm.data.transforms_factory import create_transform
+    from timm.layers import SwiGLUPacked
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     if model_name not in MODEL_ID:
         raise ValueError(f"Unknown model_name: {model_name}")
@@ -64,6 +64,7 @@ def build_encoder_and_transform(model_name: str):
 ENCODER, TRANSFORM, DEVICE = None, None, None
 
 def extract_embedding_from_image(img_path, model_name):
+    import torch
     global ENCODER, TRANSFORM, DEVICE
     if ENCODER is None:
         ENCODER, TRANSFORM, DEVICE = build_encoder_and_transform(model_name)
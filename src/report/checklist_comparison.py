@@ -3,6 +3,8 @@ import json
 import config
 import random
 from src.report.report_prompt import generate_checklist_prompt
+from utils import llm_batch
+from utils import call_ledger
 from utils.openai_client import get_openai_response_text_only
 from utils.file_utils import initialize_directories
 
@@ -18,12 +20,20 @@ def extract_gpt_answers(response):
         print("Error: GPT response is not in valid JSON format.")
         return None
 
+def is_valid_answer_list(response):
+    try:
+        return isinstance(json.loads(response.strip()), list)
+    except json.JSONDecodeError:
+        return False
+
 def compare_reports(reference_text, candidate_text, cancer_type,):
     vqa_file = os.path.join("data/eval_questions", f"{cancer_type}_eval_vqa.json")
     with open(vqa_file, "r", encoding="utf-8") as f:
         vqa_questions = json.load(f)
     prompt = generate_checklist_prompt(reference_text, candidate_text, vqa_questions)
-    response = get_openai_response_text_only(prompt)
+    response = get_openai_response_text_only(prompt, coalesce=True, cache=True, validate=is_valid_answer_list)
+    if response is None:
+        return None
     incorrect_questions = []
     correct_questions = []
     answers = None
@@ -56,7 +66,10 @@ def compare_reports(reference_text, candidate_text, cancer_type,):
         "correct_questions": correct_questions
     }
 
-def main(input_path, cancer_type, n_samples, mode):
+def main(input_path, cancer_type, n_samples, mode, batch=False):
+    if batch:
+        return llm_batch.run_in_batch(main, input_path, cancer_type, n_samples, mode,
+                                      name=f"checklist_{cancer_type}_{mode}")
     file_name = "_comparison.json"
     if mode == "baseline1" or mode == "baseline2":
         file_name = f"{mode}_comparison.json"
@@ -98,7 +111,8 @@ def main(input_path, cancer_type, n_samples, mode):
             print(f"Skipping {sample_id}, missing reference or candidate text.")
             continue
 
-        evaluation_result = compare_reports(reference_text, candidate_text, cancer_type)
+        with call_ledger.call_site(task="report", stage=f"checklist_{mode}", sample_id=sample_id, cancer_type=cancer_type):
+            evaluation_result = compare_reports(reference_text, candidate_text, cancer_type)
         if evaluation_result:
             evaluation_result["sample_id"] = sample_id
             sample_output_file = os.path.join(os.path.dirname(file_path), f"{mode}_checklist_eval.json")
@@ -106,6 +120,8 @@ def main(input_path, cancer_type, n_samples, mode):
                 json.dump(evaluation_result, f, indent=4)
             results.append(evaluation_result)
 
+    if llm_batch.is_collecting():
+        return
     # Save results to checklist_eval.json in the same directory
     output_file = os.path.join(input_path, f"{mode}_checklist_eval.json")
     with open(output_file, "w", encoding="utf-8") as f:
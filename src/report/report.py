@@ -1,6 +1,8 @@
 import os
 import base64
 import config
+from utils import llm_batch
+from utils import call_ledger
 from utils.openai_client import get_openai_response_base64, get_openai_response_base64_with_multiple_images
 import src.report.report_prompt as prompt
 import random
@@ -57,11 +59,14 @@ def generate_reports_for_samples(input_dir, output_dir, sample_id, cancer_type,
 
     image_paths = png_files[:3]
 
-    if len(image_paths) == 1:
-        report_content = get_openai_response_base64(vqa_prompt, image_paths[0])
-    else:
-        report_content = get_openai_response_base64_with_multiple_images(vqa_prompt, image_paths)
+    with call_ledger.call_site(task="report", stage=f"generate_{mode}", sample_id=sample_id, cancer_type=cancer_type):
+        if len(image_paths) == 1:
+            report_content = get_openai_response_base64(vqa_prompt, image_paths[0], task="report")
+        else:
+            report_content = get_openai_response_base64_with_multiple_images(vqa_prompt, image_paths, task="report")
 
+    if llm_batch.is_collecting():
+        return
     if report_content is None:
         print(f"Failed to generate report for sample {sample_id}.")
         return
@@ -73,7 +78,9 @@ def generate_reports_for_samples(input_dir, output_dir, sample_id, cancer_type,
     print(f"Report generated and saved for sample {sample_id}: {report_path}")
 
 
-def main(cancer_type, n, overwrite=True, mode="roiagent"):
+def main(cancer_type, n, overwrite=True, mode="roiagent", batch=False):
+    if batch:
+        return llm_batch.run_in_batch(main, cancer_type, n, overwrite, mode, name=f"report_{cancer_type}_{mode}")
     if mode == "roiagent":
         input_directory = os.path.join(config.QUICK_START_DIR, cancer_type, "roi_output")
         output_directory = os.path.join(config.QUICK_START_DIR, cancer_type, "report_output")
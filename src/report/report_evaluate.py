@@ -5,6 +5,8 @@ import pickle
 import config
 from nltk.translate.bleu_score import SmoothingFunction
 import src.report.report_utils as utils
+from utils import llm_batch
+from utils import call_ledger
 
 def extract_text_from_textract(file_path, wrap_width=80):
     with open(file_path, "rb") as file:
@@ -69,7 +71,10 @@ def compare_reports(candidate_folder, groundtruth_folder, overwrite, mode="roiag
                 continue
             save_reference_text(sample_id, reference_text)
             rouge_scores = utils.calculate_rouge(reference_text, candidate_text)
-            gpt_eval_score = utils.calculate_gpt_eval_score(reference_text, candidate_text)
+            with call_ledger.call_site(task="report", stage=f"gpt_eval_{mode}", sample_id=sample_id):
+                gpt_eval_score = utils.calculate_gpt_eval_score(reference_text, candidate_text)
+            if llm_batch.is_collecting():
+                continue
             comparison_result = {
                 "sample_id": sample_id,
                 "gpt_eval_score": gpt_eval_score,
@@ -108,7 +113,10 @@ def compare_reports(candidate_folder, groundtruth_folder, overwrite, mode="roiag
             # Calculate BLEU and ROUGE scores
             # bleu_score = calculate_bleu(reference_text, candidate_text)
             rouge_scores = utils.calculate_rouge(reference_text, candidate_text)
-            gpt_eval_score = utils.calculate_gpt_eval_score(reference_text, candidate_text)
+            with call_ledger.call_site(task="report", stage=f"gpt_eval_{mode}", sample_id=sample_id):
+                gpt_eval_score = utils.calculate_gpt_eval_score(reference_text, candidate_text)
+            if llm_batch.is_collecting():
+                continue
 
             # Save comparison results
             comparison_result = {
@@ -129,7 +137,9 @@ def compare_reports(candidate_folder, groundtruth_folder, overwrite, mode="roiag
             print(f"Comparison results saved for sample {sample_id}: {comparison_path}")
 
 
-def main(cancer_type, overwrite=True, mode="roiagent"):
+def main(cancer_type, overwrite=True, mode="roiagent", batch=False):
+    if batch:
+        return llm_batch.run_in_batch(main, cancer_type, overwrite, mode, name=f"report_eval_{cancer_type}_{mode}")
     groundtruth_folder = config.VQA_META_DATA_DIR
     candidate_folder = ""
     if mode == "roiagent":
@@ -44,13 +44,21 @@ def calculate_rouge(reference, candidate):
     scores = scorer.score(reference, candidate)
     return scores
 
+def is_valid_score(response):
+    return response.strip().lstrip("-").isdigit()
+
 def calculate_gpt_eval_score(reference, candidate):
     """
     Use GPT to evaluate the similarity between a generated scientific report and the ground truth.
     """
     reference = preprocess_text(reference)
     candidate = preprocess_text(candidate)
-    response = get_openai_response_text_only(prompt.get_gpt_eval_prompt(reference, candidate))
+    # Parallel evaluation workers often score identical pairs: share one in-flight request, and keep
+    # parseable scores in the response cache so re-runs score the same way
+    response = get_openai_response_text_only(prompt.get_gpt_eval_prompt(reference, candidate), coalesce=True,
+                                             cache=True, validate=is_valid_score)
+    if response is None:
+        return None
     try:
         score = int(response.strip())
         score = max(0, min(score, 10))
@@ -3,10 +3,10 @@ import re
 import numpy as np
 import random
 import config
-import openslide
+from utils import slide_pool
 
 from src.subtyping.roi_agent import ROIAgent
-from utils.openai_client import azure_config_list
+from utils import llm_router
 from src.subtyping.slide_utils import draw_bbox_on_overview_roi_all_tasks
 from src.vqa.questions import get_vqa_for_sample
 from src.subtyping.subtyping_prompt import get_iteration_messages
@@ -18,12 +18,12 @@ def extract_roi_with_query(file_path, task_type, cancer_type, output_dir):
     sample_id = os.path.basename(file_name).split('.')[0]
     sample_output_dir = os.path.join(output_dir, sample_id)
     os.makedirs(sample_output_dir, exist_ok=True)
-    image = openslide.OpenSlide(file_path)
+    image = slide_pool.open_slide(file_path)
     roi_agent = ROIAgent(
         image=image,
         cancer_type=cancer_type,
         name="ROI Agent",
-        llm_config={"config_list": [azure_config_list[0]], "max_tokens": 3000},
+        llm_config={"config_list": llm_router.get_config_list(sample_id), "max_tokens": 3000},
         n_iters=config.NUM_ITER,
         task=task_type,
         to_predict=False
@@ -0,0 +1,80 @@
+import re
+import config
+
+# Compaction of the ROIAgent instructor conversation.
+# Every ROI iteration adds a user turn with images and an instructor reply, and autogen re-sends the
+# whole history with each request, so without compaction the input grows by one ROI composite per
+# iteration. compact_messages() keeps the images of the last `keep_image_turns` image turns; older
+# turns are sent as text:
+#   - user turns keep their text, with each image replaced by a placeholder and without the lines
+#     a later user turn repeats (candidate list, query)
+#   - the instructor's replies to them are cut down to the coordinates they proposed and the
+#     beginning of their reasoning
+# Pinned images (e.g. the slide overview) are always kept. The conversation stored by autogen and
+# saved to chat_messages.json is not changed; only the request is compacted.
+
+COORDINATE_TAG = re.compile(r"<<.*?>>")
+OMITTED_IMAGE = "[image from an earlier iteration omitted]"
+
+
+def has_images(message):
+    content = message.get("content")
+    return isinstance(content, list) and any(item.get("type") == "image_url" for item in content)
+
+
+def get_text(message):
+    content = message.get("content")
+    if not isinstance(content, list):
+        return content or ""
+    return "".join(item.get("text", "") for item in content if item.get("type") == "text")
+
+
+def summarize_reply(text, reasoning_chars):
+    coordinates = COORDINATE_TAG.findall(text)
+    reasoning = " ".join(COORDINATE_TAG.sub("", text).split())
+    if len(reasoning) > reasoning_chars:
+        reasoning = reasoning[:reasoning_chars].rsplit(" ", 1)[0] + " ..."
+    summary = f"[Earlier reply, summarized] Proposed: {', '.join(coordinates) or 'no coordinates'}."
+    return f"{summary} Reasoning: {reasoning}" if reasoning else summary
+
+
+def compact_user_turn(message, later_lines, pinned):
+    parts = []
+    for item in message["content"]:
+        if item.get("type") == "image_url":
+            url = item["image_url"]["url"]
+            parts.append(item if id(url) in pinned else {"type": "text", "text": OMITTED_IMAGE})
+            continue
+        lines = [line for line in item.get("text", "").split("\n") if not line.strip() or line not in later_lines]
+        parts.append(dict(item, text="\n".join(lines)))
+    return dict(message, content=parts)
+
+
+def compact_messages(messages, keep_image_turns=None, pinned_images=(), reasoning_chars=None):
+    """
+    Returns (messages to send, number of compacted turns). `pinned_images` holds the id() of image
+    objects (or URLs) that are kept in every turn.
+    """
+    # The current turn always keeps its images
+    keep_image_turns = max(1, keep_image_turns or config.ROI_COMPACT_KEEP_IMAGE_TURNS)
+    reasoning_chars = reasoning_chars or config.ROI_COMPACT_REASONING_CHARS
+    image_turns = [i for i, message in enumerate(messages) if has_images(message)]
+    if len(image_turns) <= keep_image_turns:
+        return messages, 0
+    oldest_kept = image_turns[-keep_image_turns]
+    compacted, later_lines = [], set()
+    # Walk backwards so each user turn knows the lines of the user turns after it
+    for i in range(len(messages) - 1, -1, -1):
+        message = messages[i]
+        if i >= oldest_kept or message.get("role") == "system":
+            compacted.append(message)
+        elif message.get("role") == "assistant":
+            compacted.append(dict(message, content=summarize_reply(get_text(message), reasoning_chars)))
+        elif isinstance(message.get("content"), list):
+            compacted.append(compact_user_turn(message, later_lines, pinned_images))
+        else:
+            compacted.append(message)
+        if message.get("role") == "user":
+            later_lines.update(line for line in get_text(message).split("\n") if line.strip())
+    compacted.reverse()
+    return compacted, sum(1 for i in image_turns if i < oldest_kept)
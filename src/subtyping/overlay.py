@@ -0,0 +1,127 @@
+import os
+import functools
+import importlib.util
+from PIL import Image, ImageDraw, ImageFont
+
+# Overlay rendering on slide overviews (ROI boxes, visited path, coordinate labels).
+# An OverlayRenderer is created once per slide overview: the font is loaded once per process,
+# the corner labels are drawn once into a base layer, and the visited path is kept on a
+# transparent layers that only get the newly added points drawn; only the regions they touch are
+# recomposed onto the cached base. Rendering an iteration is then one copy plus the current box.
+
+FONT_SIZE = 20
+CORNER_LABELS = ("x=0.0, y=0.0", "x=0.0, y=1.0", "x=1.0, y=0.0", "x=1.0, y=1.0")
+
+
+@functools.lru_cache(maxsize=None)
+def get_font_path():
+    # DejaVuSans ships with opencv-python; locate the package without importing cv2
+    return os.path.join(importlib.util.find_spec("cv2").submodule_search_locations[0], 'qt', 'fonts', 'DejaVuSans.ttf')
+
+
+@functools.lru_cache(maxsize=None)
+def get_font(size=FONT_SIZE):
+    return ImageFont.truetype(get_font_path(), size=size)
+
+
+def get_bbox_rectangle(bbox_info, overview_size):
+    # Scale the bounding box coordinates to the overview image
+    overview_width, overview_height = overview_size
+    bbox_x = int(bbox_info['x_0'] / bbox_info['slide_width_0'] * overview_width)
+    bbox_y = int(bbox_info['y_0'] / bbox_info['slide_height_0'] * overview_height)
+    bbox_width = int(bbox_info['width_level'] * overview_width / bbox_info['slide_width_level'])
+    bbox_height = int(bbox_info['height_level'] * overview_height / bbox_info['slide_height_level'])
+    return [bbox_x, bbox_y, bbox_x + bbox_width, bbox_y + bbox_height]
+
+
+class OverlayRenderer:
+    def __init__(self, overview_image, font_size=FONT_SIZE):
+        self.overview = overview_image.convert("RGB")
+        self.width, self.height = self.overview.size
+        self.font = get_font(font_size)
+        self._base = None
+        self._path_layer = None  # RGBA: path lines
+        self._marker_layer = None  # RGBA: numbered points
+        self._list_layer = None  # RGBA: coordinate list
+        self._history_image = None  # base with the path and markers, updated in the changed regions
+        self._history = []  # slide level-0 coordinates already drawn
+
+    @property
+    def base(self):
+        """Overview with the corner coordinate labels."""
+        if self._base is None:
+            self._base = self.overview.copy()
+            draw = ImageDraw.Draw(self._base)
+            positions = [(5, 5), (5, self.height - 25), (self.width - 140, 5), (self.width - 140, self.height - 25)]
+            for position, label in zip(positions, CORNER_LABELS):
+                draw.text(position, label, fill="black", font=self.font)
+        return self._base
+
+    def _scale_point(self, point, bbox_info):
+        x, y = point
+        return (int(x * self.width / bbox_info['slide_width_0']), int(y * self.height / bbox_info['slide_height_0']))
+
+    def _refresh(self, box):
+        # Recompose base + path + markers + list inside box only
+        box = (max(box[0], 0), max(box[1], 0), min(box[2], self.width), min(box[3], self.height))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return
+        region = self.base.crop(box).convert("RGBA")
+        region.alpha_composite(self._path_layer.crop(box))
+        region.alpha_composite(self._marker_layer.crop(box))
+        region.alpha_composite(self._list_layer.crop(box))
+        self._history_image.paste(region.convert("RGB"), box[:2])
+
+    def _update_history(self, history_points, bbox_info):
+        history_points = list(history_points)
+        if history_points[:len(self._history)] != self._history or self._path_layer is None:
+            # A different path: start over
+            self._path_layer = Image.new("RGBA", self.overview.size, (0, 0, 0, 0))
+            self._marker_layer = Image.new("RGBA", self.overview.size, (0, 0, 0, 0))
+            self._list_layer = Image.new("RGBA", self.overview.size, (0, 0, 0, 0))
+            self._history_image = self.base.copy()
+            self._history = []
+        path_draw = ImageDraw.Draw(self._path_layer)
+        marker_draw = ImageDraw.Draw(self._marker_layer)
+        list_draw = ImageDraw.Draw(self._list_layer)
+        radius = 5
+        for i in range(len(self._history), len(history_points)):
+            cx, cy = self._scale_point(history_points[i], bbox_info)
+            dirty = [cx - radius, cy - radius, cx + radius + 1, cy + radius + 1]
+            if i > 0:
+                px, py = self._scale_point(history_points[i - 1], bbox_info)
+                path_draw.line([(px, py), (cx, cy)], fill="red", width=3)
+                dirty = [min(dirty[0], px - 3), min(dirty[1], py - 3), max(dirty[2], px + 4), max(dirty[3], py + 4)]
+            marker_draw.ellipse((cx - radius, cy - radius, cx + radius, cy + radius), fill="blue", outline="blue")
+            marker_draw.text((cx + 10, cy), f"{i+1}", fill="black", font=self.font)
+            text_box = marker_draw.textbbox((cx + 10, cy), f"{i+1}", font=self.font)
+            self._refresh((min(dirty[0], text_box[0]), min(dirty[1], text_box[1]),
+                           max(dirty[2], text_box[2] + 1), max(dirty[3], text_box[3] + 1)))
+            original_x, original_y = history_points[i]
+            x_coord = round(original_x / bbox_info['slide_width_0'], 2)
+            y_coord = round(original_y / bbox_info['slide_height_0'], 2)
+            label = f"{i+1}: x={x_coord}, y={y_coord}"
+            list_draw.text((20, 50 + i * 20), label, fill="black", font=self.font)
+            text_box = list_draw.textbbox((20, 50 + i * 20), label, font=self.font)
+            self._refresh((text_box[0], text_box[1], text_box[2] + 1, text_box[3] + 1))
+        self._history = history_points
+        return self._history_image
+
+    def render(self, bbox_info, history_points=()):
+        """Overview with the visited path, the current ROI box (green) and its coordinates."""
+        image = self._update_history(history_points, bbox_info).copy() if history_points else self.base.copy()
+        draw = ImageDraw.Draw(image)
+        rectangle = get_bbox_rectangle(bbox_info, image.size)
+        draw.rectangle(rectangle, outline="green", width=5)
+        x_ratio = bbox_info['x_0'] / bbox_info['slide_width_0']
+        y_ratio = bbox_info['y_0'] / bbox_info['slide_height_0']
+        draw.text((rectangle[0], rectangle[1] - 30), f"x={x_ratio:.2f}, y={y_ratio:.2f}", fill="black", font=self.font)
+        return image
+
+    def render_boxes(self, bbox_info_list, color_list, labels=True):
+        """Overview with one box per (bbox_info, color), with or without the corner labels."""
+        image = self.base.copy() if labels else self.overview.copy()
+        draw = ImageDraw.Draw(image)
+        for bbox_info, color in zip(bbox_info_list, color_list):
+            draw.rectangle(get_bbox_rectangle(bbox_info, image.size), outline=color, width=5)
+        return image
@@ -0,0 +1,88 @@
+import os
+import hashlib
+from collections import OrderedDict
+from PIL import Image
+import config
+
+# Overview / thumbnail images keyed by (slide path, slide mtime, target size).
+# One decode per slide serves ROIAgent iterations, the baselines' thumbnails and tissue masks;
+# a PNG copy under config.OVERVIEW_CACHE_DIR lets other workers and later runs skip the decode.
+
+_memory_cache = OrderedDict()
+
+
+def get_slide_path(image):
+    # openslide.OpenSlide keeps the path it was opened with
+    return getattr(image, "_filename", None)
+
+
+def get_overview_key(image, size):
+    slide_path = get_slide_path(image)
+    if slide_path is None:
+        return None
+    try:
+        stat = os.stat(slide_path)
+    except OSError:
+        return None
+    raw_key = f"{os.path.realpath(slide_path)}|{stat.st_mtime_ns}|{stat.st_size}|{size[0]}x{size[1]}"
+    return hashlib.sha1(raw_key.encode("utf-8")).hexdigest()
+
+
+def get_best_level_for_size(image, size):
+    # Coarsest pyramid level that still has at least the requested resolution
+    x_dim_0, y_dim_0 = image.level_dimensions[0]
+    downsample = max(x_dim_0 / size[0], y_dim_0 / size[1])
+    return image.get_best_level_for_downsample(downsample)
+
+
+def render_overview(image, size):
+    level = get_best_level_for_size(image, size)
+    level_dims = image.level_dimensions[level]
+    region = image.read_region((0, 0), level, level_dims)
+    # Composite transparent (out-of-scan) areas on the slide background, as OpenSlide.get_thumbnail does
+    background_color = "#" + image.properties.get("openslide.background-color", "ffffff")
+    overview = Image.new("RGB", region.size, background_color)
+    overview.paste(region, mask=region.split()[-1])
+    overview.thumbnail(size, Image.LANCZOS)
+    return overview
+
+
+def _remember(key, overview):
+    _memory_cache[key] = overview
+    _memory_cache.move_to_end(key)
+    while len(_memory_cache) > config.OVERVIEW_CACHE_MEMORY_ITEMS:
+        _memory_cache.popitem(last=False)
+
+
+def get_overview(image, size=(1024, 1024)):
+    """
+    Return an RGB overview of the slide that fits in `size`. The returned image is a copy,
+    so callers may draw on it.
+    """
+    size = (int(size[0]), int(size[1]))
+    key = get_overview_key(image, size)
+    if key is None:
+        return render_overview(image, size)
+    if key in _memory_cache:
+        _memory_cache.move_to_end(key)
+        return _memory_cache[key].copy()
+
+    cache_path = os.path.join(config.OVERVIEW_CACHE_DIR, f"{key}.png")
+    overview = None
+    if os.path.exists(cache_path):
+        try:
+            with Image.open(cache_path) as cached:
+                overview = cached.convert("RGB")
+        except OSError as e:
+            print(f"Warning: Failed to read cached overview {cache_path}: {e}")
+    if overview is None:
+        overview = render_overview(image, size)
+        try:
+            os.makedirs(config.OVERVIEW_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            overview.save(tmp_path, format="PNG")
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Warning: Failed to cache overview {cache_path}: {e}")
+    _remember(key, overview)
+    return overview.copy()
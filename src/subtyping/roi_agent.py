@@ -2,25 +2,136 @@ import os
 import re
 import sys
 import json
-import openai
 import random
 import numpy as np
 import config
 import glob
+import time
 from src.subtyping import subtyping_prompt as prompt
 from src.subtyping import slide_utils
+from src.subtyping import overview_store
+from src.subtyping import tissue_mask
+from src.subtyping import overlay
+from src.subtyping import roi_prefetch
+from src.subtyping import stopping_policy
+from src.subtyping import conversation_compaction
 import openslide
 from autogen import Agent, ConversableAgent, AssistantAgent
 from autogen.agentchat.contrib.multimodal_conversable_agent import MultimodalConversableAgent
+from autogen._pydantic import model_dump
 from PIL import Image, ImageDraw
-from skimage import io, color
-from skimage.filters import threshold_otsu
-from utils.openai_client import azure_config_list, get_openai_response_base64, get_openai_response_base64_with_multiple_images
+from utils import llm_router
+from utils import call_ledger
+from utils import image_payload
+from utils.openai_client import get_openai_response_base64, get_openai_response_base64_with_multiple_images, send_to_deployment
 
 this_file_dir = os.path.dirname(os.path.abspath(__file__))
 
+
+def build_message_content(message, images):
+    # "<img path>" tags whose path is in `images` become in-memory image parts (no file is read)
+    content, last = [], 0
+    for match in re.finditer(r"<img (.*?)>", message):
+        content.append({"type": "text", "text": message[last:match.start()]})
+        content.append({"type": "image_url", "image_url": {"url": images[match.group(1)]}})
+        last = match.end()
+    content.append({"type": "text", "text": message[last:]})
+    return content
+
+
+def content_to_text(content, image_paths):
+    # Inverse of build_message_content for logs: images are written back as "<img path>" tags
+    if not isinstance(content, list):
+        return content
+    parts = []
+    for item in content:
+        if item.get("type") == "image_url":
+            url = item["image_url"]["url"]
+            parts.append(f"<img {image_paths.get(id(url), '<image>') if isinstance(url, Image.Image) else url}>")
+        else:
+            parts.append(item.get("text", ""))
+    return "".join(parts)
+
+
+class InstructorAgent(MultimodalConversableAgent):
+    """
+    MultimodalConversableAgent for in-memory images: PIL images in the message content are encoded
+    once with the task's payload policy (utils.image_payload), instead of being read from files and
+    re-encoded as PNG for every turn of the conversation. With compact=True, requests only carry the
+    images of the last turns (see conversation_compaction). Requests go through the shared rate
+    limiter and router health of utils.openai_client (route_clients).
+    """
+
+    def __init__(self, task=None, compact=False, keep_image_turns=None, **kwargs):
+        super().__init__(**kwargs)
+        self.task = task
+        self.compact = compact
+        self.keep_image_turns = keep_image_turns
+        self.pinned_images = set()  # id() of images kept in every request
+        self.last_request = {}  # size of the last request sent
+        self._image_urls = {}  # id(image) -> (image, data URL)
+        self.replace_reply_func(MultimodalConversableAgent.generate_oai_reply, InstructorAgent.generate_oai_reply)
+        self.route_clients()
+
+    def route_clients(self):
+        # autogen tries the config_list entries in order; each entry's client sends through send_to_deployment
+        if self.client is None:
+            return
+        for model_client, entry in zip(self.client._clients, self.llm_config["config_list"]):
+            index = llm_router.find_deployment(entry)
+            if index is not None:
+                model_client.create = self._make_routed_create(model_client.create, index)
+
+    def _make_routed_create(self, create, index):
+        def routed_create(params):
+            # last_request collects model, deployment, attempts and api_latency for the call ledger
+            self.last_request["model"] = llm_router.get_deployment(index).get("model", params.get("model"))
+            return send_to_deployment(index, lambda: create(params), params["messages"], self.last_request)
+        return routed_create
+
+    def pin_image(self, image):
+        self.pinned_images.add(id(image))
+
+    def get_image_url(self, image):
+        if not isinstance(image, Image.Image):
+            return image
+        if id(image) not in self._image_urls:
+            self._image_urls[id(image)] = (image, image_payload.get_pil_image_payload(image, self.task)[0])
+        return self._image_urls[id(image)][1]
+
+    def _encode_messages(self, messages):
+        encoded = []
+        for message in messages:
+            if isinstance(message.get("content"), list):
+                message = dict(message, content=[
+                    dict(item, image_url={"url": self.get_image_url(item["image_url"]["url"])}) if "image_url" in item else item
+                    for item in message["content"]
+                ])
+            encoded.append(message)
+        return encoded
+
+    def generate_oai_reply(self, messages=None, sender=None, config=None):
+        client = self.client if config is None else config
+        if client is None:
+            return False, None
+        if messages is None:
+            messages = self._oai_messages[sender]
+        context = messages[-1].pop("context", None)
+        compacted_turns = 0
+        if self.compact:
+            messages, compacted_turns = conversation_compaction.compact_messages(
+                messages, self.keep_image_turns, self.pinned_images)
+        request_messages = self._encode_messages(self._oai_system_message + messages)
+        num_images, image_bytes = call_ledger.describe_messages(request_messages)
+        self.last_request = {"images": num_images, "image_bytes": image_bytes, "compacted_turns": compacted_turns}
+        response = client.create(context=context, messages=request_messages)
+        extracted_response = client.extract_text_or_completion_object(response)[0]
+        if not isinstance(extracted_response, str):
+            extracted_response = model_dump(extracted_response)
+        return True, extracted_response
+
 class ROIAgent(ConversableAgent):
-    def __init__(self, image, cancer_type, n_iters=2, mode="multiple", task="subtyping", to_predict=True, **kwargs):
+    def __init__(self, image, cancer_type, n_iters=2, mode="multiple", task="subtyping", to_predict=True, stop_rules=None, **kwargs):
         super().__init__(**kwargs)
         self.image = image
         self.n_iters = n_iters
@@ -38,6 +149,13 @@ class ROIAgent(ConversableAgent):
         self.final_bbox_info = None
         self.overview_image = None
         self.final_roi = None
+        self.prefetch = config.ROI_PREFETCH_ENABLED
+        self.prefetch_stats = None
+        self.stop_rules = config.ROI_STOP_RULES if stop_rules is None else stop_rules
+        self.stop_info = None
+        self.compact = config.ROI_COMPACT_ENABLED
+        self.pin_overview = config.ROI_COMPACT_PIN_OVERVIEW
+        self.iteration_tokens = []
         self.set_roi(0.5, 0.5, 2)
 
     def set_roi(self, x, y, level):
@@ -48,27 +166,24 @@ class ROIAgent(ConversableAgent):
     def update_history(self, x, y):
         self.history_points.append((x, y))
 
+    def get_call_site(self, **fields):
+        site = {"task": self.task, "stage": "roi_agent", "sample_id": self.sample_id, "cancer_type": self.cancer_type}
+        site.update(fields)
+        return site
+
     def generate_candidate_rois(self, num_candidates=10):
-        candidates = []
-        max_level = 0
-        while len(candidates) < num_candidates:
-            range_min, range_max = 0.1, 0.9
-            x = random.uniform(range_min, range_max)
-            y = random.uniform(range_min, range_max)
-            level = random.randint(0, max_level)
-            if 0 <= level <= max_level and slide_utils.is_tissue_region(self.image, level, x, y):
-                candidates.append((x, y, level))
-                # print(f"Added candidate ROI: (x={x:.2f}, y={y:.2f}, level={level})")
-        return candidates
+        range_min, range_max = 0.1, 0.9
+        level = 0
+        # One vectorized draw from the cached tissue mask instead of per-candidate read_region checks
+        tissue = tissue_mask.get_tissue_mask(self.image, method="aod")
+        coords = tissue.sample(num_candidates, stratified=True, bounds=(range_min, range_max))
+        if len(coords) == 0:
+            print("WARNING: No tissue found for candidate ROIs; sampling uniformly.")
+            coords = np.random.uniform(range_min, range_max, size=(num_candidates, 2))
+        return [(float(x), float(y), level) for x, y in coords]
 
     def get_overview_image(self, image, save_path='overview.png'):
-        # use the highest level to get the overview image
-        max_level = image.level_count - 1
-        x_dim, y_dim = image.level_dimensions[max_level]
-        overview = image.read_region((0, 0), max_level, (x_dim, y_dim))
-        if x_dim * y_dim > 1024 * 1024:
-            overview.thumbnail((1024, 1024))
-        overview.save(save_path)
+        overview_store.get_overview(image).save(save_path)
         return save_path
 
     def _reply_user(self, messages=None, sender=None, config=None):
@@ -93,10 +208,13 @@ class ROIAgent(ConversableAgent):
             is_termination_msg=lambda x: x.get("content", "").rstrip().endswith("TERMINATE"),
         )
 
-        instructor = MultimodalConversableAgent(
+        instructor = InstructorAgent(
+            task=self.task,
+            compact=self.compact,
             name="Instructor",
             system_message=prompt.get_system_message(),
-            llm_config={"config_list": [azure_config_list[0]], "max_tokens": 3000},
+            # One deployment per slide so the conversation is served consistently
+            llm_config={"config_list": llm_router.get_config_list(self.sample_id or None), "max_tokens": 3000},
             human_input_mode="NEVER",
             max_consecutive_auto_reply=self.n_iters,
         )
@@ -119,25 +237,45 @@ class ROIAgent(ConversableAgent):
 
         x, y, level = self.x, self.y, self.level
         history_points = []
-        overview_img_path = os.path.join(self.working_dir, 'overview.png')
-        overview_image, overview_img_path = slide_utils.get_overview_image(image, overview_img_path)
-        overview_image_original = overview_image.copy()
+        self.iteration_tokens = []
+        # Iteration images stay in memory (path -> PIL image) and are sent to the instructor directly;
+        # only the files kept at the end are written (all of them when there is no final prediction)
+        iteration_images = {}
+        image_paths = {}  # id(image) -> path, for the chat log
+        roi_scores = {}  # "roi_<i>.png" -> AOD, for selecting the final ROIs
+
+        def add_image(file_name, pil_image):
+            path = os.path.join(self.working_dir, file_name)
+            iteration_images[path] = pil_image
+            image_paths[id(pil_image)] = path
+            if not self.to_predict:
+                pil_image.save(path)
+            return path
+
+        overview_image = overview_store.get_overview(image)
         self.overview_image = overview_image.copy()
-        roi_img_path = os.path.join(self.working_dir, 'roi_0.png')
-        roi_path, action_message, bbox_info = slide_utils.get_image_from_bbox(image, x, y, level, roi_img_path)
+        overview_img_path = add_image('overview.png', overview_image)
+        if self.pin_overview:
+            instructor.pin_image(overview_image)
+        # Corner labels and the visited path are drawn once and reused across iterations
+        renderer = overlay.OverlayRenderer(overview_image)
+        policy = stopping_policy.StoppingPolicy(image, rules=self.stop_rules)
+        roi_image, action_message, bbox_info = slide_utils.get_bbox_region(image, x, y, level)
+        policy.record_visit(bbox_info)
+        roi_img_path = add_image('roi_0.png', roi_image)
+        roi_scores['roi_0.png'] = slide_utils.calculate_aod(roi_image)
 
         # Record the center
-        bbox_center_x = bbox_info["x_0"] + bbox_info["width_level"] // 2
-        bbox_center_y = bbox_info["y_0"] + bbox_info["height_level"] // 2
+        bbox_center_x = bbox_info["x_0"] + bbox_info["width_0"] // 2
+        bbox_center_y = bbox_info["y_0"] + bbox_info["height_0"] // 2
         history_points.append((bbox_center_x, bbox_center_y))
 
-        overview_with_bbox_path = os.path.join(self.working_dir, 'overview_with_bbox_0.png')
-        overview_with_bbox_path = slide_utils.draw_bbox_on_overview(overview_image, bbox_info, overview_with_bbox_path, history_points)
-        roi_and_overview_img_path = os.path.join(self.working_dir, 'roi_and_overview_0.png')
-        slide_utils.concatenate_images(overview_with_bbox_path, roi_img_path, roi_and_overview_img_path)
+        overview_with_bbox = renderer.render(bbox_info, history_points)
+        add_image('overview_with_bbox_0.png', overview_with_bbox)
+        roi_and_overview_img_path = add_image('roi_and_overview_0.png', slide_utils.compose_side_by_side(overview_with_bbox, roi_image))
 
-        final_roi_image_path = ""  # Variable to store the path of the last ROI image
-        final_overview_path = ""
+        final_roi_image_path = roi_img_path  # Variable to store the path of the last ROI image
+        final_overview_path = roi_and_overview_img_path
         final_bbox_info = None
         final_roi = None
 
@@ -146,86 +284,128 @@ class ROIAgent(ConversableAgent):
             [str(f"- Candidate {i+1}: (x={coord[0]:.2f}, y={coord[1]:.2f}, level={coord[2]})")
             for i, coord in enumerate(candidate_rois)]
         )
+        # Read the candidates (as the model sees them) and the current ROI's neighbours while it thinks
+        prefetcher = roi_prefetch.ROIPrefetcher(image) if self.prefetch else None
+        listed_candidates = [(round(cx, 2), round(cy, 2), clevel) for cx, cy, clevel in candidate_rois]
 
-        for i in range(self.n_iters):
-            if i == 0:
-                message_content = (
-                    f"WSI overview: <img {overview_img_path}>\n"
-                    f"Available levels: {available_downsample_levels}\n"
-                    f"ROI iteration {i+1}: <img {roi_and_overview_img_path}>\n"
-                    f"Please select the best ROI from the following candidates:\n{candidate_coords_str}\n"
-                    f"Query: {query}\n"
-                    "Choose the most suitable ROI based on the candidate list. Provide the coordinates as: <<x, y, level>>."
-                )
-                
-            else:
-                overview_img_path = os.path.join(self.working_dir, 'overview.png')
-                overview_image, overview_img_path = slide_utils.get_overview_image(image, overview_img_path)
-                roi_img_path = os.path.join(self.working_dir, f'roi_{i}.png')
-                roi_path, action_message, bbox_info = slide_utils.get_image_from_bbox(image, x, y, level, roi_img_path)
-
-                bbox_center_x = bbox_info["x_0"] + bbox_info["width_level"] // 2
-                bbox_center_y = bbox_info["y_0"] + bbox_info["height_level"] // 2
-                history_points.append((bbox_center_x, bbox_center_y))
-
-                overview_with_bbox_path = os.path.join(self.working_dir, f'overview_with_bbox_{i}.png')
-                overview_with_bbox_path = slide_utils.draw_bbox_on_overview(overview_image, bbox_info, overview_with_bbox_path, history_points)
-                # overview_with_roi_only_path = os.path.join(self.working_dir, f'overview_with_roi_only_{i}.png')
-                # overview_clean = overview_image_original.copy()
-                # overview_with_roi_only_path = slide_utils.draw_bbox_on_overview_roi_only(overview_clean, bbox_info, overview_with_roi_only_path, "orange")
-                roi_and_overview_img_path = os.path.join(self.working_dir, f'roi_and_overview_{i}.png')
-                slide_utils.concatenate_images(overview_with_bbox_path, roi_img_path, roi_and_overview_img_path)
-
-                # Update final_roi_image_path each iteration
-                final_roi_image_path = roi_img_path
-                final_overview_path = roi_and_overview_img_path
-                self.final_bbox_info = bbox_info
-                
-                # For i < 3, include the candidate list for selection
-                if i < 3:
+        try:
+            for i in range(self.n_iters):
+                if i == 0:
                     message_content = (
+                        f"WSI overview: <img {overview_img_path}>\n"
+                        f"Available levels: {available_downsample_levels}\n"
                         f"ROI iteration {i+1}: <img {roi_and_overview_img_path}>\n"
-                        f"Please select the best ROI from the candidates:\n{candidate_coords_str}\n"
+                        f"Please select the best ROI from the following candidates:\n{candidate_coords_str}\n"
                         f"Query: {query}\n"
-                        "Provide the coordinates as: <<x, y, level>>."
+                        "Choose the most suitable ROI based on the candidate list. Provide the coordinates as: <<x, y, level>>."
                     )
+                
                 else:
-                    # For i >= 3, switch to standard message
-                    message_content = (
-                        f"ROI iteration {i+1}: <img {roi_and_overview_img_path}>\n"
-                        f"ROI coordinates: (x={x}, y={y}, level={level})\n"
-                        f"Query: {query}\n"
-                        "Think carefully if the current ROI selection is best for answering the user query. Let's try to find a better ROI selection."
+                    if prefetcher is not None:
+                        roi_image, action_message, bbox_info, roi_aod, _ = prefetcher.get(x, y, level)
+                    else:
+                        roi_image, action_message, bbox_info = slide_utils.get_bbox_region(image, x, y, level)
+                        roi_aod = slide_utils.calculate_aod(roi_image)
+                    policy.record_visit(bbox_info)
+                    roi_img_path = add_image(f'roi_{i}.png', roi_image)
+                    roi_scores[f'roi_{i}.png'] = roi_aod
+
+                    bbox_center_x = bbox_info["x_0"] + bbox_info["width_0"] // 2
+                    bbox_center_y = bbox_info["y_0"] + bbox_info["height_0"] // 2
+                    history_points.append((bbox_center_x, bbox_center_y))
+
+                    overview_with_bbox = renderer.render(bbox_info, history_points)
+                    add_image(f'overview_with_bbox_{i}.png', overview_with_bbox)
+                    roi_and_overview_img_path = add_image(
+                        f'roi_and_overview_{i}.png', slide_utils.compose_side_by_side(overview_with_bbox, roi_image))
+
+                    # Update final_roi_image_path each iteration
+                    final_roi_image_path = roi_img_path
+                    final_overview_path = roi_and_overview_img_path
+                    self.final_bbox_info = bbox_info
+                
+                    # For i < 3, include the candidate list for selection
+                    if i < 3:
+                        message_content = (
+                            f"ROI iteration {i+1}: <img {roi_and_overview_img_path}>\n"
+                            f"Please select the best ROI from the candidates:\n{candidate_coords_str}\n"
+                            f"Query: {query}\n"
+                            "Provide the coordinates as: <<x, y, level>>."
+                        )
+                    else:
+                        # For i >= 3, switch to standard message
+                        message_content = (
+                            f"ROI iteration {i+1}: <img {roi_and_overview_img_path}>\n"
+                            f"ROI coordinates: (x={x}, y={y}, level={level})\n"
+                            f"Query: {query}\n"
+                            "Think carefully if the current ROI selection is best for answering the user query. Let's try to find a better ROI selection."
+                        )
+                if prefetcher is not None and i + 1 < self.n_iters:
+                    prefetcher.prefetch((listed_candidates if i < 3 else []) + prefetcher.neighbours_of(bbox_info, x, y, level))
+                started_at = time.time()
+                tokens_before = call_ledger.get_autogen_usage(instructor)
+                with call_ledger.call_site(**self.get_call_site(iteration=i)):
+                    commander.send(
+                        message={"content": build_message_content(str(message_content), iteration_images)},
+                        recipient=instructor,
+                        request_reply=True,
                     )
-            commander.send(
-                message=str(message_content),
-                recipient=instructor,
-                request_reply=True,
-            )
-
-            feedback = commander._oai_messages[instructor][-1]["content"]
-            if "TERMINATE".lower() in feedback.lower():
-                break
-            # parse the feedback to get x, y, level
-            matches = re.findall(r"<<x=(.*?), y=(.*?), level=(.*?)>>", feedback)
-            if matches:
-                new_x, new_y, new_level = matches[-1]
-                new_x, new_y, new_level = float(new_x), float(new_y), int(new_level)
+                    tokens_after = call_ledger.get_autogen_usage(instructor)
+                    usage = dict(
+                        prompt_tokens=tokens_after[0] - tokens_before[0],
+                        completion_tokens=tokens_after[1] - tokens_before[1],
+                        **instructor.last_request,
+                    )
+                    # Model and deployment the router sent the request to (none for an autogen cache hit)
+                    model = usage.pop("model", None) or instructor.llm_config["config_list"][0].get("model")
+                    call_ledger.record(None, model, started_at, **usage)
+                self.iteration_tokens.append(dict(iteration=i, **usage))
+                print(f"ROI iteration {i+1}: {usage['prompt_tokens']} prompt tokens, {usage['completion_tokens']} completion tokens, "
+                      f"{usage.get('images', 0)} images ({usage.get('compacted_turns', 0)} earlier turns compacted)")
+
+                feedback = commander._oai_messages[instructor][-1]["content"]
+                if "TERMINATE".lower() in feedback.lower():
+                    policy.stop("terminate")
+                    break
+                # parse the feedback to get x, y, level
+                matches = re.findall(r"<<x=(.*?), y=(.*?), level=(.*?)>>", feedback)
+                if matches:
+                    new_x, new_y, new_level = matches[-1]
+                    new_x, new_y, new_level = float(new_x), float(new_y), int(new_level)
+                else:
+                    print("No new coordinates found in the response; defaulting to last known ROI.")
+                    policy.stop("no_coordinates")
+                    break
+                policy.record_reply(feedback, tokens_after)
+                # Only stop once the instructor has seen at least one ROI it proposed (i >= 1)
+                if 1 <= i < self.n_iters - 1 and policy.check(new_x, new_y, new_level):
+                    print(f"Stopping ROI exploration after {policy.num_iterations} iterations: {policy.reason} ({policy.detail})")
+                    break
                 x, y, level = new_x, new_y, new_level
-            else:
-                print("No new coordinates found in the response; defaulting to last known ROI.")
-                break
-        
+        finally:
+            # Also on errors: stop the queued speculative slide reads
+            if prefetcher is not None:
+                prefetcher.close()
+        policy.stop("max_iterations")
+        self.stop_info = policy.summary()
+        if prefetcher is not None:
+            self.prefetch_stats = dict(prefetcher.stats)
+            print(prefetcher.summary())
+
         if self.to_predict:
             num_images_final = 3
             final_prompt = ""
-            if self.mode == "single":
-                final_prompt = prompt.get_final_prompt(self.cancer_type, self.task, self.vqa_msg)
-                response = get_openai_response_base64(final_prompt, final_roi_image_path)
-            elif self.mode == "multiple":
-                final_prompt = prompt.get_final_prompt_with_multiple_images(self.cancer_type, self.task, self.vqa_msg, num_images_final)
-                top_roi_files = slide_utils.select_top_rois(self.working_dir, num_images_final)
-                response = get_openai_response_base64_with_multiple_images(final_prompt, top_roi_files)
+            with call_ledger.call_site(**self.get_call_site(stage="final_prediction")):
+                if self.mode == "single":
+                    final_prompt = prompt.get_final_prompt(self.cancer_type, self.task, self.vqa_msg)
+                    final_roi_image = iteration_images.get(final_roi_image_path, final_roi_image_path)
+                    response = get_openai_response_base64(final_prompt, final_roi_image, task=self.task)
+                elif self.mode == "multiple":
+                    final_prompt = prompt.get_final_prompt_with_multiple_images(self.cancer_type, self.task, self.vqa_msg, num_images_final)
+                    top_roi_files = [os.path.join(self.working_dir, roi_file)
+                                     for roi_file in slide_utils.rank_top_rois(roi_scores, num_images_final)]
+                    response = get_openai_response_base64_with_multiple_images(
+                        final_prompt, [iteration_images[path] for path in top_roi_files], task=self.task)
 
             if self.task == "subtyping":
                 print("Model Response:", response)
@@ -249,10 +429,12 @@ class ROIAgent(ConversableAgent):
                 "correct_label": self.correct_label,
                 "is_correct": self.result == self.correct_label,
             }
+            sample_result.update(self.stop_info)
+            sample_result["iteration_tokens"] = self.iteration_tokens
             with open(save_result_path, "w") as f:
                 json.dump(sample_result, f, indent=4)
             
-            # Delete unnecessary files
+            # Write the kept images and delete stale ones from earlier runs
             keep_files = []  
             if self.mode == "single":
                 keep_files = [final_roi_image_path, final_overview_path]
@@ -262,9 +444,15 @@ class ROIAgent(ConversableAgent):
             for img_file in glob.glob(os.path.join(self.working_dir, '*.png')):
                 if img_file not in keep_files:
                     os.remove(img_file)
+            for img_file in keep_files:
+                if img_file in iteration_images:
+                    iteration_images[img_file].save(img_file)
 
         # save commander's chat_messages into json file
-        chat_messages = commander.chat_messages[instructor]
+        chat_messages = [
+            dict(message, content=content_to_text(message.get("content"), image_paths))
+            for message in commander.chat_messages[instructor]
+        ]
         save_history_path = os.path.join(self.working_dir, "chat_messages.json")
         with open(save_history_path, "w") as f:
             json.dump(chat_messages, f, indent=4)
@@ -0,0 +1,127 @@
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import config
+from src.subtyping import slide_utils
+from src.subtyping import tile_cache
+
+# Speculative ROI reads for ROIAgent.
+# While the instructor model is thinking, the candidate ROIs listed in the prompt and the neighbours
+# of the current ROI are read (and scored) on a small thread pool; OpenSlide releases the GIL while
+# decoding, so the reads overlap the LLM round trip. When the coordinates the model answers with
+# match a prefetched region exactly, the next iteration starts without touching the slide.
+# Speculative reads do not write the tile cache (most guesses are never visited); the tiles a
+# region decoded are stored only when that region is used.
+# Regions are keyed by the requested (x, y, level), as the model echoes them from the prompt.
+
+_stats = {"requests": 0, "hits": 0, "waits": 0, "misses": 0, "prefetched": 0, "saved_seconds": 0.0}
+_stats_lock = threading.Lock()
+
+
+def get_key(x, y, level):
+    return (round(float(x), 4), round(float(y), 4), int(level))
+
+
+def load_region(image, x, y, level, verbose=False, pending_tiles=None):
+    """(region, action_message, bbox_info, aod, seconds) for the ROI at x, y, level."""
+    started_at = time.time()
+    region, action_message, bbox_info = slide_utils.get_bbox_region(
+        image, x, y, level, verbose=verbose, pending_tiles=pending_tiles)
+    aod = slide_utils.calculate_aod(region)
+    return region, action_message, bbox_info, aod, time.time() - started_at
+
+
+def load_region_speculatively(image, x, y, level):
+    # load_region() without touching the tile cache; returns (result, tiles to store if used)
+    pending_tiles = {}
+    return load_region(image, x, y, level, pending_tiles=pending_tiles), pending_tiles
+
+
+def get_neighbours(bbox_info, x, y, level, max_level):
+    # One ROI width/height away in the 8 directions, plus the same position one level up and down
+    step_x = bbox_info["width_0"] / bbox_info["slide_width_0"]
+    step_y = bbox_info["height_0"] / bbox_info["slide_height_0"]
+    neighbours = []
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dx == 0 and dy == 0:
+                continue
+            nx, ny = round(x + dx * step_x, 2), round(y + dy * step_y, 2)
+            if 0 <= nx <= 1 and 0 <= ny <= 1:
+                neighbours.append((nx, ny, level))
+    for neighbour_level in (level - 1, level + 1):
+        if 0 <= neighbour_level <= max_level:
+            neighbours.append((x, y, neighbour_level))
+    return neighbours
+
+
+class ROIPrefetcher:
+    def __init__(self, image, max_workers=None, max_regions=None):
+        self.image = image
+        self.max_regions = max_regions or config.ROI_PREFETCH_MAX_REGIONS
+        self.neighbours = config.ROI_PREFETCH_NEIGHBOURS
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or config.ROI_PREFETCH_WORKERS,
+                                            thread_name_prefix="roi-prefetch")
+        self._futures = OrderedDict()  # key -> Future of load_region_speculatively
+        self.stats = {"requests": 0, "hits": 0, "waits": 0, "misses": 0, "prefetched": 0, "saved_seconds": 0.0}
+
+    def prefetch(self, rois):
+        """Start reading the (x, y, level) ROIs that are not read or queued yet (most likely first)."""
+        for x, y, level in rois:
+            key = get_key(x, y, level)
+            if key in self._futures:
+                self._futures.move_to_end(key)
+                continue
+            self._futures[key] = self._executor.submit(load_region_speculatively, self.image, x, y, level)
+            self._count("prefetched")
+        while len(self._futures) > self.max_regions:
+            # Guesses not renewed for the longest go first; a dropped queued read is never started
+            _, future = self._futures.popitem(last=False)
+            future.cancel()
+
+    def neighbours_of(self, bbox_info, x, y, level):
+        if not self.neighbours:
+            return []
+        return get_neighbours(bbox_info, x, y, level, self.image.level_count - 1)
+
+    def get(self, x, y, level):
+        """load_region() result for the ROI, from the prefetched regions when possible."""
+        self._count("requests")
+        future = self._futures.pop(get_key(x, y, level), None)
+        if future is not None and not future.cancelled():
+            ready = future.done()
+            started_at = time.time()
+            try:
+                result, pending_tiles = future.result()
+            except Exception as e:
+                print(f"Warning: ROI prefetch failed ({e}); reading the region again.")
+            else:
+                self._count("hits" if ready else "waits")
+                self._count("saved_seconds", max(0.0, result[4] - (time.time() - started_at)))
+                tile_cache.store_tiles(pending_tiles)
+                return result
+        self._count("misses")
+        return load_region(self.image, x, y, level, verbose=True)
+
+    def _count(self, name, value=1):
+        self.stats[name] += value
+        with _stats_lock:
+            _stats[name] += value
+
+    def summary(self):
+        stats = self.stats
+        served = stats["hits"] + stats["waits"]
+        hit_rate = served / stats["requests"] if stats["requests"] else 0.0
+        return (f"ROI prefetch: {served}/{stats['requests']} regions served from prefetch "
+                f"({hit_rate:.0%}, {stats['waits']} still in flight), "
+                f"{stats['prefetched']} prefetched, {stats['saved_seconds']:.2f}s saved")
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._futures.clear()
+
+
+def get_roi_prefetch_stats():
+    with _stats_lock:
+        return dict(_stats)
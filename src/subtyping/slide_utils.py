@@ -1,15 +1,15 @@
 import openslide
 import os
 import numpy as np
-import pandas as pd
-from PIL import Image, ImageDraw, ImageFont
-import openai
+from PIL import Image
 import base64
 import re
-import cv2
-import os
 import math
 import config
+from utils import metadata_store
+from src.subtyping import overview_store
+from src.subtyping import tile_cache
+from src.subtyping import overlay
 
 def calculate_f1_scores(results, subtypes):
     confusion_matrix = {subtype: {"tp": 0, "fp": 0, "fn": 0} for subtype in subtypes}
@@ -42,26 +42,26 @@ def select_top_rois(folder_path, num_rois=3):
         f for f in os.listdir(folder_path) 
         if re.match(r"^roi_\d+\.png$", f)  # Matches filenames like "roi_0.png", "roi_1.png"
     ]
-    roi_scores = []
+    roi_scores = {}
     for roi_file in roi_files:
         roi_path = os.path.join(folder_path, roi_file)
         with Image.open(roi_path) as img:
-            quality_score = calculate_aod(img)
-            roi_scores.append((roi_file, quality_score))
-
-    # Sort the ROIs by quality in descending order and select the top ones
-    top_rois = sorted(roi_scores, key=lambda x: x[1], reverse=True)[:num_rois-1]
-    if roi_files:
-        last_roi_file = max(roi_files, key=lambda x: int(re.search(r"roi_(\d+).png", x).group(1)))
-        last_roi_path = os.path.join(folder_path, last_roi_file)
-        with Image.open(last_roi_path) as img:
-            last_roi_score = calculate_aod(img)
-        top_rois.append((last_roi_file, last_roi_score))
+            roi_scores[roi_file] = calculate_aod(img)
+    return [os.path.join(folder_path, roi_file) for roi_file in rank_top_rois(roi_scores, num_rois)]
+
+def rank_top_rois(roi_scores, num_rois=3):
+    # roi_scores: {"roi_<i>.png": AOD}; the num_rois - 1 best other ROIs by AOD plus the last ROI
+    top_rois = []
+    if roi_scores:
+        last_roi_file = max(roi_scores, key=lambda x: int(re.search(r"roi_(\d+).png", x).group(1)))
+        others = [item for item in roi_scores.items() if item[0] != last_roi_file]
+        top_rois = sorted(others, key=lambda x: x[1], reverse=True)[:num_rois-1]
+        top_rois.append((last_roi_file, roi_scores[last_roi_file]))
     print("Top ROIs with their AOD values:")
     for roi_path, od in top_rois:
         print(f"File: {roi_path}, AOD: {od:.4f}")
     # Return only the file names of the top ROIs
-    return [os.path.join(folder_path, roi[0]) for roi in top_rois]
+    return [roi[0] for roi in top_rois]
 
 def calculate_aod(image):
     image = image.convert('L')
@@ -70,46 +70,18 @@ def calculate_aod(image):
     od = np.log10(255 / (mean_gray_value + 1))
     return od
 
-
-def is_tissue_region(image, level, x, y, patch_size=100, aod_threshold=0.05):
-    width, height = image.level_dimensions[level]
-    abs_x, abs_y = int(x * width), int(y * height)
-    if abs_x + patch_size > width or abs_y + patch_size > height:
-        return False
-    patch = image.read_region((abs_x, abs_y), level, (patch_size, patch_size)).convert("L")
-    # Calculate the AOD of the patch
-    patch_array = np.array(patch)
-    mean_gray_value = np.mean(patch_array)
-    od = np.log10(255 / (mean_gray_value + 1))
-    return od > aod_threshold
-
 def calculate_f1(tp, fp, fn):
     precision = tp / (tp + fp) if (tp + fp) > 0 else 0
     recall = tp / (tp + fn) if (tp + fn) > 0 else 0
     return 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
 
 def get_oncotree_code(sample_id):
-    sample_id = sample_id[:12]
-    data_path = config.META_DATA_DIR
-    df = pd.read_csv(data_path)
-    result = df[df['Patient ID'] == sample_id]
-    if not result.empty:
-        # Oncotree Code / TCGA PanCanAtlas Cancer Type Acronym
-        oncotree_code = result.iloc[0]['Oncotree Code']
-        # oncotree_code = result.iloc[0]['TCGA PanCanAtlas Cancer Type Acronym']
-        return oncotree_code
-    else:
-        return "None"
+    # Oncotree Code / TCGA PanCanAtlas Cancer Type Acronym
+    return metadata_store.get_oncotree_code(sample_id)
 
-def get_overview_image(image, save_path):
-    # Use the highest level to get the overview image
-    max_level = image.level_count - 1
-    x_dim, y_dim = image.level_dimensions[max_level]
-    overview = image.read_region((0, 0), max_level, (x_dim, y_dim))
-    # If the image is larger than 20MB, resize the image
-    if x_dim * y_dim > 1024 * 1024:
-        overview.thumbnail((1024, 1024))
-    overview = overview.convert("RGB")
+def get_overview_image(image, save_path, size=(1024, 1024)):
+    # Served from the per-slide overview store; the slide is decoded at most once
+    overview = overview_store.get_overview(image, size)
     overview.save(save_path)
     if os.path.exists(save_path):
         print(f"{save_path} exists.")
@@ -117,181 +89,103 @@ def get_overview_image(image, save_path):
         print(f"Failed to save {save_path}")
     return overview, save_path
 
-def get_image_from_bbox(image, x, y, level, save_path):
-    max_level = image.level_count
+def read_region_at_downsample(image, location_0, downsample, size, pending_tiles=None):
+    # Read `size` pixels at an arbitrary downsample: native levels are read directly,
+    # other magnifications are read from the nearest finer level and resized.
+    read_level = image.get_best_level_for_downsample(downsample)
+    scale = downsample / image.level_downsamples[read_level]
+    read_size = (max(1, int(round(size[0] * scale))), max(1, int(round(size[1] * scale))))
+    region = tile_cache.read_region(image, location_0, read_level, read_size, pending_tiles)
+    if read_size != tuple(size):
+        region = region.resize(size, Image.LANCZOS)
+    return region, read_level
+
+def get_bbox_extent(image, x, y, downsample, size=(1024, 1024)):
+    # Level-0 (x, y, width, height) of the region get_bbox_region reads at this downsample
+    x_dim_0, y_dim_0 = image.level_dimensions[0]
+    width_level, height_level = min(size[0], int(x_dim_0 / downsample)), min(size[1], int(y_dim_0 / downsample))
+    width_0, height_0 = int(width_level * downsample), int(height_level * downsample)
+    abs_x = min(max(int(x * x_dim_0), 0), x_dim_0 - width_0)
+    abs_y = min(max(int(y * y_dim_0), 0), y_dim_0 - height_0)
+    return abs_x, abs_y, width_0, height_0
+
+def get_bbox_region(image, x, y, level, size=(1024, 1024), downsample=None, verbose=True, pending_tiles=None):
     action_message = ""
-    abs_width, abs_height = 1024, 1024
-    if max_level < level:
+    max_level = image.level_count - 1
+    if level > max_level or level < 0:
         action_message += f"Error: The downsample level {level} is not available. The maximum level is {max_level}.\n"
+        level = min(max(level, 0), max_level)
+    if downsample is None:
+        downsample = image.level_downsamples[level]
 
     x_dim_0, y_dim_0 = image.level_dimensions[0]
-    print(f"level dimensions[0] = {x_dim_0}, {y_dim_0}")
-    abs_x, abs_y = int(x * x_dim_0), int(y * y_dim_0)
-    print(f"abs_x, abs_y = {abs_x}, {abs_y}")
-    level = 0
-    image.read_region((abs_x, abs_y), level, (abs_width, abs_height)).save(save_path)
+    slide_width_level, slide_height_level = int(x_dim_0 / downsample), int(y_dim_0 / downsample)
+    # Clamp the region to the slide at the requested magnification
+    width_level, height_level = min(size[0], slide_width_level), min(size[1], slide_height_level)
+    abs_x, abs_y, width_0, height_0 = get_bbox_extent(image, x, y, downsample, size)
+    if verbose:
+        print(f"level dimensions[0] = {x_dim_0}, {y_dim_0}")
+        print(f"abs_x, abs_y = {abs_x}, {abs_y}, level = {level}, downsample = {downsample:.2f}")
+    region, read_level = read_region_at_downsample(image, (abs_x, abs_y), downsample, (width_level, height_level), pending_tiles)
 
     # Extract mpp (magnification per pixel) information for level 0
     mpp_x_level_0 = float(image.properties.get('openslide.mpp-x', '0'))
     mpp_y_level_0 = float(image.properties.get('openslide.mpp-y', '0'))
 
-    # Calculate mpp for the specified level
-    if level >= len(image.level_downsamples):
-        level = len(image.level_downsamples) - 1
-    downsample_factor = image.level_downsamples[level]
-    mpp_x = mpp_x_level_0 * downsample_factor
-    mpp_y = mpp_y_level_0 * downsample_factor
-
     bbox_info = {
         "x_0": abs_x,
         "y_0": abs_y,
-        "width_level": abs_width,
-        "height_level": abs_height,
+        "width_0": width_0,
+        "height_0": height_0,
+        "width_level": width_level,
+        "height_level": height_level,
         "slide_width_0": x_dim_0,
         "slide_height_0": y_dim_0,
-        "slide_width_level": image.level_dimensions[level][0],
-        "slide_height_level": image.level_dimensions[level][1],
-        "mpp_x_level": mpp_x,
-        "mpp_y_level": mpp_y,
+        "slide_width_level": slide_width_level,
+        "slide_height_level": slide_height_level,
+        "mpp_x_level": mpp_x_level_0 * downsample,
+        "mpp_y_level": mpp_y_level_0 * downsample,
         "mpp_x_0": mpp_x_level_0,
         "mpp_y_0": mpp_y_level_0,
-        "level": level
+        "level": level,
+        "downsample": downsample,
+        "read_level": read_level,
     }
+    return region, action_message, bbox_info
 
+def get_image_from_bbox(image, x, y, level, save_path, size=(1024, 1024), downsample=None):
+    region, action_message, bbox_info = get_bbox_region(image, x, y, level, size, downsample)
+    region.save(save_path)
     return save_path, action_message, bbox_info
 
 def draw_bbox_on_overview_roi_all_tasks(overview_image, bbox_info_list, overview_save_path, color_list):
-    draw = ImageDraw.Draw(overview_image)
-    font_path = os.path.join(cv2.__path__[0],'qt','fonts','DejaVuSans.ttf')
-    font = ImageFont.truetype(font_path, size=20)
-    for bbox_info, color in zip(bbox_info_list, color_list):
-        x_ratio = bbox_info['x_0'] / bbox_info['slide_width_0']
-        y_ratio = bbox_info['y_0'] / bbox_info['slide_height_0']
-        overview_width, overview_height = overview_image.size
-        bbox_x = int(x_ratio * overview_width)
-        bbox_y = int(y_ratio * overview_height)
-        bbox_width = int(bbox_info['width_level'] * overview_width / bbox_info['slide_width_level'])
-        bbox_height = int(bbox_info['height_level'] * overview_height / bbox_info['slide_height_level'])
-        # Draw the bounding box
-        draw.rectangle([bbox_x, bbox_y, bbox_x + bbox_width, bbox_y + bbox_height], outline=color, width=5)
-    # Add text annotations
-    draw.text((5, 5), "x=0.0, y=0.0", fill="black", font=font)
-    draw.text((5, overview_height - 25), "x=0.0, y=1.0", fill="black", font=font)
-    draw.text((overview_width - 140, 5), "x=1.0, y=0.0", fill="black", font=font)
-    draw.text((overview_width - 140, overview_height - 25), "x=1.0, y=1.0", fill="black", font=font)
-    bbox_center_x = bbox_x
-    bbox_center_y = bbox_y - 30
-    # draw.text((bbox_center_x, bbox_center_y), f"x={x_ratio:.2f}, y={y_ratio:.2f}", fill="black", font=font)
-    # Save the image with the bounding box and annotations
-    overview_image.save(overview_save_path)
+    overlay.OverlayRenderer(overview_image).render_boxes(bbox_info_list, color_list).save(overview_save_path)
     return overview_save_path
 
 def draw_bbox_on_overview_roi_only(overview_image, bbox_info, overview_save_path, color):
-    draw = ImageDraw.Draw(overview_image)
-    font_path = os.path.join(cv2.__path__[0],'qt','fonts','DejaVuSans.ttf')
-    font = ImageFont.truetype(font_path, size=20)
-    x_ratio = bbox_info['x_0'] / bbox_info['slide_width_0']
-    y_ratio = bbox_info['y_0'] / bbox_info['slide_height_0']
-    overview_width, overview_height = overview_image.size
-    bbox_x = int(x_ratio * overview_width)
-    bbox_y = int(y_ratio * overview_height)
-    bbox_width = int(bbox_info['width_level'] * overview_width / bbox_info['slide_width_level'])
-    bbox_height = int(bbox_info['height_level'] * overview_height / bbox_info['slide_height_level'])
-    # Draw the bounding box
-    draw.rectangle([bbox_x, bbox_y, bbox_x + bbox_width, bbox_y + bbox_height], outline=color, width=5)
-    # Add text annotations
-    draw.text((5, 5), "x=0.0, y=0.0", fill="black", font=font)
-    draw.text((5, overview_height - 25), "x=0.0, y=1.0", fill="black", font=font)
-    draw.text((overview_width - 140, 5), "x=1.0, y=0.0", fill="black", font=font)
-    draw.text((overview_width - 140, overview_height - 25), "x=1.0, y=1.0", fill="black", font=font)
-    bbox_center_x = bbox_x
-    bbox_center_y = bbox_y - 30
-    # draw.text((bbox_center_x, bbox_center_y), f"x={x_ratio:.2f}, y={y_ratio:.2f}", fill="black", font=font)
-    # Save the image with the bounding box and annotations
-    overview_image.save(overview_save_path)
+    overlay.OverlayRenderer(overview_image).render_boxes([bbox_info], [color]).save(overview_save_path)
     return overview_save_path
 
 def draw_bbox_only_on_overview(overview_image, bbox_info, overview_save_path, color='red'):
-    draw = ImageDraw.Draw(overview_image)
-    #font = ImageFont.load_default()
-    font_path = os.path.join(cv2.__path__[0],'qt','fonts','DejaVuSans.ttf')
-    font = ImageFont.truetype(font_path, size=20)
-
-    # Scale the bounding box coordinates to the overview image
-    x_ratio = bbox_info['x_0'] / bbox_info['slide_width_0']
-    y_ratio = bbox_info['y_0'] / bbox_info['slide_height_0']
-    overview_width, overview_height = overview_image.size
-    bbox_x = int(x_ratio * overview_width)
-    bbox_y = int(y_ratio * overview_height)
-    bbox_width = int(bbox_info['width_level'] * overview_width / bbox_info['slide_width_level'])
-    bbox_height = int(bbox_info['height_level'] * overview_height / bbox_info['slide_height_level'])
-
-    # Draw the bounding box
-    draw.rectangle([bbox_x, bbox_y, bbox_x + bbox_width, bbox_y + bbox_height], outline=color, width=5)
-
-    # Save the image with the bounding box and annotations
-    overview_image.save(overview_save_path)
+    overlay.OverlayRenderer(overview_image).render_boxes([bbox_info], [color], labels=False).save(overview_save_path)
     return overview_save_path
 
 
 def draw_bbox_on_overview(overview_image, bbox_info, overview_save_path, history_points):
-    draw = ImageDraw.Draw(overview_image)
-    #font = ImageFont.load_default()
-    font_path = os.path.join(cv2.__path__[0],'qt','fonts','DejaVuSans.ttf')
-    font = ImageFont.truetype(font_path, size=20)
-
-    # Scale the bounding box coordinates to the overview image
-    x_ratio = bbox_info['x_0'] / bbox_info['slide_width_0']
-    y_ratio = bbox_info['y_0'] / bbox_info['slide_height_0']
-    overview_width, overview_height = overview_image.size
-    bbox_x = int(x_ratio * overview_width)
-    bbox_y = int(y_ratio * overview_height)
-    bbox_width = int(bbox_info['width_level'] * overview_width / bbox_info['slide_width_level'])
-    bbox_height = int(bbox_info['height_level'] * overview_height / bbox_info['slide_height_level'])
-
-    # History points
-    scaled_history_points = [
-        (int(x * overview_image.size[0] / bbox_info['slide_width_0']),
-        int(y * overview_image.size[1] / bbox_info['slide_height_0']))
-        for x, y in history_points
-    ]
-    for i in range(1, len(scaled_history_points)):
-        start = scaled_history_points[i - 1]
-        end = scaled_history_points[i]
-        draw.line([start, end], fill="red", width=3)  # Red lines for path
-    for i, point in enumerate(scaled_history_points):
-        cx, cy = point
-        radius = 5
-        draw.ellipse((cx - radius, cy - radius, cx + radius, cy + radius), fill="blue", outline="blue")
-        draw.text((cx + 10, cy), f"{i+1}", fill="black", font=font)
-
-    left_margin_x = 20
-    top_margin_y = 50
-    line_spacing = 20
-    for i, (original_x, original_y) in enumerate(history_points):
-        x_coord = round(original_x / bbox_info['slide_width_0'], 2)
-        y_coord = round(original_y / bbox_info['slide_height_0'], 2)
-        draw.text((left_margin_x, top_margin_y + i * line_spacing), f"{i+1}: x={x_coord}, y={y_coord}", fill="black", font=font)
-
-    # Draw the bounding box
-    draw.rectangle([bbox_x, bbox_y, bbox_x + bbox_width, bbox_y + bbox_height], outline="green", width=5)
-    # Add text annotations
-    draw.text((5, 5), "x=0.0, y=0.0", fill="black", font=font)
-    draw.text((5, overview_height - 25), "x=0.0, y=1.0", fill="black", font=font)
-    draw.text((overview_width - 140, 5), "x=1.0, y=0.0", fill="black", font=font)
-    draw.text((overview_width - 140, overview_height - 25), "x=1.0, y=1.0", fill="black", font=font)
-    bbox_center_x = bbox_x
-    bbox_center_y = bbox_y - 30
-    draw.text((bbox_center_x, bbox_center_y), f"x={x_ratio:.2f}, y={y_ratio:.2f}", fill="black", font=font)
-
-    # Save the image with the bounding box and annotations
-    overview_image.save(overview_save_path)
+    render_bbox_on_overview(overview_image, bbox_info, history_points).save(overview_save_path)
     return overview_save_path
 
+def render_bbox_on_overview(overview_image, bbox_info, history_points):
+    # One-off render; ROIAgent keeps an overlay.OverlayRenderer per slide to draw the path incrementally
+    return overlay.OverlayRenderer(overview_image).render(bbox_info, history_points)
+
 def concatenate_images(image1_path, image2_path, output_path):
     # Open the images
     image1 = Image.open(image1_path)
     image2 = Image.open(image2_path)
+    compose_side_by_side(image1, image2).save(output_path)
+
+def compose_side_by_side(image1, image2):
     # Get the dimensions of the images
     image1_width, image1_height = image1.size
     image2_width, image2_height = image2.size
@@ -302,5 +196,4 @@ def concatenate_images(image1_path, image2_path, output_path):
     # Paste the images into the new image
     new_image.paste(image1, (0, 0))
     new_image.paste(image2, (image1_width, 0))
-    # Save the concatenated image
-    new_image.save(output_path)
\ No newline at end of file
+    return new_image
\ No newline at end of file
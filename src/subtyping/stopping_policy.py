@@ -0,0 +1,162 @@
+import re
+import time
+import difflib
+import config
+from src.subtyping import slide_utils
+
+# Early stopping for the ROIAgent exploration loop.
+# After every instructor reply from the second iteration on (once it has seen an ROI it proposed) the
+# proposed ROI is checked against the rules in config.ROI_STOP_RULES (or the agent's own list); the
+# first rule that fires config.ROI_STOP_PATIENCE times in a row ends the exploration before the next
+# LLM call. Built-in rules:
+#   "duplicate"        - the proposal is (almost) the ROI just shown: same level, origin within
+#                        ROI_STOP_DUPLICATE_DISTANCE of an ROI width/height away
+#   "revisit"          - the proposal covers tissue already seen: IoU with an earlier ROI at the
+#                        same downsample of at least ROI_STOP_REVISIT_IOU
+#   "stable_reasoning" - the reply text (without the coordinates) is nearly the previous one
+#   "budget"           - wall-clock seconds or LLM cost (USD) spent on the slide reached its limit
+# More rules can be added with @register_rule("name"); a rule takes the ExplorationState and the
+# proposal (x, y, level) and returns a short detail string when it fires, else None.
+# The loop's other exits are recorded as "terminate", "no_coordinates" and "max_iterations".
+
+COORDINATE_TAG = re.compile(r"<<.*?>>")
+
+STOP_RULES = {}
+
+
+def register_rule(name):
+    def decorator(rule):
+        STOP_RULES[name] = rule
+        return rule
+    return decorator
+
+
+class ExplorationState:
+    def __init__(self, image):
+        self.image = image
+        self.started_at = time.time()
+        self.visited = []  # bbox_info of every ROI shown to the instructor
+        self.replies = []
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started_at
+
+    @property
+    def cost(self):
+        return (self.prompt_tokens * config.LLM_PRICE_INPUT_PER_M
+                + self.completion_tokens * config.LLM_PRICE_OUTPUT_PER_M) / 1e6
+
+    def get_extent(self, x, y, level):
+        """(level, downsample, level-0 x, y, width, height) of the ROI a proposal would read."""
+        level = min(max(level, 0), self.image.level_count - 1)
+        downsample = self.image.level_downsamples[level]
+        return (level, downsample) + slide_utils.get_bbox_extent(self.image, x, y, downsample)
+
+
+def get_iou(box_a, box_b):
+    ax, ay, aw, ah = box_a
+    bx, by, bw, bh = box_b
+    overlap_w = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    overlap_h = max(0, min(ay + ah, by + bh) - max(ay, by))
+    overlap = overlap_w * overlap_h
+    union = aw * ah + bw * bh - overlap
+    return overlap / union if union else 0.0
+
+
+@register_rule("duplicate")
+def duplicate_rule(state, proposal):
+    if not state.visited:
+        return None
+    level, _, abs_x, abs_y, width_0, height_0 = state.get_extent(*proposal)
+    last = state.visited[-1]
+    if level != last["level"]:
+        return None
+    dx = abs(abs_x - last["x_0"]) / max(width_0, 1)
+    dy = abs(abs_y - last["y_0"]) / max(height_0, 1)
+    if max(dx, dy) <= config.ROI_STOP_DUPLICATE_DISTANCE:
+        return f"proposal repeats the current ROI (offset {max(dx, dy):.2f} of an ROI)"
+    return None
+
+
+@register_rule("revisit")
+def revisit_rule(state, proposal):
+    _, downsample, abs_x, abs_y, width_0, height_0 = state.get_extent(*proposal)
+    for i, bbox_info in enumerate(state.visited):
+        if bbox_info["downsample"] != downsample:
+            continue
+        iou = get_iou((abs_x, abs_y, width_0, height_0),
+                      (bbox_info["x_0"], bbox_info["y_0"], bbox_info["width_0"], bbox_info["height_0"]))
+        if iou >= config.ROI_STOP_REVISIT_IOU:
+            return f"proposal revisits ROI {i} (IoU {iou:.2f})"
+    return None
+
+
+@register_rule("stable_reasoning")
+def stable_reasoning_rule(state, proposal):
+    if len(state.replies) < 2:
+        return None
+    previous, current = (COORDINATE_TAG.sub("", reply).strip() for reply in state.replies[-2:])
+    similarity = difflib.SequenceMatcher(None, previous, current).ratio()
+    if similarity >= config.ROI_STOP_REASONING_SIMILARITY:
+        return f"reply unchanged from the previous one (similarity {similarity:.2f})"
+    return None
+
+
+@register_rule("budget")
+def budget_rule(state, proposal):
+    if config.ROI_STOP_MAX_SECONDS is not None and state.elapsed >= config.ROI_STOP_MAX_SECONDS:
+        return f"{state.elapsed:.0f}s spent (limit {config.ROI_STOP_MAX_SECONDS}s)"
+    if config.ROI_STOP_MAX_COST_USD is not None and state.cost >= config.ROI_STOP_MAX_COST_USD:
+        return f"${state.cost:.4f} spent (limit ${config.ROI_STOP_MAX_COST_USD})"
+    return None
+
+
+class StoppingPolicy:
+    def __init__(self, image, rules=None, patience=None):
+        rules = config.ROI_STOP_RULES if rules is None else rules
+        unknown = [name for name in rules if name not in STOP_RULES]
+        if unknown:
+            raise ValueError(f"Unknown ROI stopping rule(s): {', '.join(unknown)}")
+        self.rules = list(rules)
+        self.patience = patience or config.ROI_STOP_PATIENCE
+        self.state = ExplorationState(image)
+        self.streaks = {name: 0 for name in self.rules}
+        self.reason = None
+        self.detail = None
+        self.num_iterations = 0
+
+    def record_visit(self, bbox_info):
+        self.state.visited.append(bbox_info)
+        self.num_iterations = len(self.state.visited)
+
+    def record_reply(self, reply, tokens=None):
+        # tokens: cumulative (prompt, completion) tokens of the conversation
+        self.state.replies.append(reply)
+        if tokens is not None:
+            self.state.prompt_tokens, self.state.completion_tokens = tokens
+
+    def check(self, x, y, level):
+        """Name of the rule that stops the exploration before visiting (x, y, level), or None."""
+        for name in self.rules:
+            detail = STOP_RULES[name](self.state, (x, y, level))
+            self.streaks[name] = self.streaks[name] + 1 if detail else 0
+            if detail and self.streaks[name] >= self.patience:
+                self.stop(name, detail)
+                return name
+        return None
+
+    def stop(self, reason, detail=None):
+        if self.reason is None:
+            self.reason, self.detail = reason, detail
+
+    def summary(self):
+        return {
+            "stop_reason": self.reason,
+            "stop_detail": self.detail,
+            "num_iterations": self.num_iterations,
+            "exploration_seconds": round(self.state.elapsed, 2),
+            "exploration_cost_usd": round(self.state.cost, 4),
+        }
@@ -1,14 +1,14 @@
 import os
 import json
 import random
-import openslide
+from utils import slide_pool
+from utils import call_ledger
 import multiprocessing
-import numpy as np
-from src.subtyping.roi_agent import ROIAgent
 from src.subtyping.slide_utils import get_image_from_bbox, get_oncotree_code, calculate_f1_scores
 import config
+from src.subtyping import overview_store
+from src.subtyping import tissue_mask
 import src.subtyping.subtyping_prompt as prompt
-from skimage.filters import threshold_otsu
 import re
 from collections import Counter
 from PIL import Image, ImageDraw, ImageFont
@@ -27,14 +27,15 @@ def get_random_coordinates():
 def process_slide(file_path, cancer_type, output_path, baseline_type, final_prompt):
     file_name = os.path.basename(file_path)
     sample_id = os.path.basename(file_name).split('.')[0]
-    image = openslide.OpenSlide(file_path)
-    if baseline_type == "random":
-        result = process_random_roi(image, sample_id, cancer_type, output_path, final_prompt)
-        # result = run_majority_vote_random_baseline(image, sample_id, cancer_type, output_path, final_prompt)
-    elif baseline_type == "gpt":
-        result = process_gpt_selected_roi(image, sample_id, cancer_type, output_path, final_prompt)
-    else:
-        raise ValueError(f"Unknown baseline type: {baseline_type}")
+    image = slide_pool.open_slide(file_path)
+    with call_ledger.call_site(task="subtyping", stage=f"baseline_{baseline_type}", sample_id=sample_id, cancer_type=cancer_type):
+        if baseline_type == "random":
+            result = process_random_roi(image, sample_id, cancer_type, output_path, final_prompt)
+            # result = run_majority_vote_random_baseline(image, sample_id, cancer_type, output_path, final_prompt)
+        elif baseline_type == "gpt":
+            result = process_gpt_selected_roi(image, sample_id, cancer_type, output_path, final_prompt)
+        else:
+            raise ValueError(f"Unknown baseline type: {baseline_type}")
     return result
 
 def run_majority_vote_random_baseline(image, sample_id, cancer_type, output_path, final_prompt, n=21):
@@ -63,42 +64,23 @@ def run_majority_vote_random_baseline(image, sample_id, cancer_type, output_path
     else:
         return None
 
-def generate_non_blank_mask(image, downscale_size=(2048, 2048)):
-    thumbnail = image.get_thumbnail(downscale_size).convert("L")
-    thumbnail_array = np.array(thumbnail)
-    # Apply Otsu's method to binarize
-    threshold = threshold_otsu(thumbnail_array)
-    binary_mask = thumbnail_array <= threshold  # Non-blank regions are darker
-    return binary_mask
-
-def get_random_tissue_coordinates(binary_mask):
-    tissue_coords = np.argwhere(binary_mask)
-    if len(tissue_coords) == 0:
-        raise ValueError("No tissue regions found in the WSI.")
-    selected_coord = tissue_coords[np.random.randint(len(tissue_coords))]
-    return selected_coord[1], selected_coord[0]  # x, y
-
-
 def process_random_roi(image, sample_id, cancer_type, output_path, final_prompt):
     os.makedirs(os.path.join(output_path, sample_id), exist_ok=True)
-    binary_mask = generate_non_blank_mask(image)
+    tissue = tissue_mask.get_tissue_mask(image)
     correct_label = get_oncotree_code(sample_id[:12])
-    for _ in range(100):  # Limit maximum attempts
-        try:
-            x, y = get_random_tissue_coordinates(binary_mask)  # Select a random tissue region
-            level = 0
-            roi_path, _, _ = get_image_from_bbox(
-                image, x / binary_mask.shape[1], y / binary_mask.shape[0], level,
-                save_path=os.path.join(output_path, sample_id, "random_roi.png")
-            )
-            print(f"Selected ROI: ({x}, {y}) at level {level}")
-            break
-        except ValueError:
-            print(f"No tissue found for {sample_id}. Skipping.")
-            return None
+    if tissue.num_tissue == 0:
+        print(f"No tissue found for {sample_id}. Skipping.")
+        return None
+    x, y = tissue.sample_pixels(1)[0]  # Select a random tissue region
+    level = 0
+    roi_path, _, _ = get_image_from_bbox(
+        image, x / tissue.width, y / tissue.height, level,
+        save_path=os.path.join(output_path, sample_id, "random_roi.png")
+    )
+    print(f"Selected ROI: ({x}, {y}) at level {level}")
 
     # Perform GPT-based prediction
-    predicted_label = get_openai_response_base64(final_prompt, roi_path)
+    predicted_label = get_openai_response_base64(final_prompt, roi_path, task="subtyping")
     if not predicted_label:
         print(f"WARNING: GPT failed to predict label for {sample_id}. Skipping.")
         return None
@@ -141,23 +123,14 @@ def process_gpt_selected_roi(image, sample_id, cancer_type, output_path, final_p
     and classify the selected ROI after parsing the response.
     """
     os.makedirs(os.path.join(output_path, sample_id), exist_ok=True)
-    binary_mask = generate_non_blank_mask(image)
-    image_width, image_height = binary_mask.shape[1], binary_mask.shape[0]
+    tissue = tissue_mask.get_tissue_mask(image)
+    image_width, image_height = tissue.width, tissue.height
     correct_label = get_oncotree_code(sample_id[:12])
     # print(f"Image dimensions - Width: {image_width}, Height: {image_height}")
-    candidate_coords = []
-    for _ in range(20):
-        try:
-            x, y = get_random_tissue_coordinates(binary_mask)
-            normalized_x = round(x / image_width, 2)
-            normalized_y = round(y / image_height, 2)
-            if isinstance(normalized_x, (int, float)) and isinstance(normalized_y, (int, float)):
-                candidate_coords.append((normalized_x, normalized_y))
-            else:
-                print(f"Invalid coordinates generated: {(normalized_x, normalized_y)}")
-        except ValueError as e:
-            print(f"Failed to generate tissue coordinates: {e}")
-            continue
+    candidate_coords = [
+        (round(x / image_width, 2), round(y / image_height, 2))
+        for x, y in tissue.sample_pixels(20)
+    ]
     if not candidate_coords:
         print(f"No valid tissue coordinates found for {sample_id}. Skipping.")
         return None
@@ -166,7 +139,7 @@ def process_gpt_selected_roi(image, sample_id, cancer_type, output_path, final_p
     thumbnail_path = get_thumbnail(image, output_path=os.path.join(output_path, f"{sample_id}_thumbnail.png"))
     text_prompt = prompt.generate_prompt_for_coordinates(cancer_type, coords_text)
     try:
-        best_point_response = get_openai_response_base64(text_prompt, thumbnail_path)
+        best_point_response = get_openai_response_base64(text_prompt, thumbnail_path, task="subtyping")
         selected_coord = parse_gpt_response(best_point_response, image_width, image_height)
     except Exception as e:
         print(f"Error in GPT response parsing: {e}")
@@ -178,14 +151,14 @@ def process_gpt_selected_roi(image, sample_id, cancer_type, output_path, final_p
     level = 0
     try:
         roi_path, _, _ = get_image_from_bbox(
-            image, new_x / binary_mask.shape[1], new_y / binary_mask.shape[0], level,  # Use level 0 (highest resolution)
+            image, new_x / image_width, new_y / image_height, level,  # Use level 0 (highest resolution)
             save_path=os.path.join(output_path, sample_id, "gpt_selected_roi.png")
         )
     except Exception as e:
         print(f"Error extracting ROI: {e}")
         return None
     try:
-        predicted_label = get_openai_response_base64(final_prompt, roi_path)
+        predicted_label = get_openai_response_base64(final_prompt, roi_path, task="subtyping")
     except Exception as e:
         print(f"Error in GPT subtype prediction: {e}")
         return None
@@ -204,7 +177,7 @@ def process_gpt_selected_roi(image, sample_id, cancer_type, output_path, final_p
     return sample_result
 
 def get_thumbnail(image, thumbnail_size=(1024, 1024), output_path="thumbnail.png"):
-    thumbnail = image.get_thumbnail(thumbnail_size)
+    thumbnail = overview_store.get_overview(image, thumbnail_size)
     thumbnail.save(output_path)
     return output_path
 
@@ -1,11 +1,11 @@
 import os
 import json
-import openslide
+from utils import slide_pool
 from PIL import Image
 from src.subtyping.roi_agent import ROIAgent
 from src.subtyping import slide_utils
 import config
-from utils.openai_client import azure_config_list
+from utils import llm_router
 from src.subtyping import subtyping_prompt as prompt
 from utils.file_utils import initialize_directories, get_svs_files_from_folders
 
@@ -25,12 +25,12 @@ def process_slide(file_path, cancer_type, output_path, messages):
         print(f"Existing sample: {sample_id}")
         return None
 
-    image = openslide.OpenSlide(file_path)
+    image = slide_pool.open_slide(file_path)
     roi_agent = ROIAgent(
         image=image,
         cancer_type=cancer_type,
         name="ROI Agent",
-        llm_config={"config_list": [azure_config_list[0]], "max_tokens": 3000},
+        llm_config={"config_list": llm_router.get_config_list(sample_id), "max_tokens": 3000},
         n_iters=config.NUM_ITER,
         task = "subtyping"
     )
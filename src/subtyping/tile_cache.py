@@ -0,0 +1,242 @@
+import os
+import json
+import fcntl
+import hashlib
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+import config
+
+# Decoded tile cache for read_region.
+# Regions are assembled from fixed-size tiles keyed by (slide, level, tile column, tile row).
+# Tiles live in an in-memory LRU (config.TILE_CACHE_MEMORY_BYTES, per process) backed by .npz
+# (compressed) or .npy files under config.TILE_CACHE_DIR (LRU by file mtime, bounded by
+# config.TILE_CACHE_DISK_BYTES), so revisiting a region skips the SVS JPEG decode across
+# iterations, tasks and retries.
+# The disk usage is shared by all worker processes in TILE_CACHE_DIR/usage.json under an flock;
+# one process at a time (evict.lock) re-stats the directory and evicts, without holding the usage
+# lock. Safe to call from several threads (ROI prefetch); slide reads and disk scans run unlocked.
+# Speculative reads pass pending_tiles={} to read_region: tiles not cached yet are collected there
+# instead of being stored, and store_tiles(pending_tiles) persists them once the region is used.
+
+TILE_EXTENSIONS = (".npz", ".npy")
+
+_memory_tiles = OrderedDict()
+_memory_bytes = 0
+_stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+_lock = threading.Lock()  # memory LRU
+
+
+def get_slide_key(image):
+    slide_path = getattr(image, "_filename", None)
+    if slide_path is None:
+        return None
+    try:
+        stat = os.stat(slide_path)
+    except OSError:
+        return None
+    raw_key = f"{os.path.realpath(slide_path)}|{stat.st_mtime_ns}|{stat.st_size}"
+    return hashlib.sha1(raw_key.encode("utf-8")).hexdigest()[:20]
+
+
+def _remember(key, tile):
+    global _memory_bytes
+    if key in _memory_tiles:
+        _memory_tiles.move_to_end(key)
+        return
+    _memory_tiles[key] = tile
+    _memory_bytes += tile.nbytes
+    while _memory_bytes > config.TILE_CACHE_MEMORY_BYTES and _memory_tiles:
+        _, evicted = _memory_tiles.popitem(last=False)
+        _memory_bytes -= evicted.nbytes
+
+
+def _scan_disk():
+    entries = []
+    for root, _, files in os.walk(config.TILE_CACHE_DIR):
+        for file in files:
+            if not file.endswith(TILE_EXTENSIONS) or ".tmp." in file:
+                continue
+            path = os.path.join(root, file)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+
+def _evict_disk():
+    # Drop least recently used tiles until the cache is back under 90% of its budget
+    entries = sorted(_scan_disk())
+    total = sum(size for _, size, _ in entries)
+    target = config.TILE_CACHE_DISK_BYTES * 0.9
+    for _, size, path in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+    return total
+
+
+@contextmanager
+def _locked_usage():
+    # Disk bytes used by the cache, shared by all processes; None until the directory is scanned
+    os.makedirs(config.TILE_CACHE_DIR, exist_ok=True)
+    with open(os.path.join(config.TILE_CACHE_DIR, "usage.json"), "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            usage = json.loads(f.read())
+        except ValueError:
+            usage = {}
+        usage.setdefault("bytes", None)
+        yield usage
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(usage))
+        f.flush()
+
+
+@contextmanager
+def _eviction_lock():
+    # Yields True in the one process (and thread) allowed to evict; others skip eviction
+    with open(os.path.join(config.TILE_CACHE_DIR, "evict.lock"), "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+
+
+def _account_disk(nbytes):
+    with _locked_usage() as usage:
+        if usage["bytes"] is not None:
+            usage["bytes"] += nbytes
+            if usage["bytes"] <= config.TILE_CACHE_DISK_BYTES:
+                return
+        started_bytes = usage["bytes"] or 0
+    with _eviction_lock() as evicting:
+        if not evicting:
+            return
+        # Re-stat the directory (the shared count can drift when processes write the same tile)
+        # and evict without holding the usage lock
+        remaining = _evict_disk()
+        with _locked_usage() as usage:
+            # Keep what other processes added during the scan
+            usage["bytes"] = remaining + max(0, (usage["bytes"] or 0) - started_bytes)
+
+
+def _tile_path(slide_key, level, col, row):
+    extension = ".npz" if config.TILE_CACHE_COMPRESS else ".npy"
+    return os.path.join(config.TILE_CACHE_DIR, slide_key, str(level), f"{col}_{row}{extension}")
+
+
+def _load_tile(tile_path):
+    if tile_path.endswith(".npz"):
+        with np.load(tile_path) as data:
+            return data["tile"]
+    return np.load(tile_path)
+
+
+def _save_tile(key, tile):
+    slide_key, level, col, row = key
+    tile_path = _tile_path(slide_key, level, col, row)
+    try:
+        os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+        tmp_path = f"{tile_path}.{os.getpid()}.{threading.get_ident()}.tmp{os.path.splitext(tile_path)[1]}"
+        if config.TILE_CACHE_COMPRESS:
+            np.savez_compressed(tmp_path, tile=tile)
+        else:
+            np.save(tmp_path, tile)
+        nbytes = os.path.getsize(tmp_path)
+        os.replace(tmp_path, tile_path)
+        _account_disk(nbytes)
+    except OSError as e:
+        print(f"Warning: Failed to cache tile {tile_path}: {e}")
+
+
+def get_tile(image, slide_key, level, col, row, pending_tiles=None):
+    key = (slide_key, level, col, row)
+    with _lock:
+        tile = _memory_tiles.get(key)
+        if tile is not None:
+            _memory_tiles.move_to_end(key)
+            _stats["memory_hits"] += 1
+            return tile
+    if pending_tiles is not None and key in pending_tiles:
+        return pending_tiles[key]
+
+    tile_path = _tile_path(slide_key, level, col, row)
+    if os.path.exists(tile_path):
+        try:
+            tile = _load_tile(tile_path)
+            if pending_tiles is None:
+                os.utime(tile_path)  # refresh LRU position
+            _stats["disk_hits"] += 1
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Warning: Failed to read cached tile {tile_path}: {e}")
+            tile = None
+        if tile is not None and pending_tiles is not None:
+            return tile
+
+    if tile is None:
+        _stats["misses"] += 1
+        tile_size = config.TILE_CACHE_TILE_SIZE
+        downsample = image.level_downsamples[level]
+        location_0 = (int(col * tile_size * downsample), int(row * tile_size * downsample))
+        tile = np.asarray(image.read_region(location_0, level, (tile_size, tile_size)))
+        if pending_tiles is not None:
+            # Speculative read: keep the tile out of both tiers until store_tiles()
+            pending_tiles[key] = tile
+            return tile
+        _save_tile(key, tile)
+    with _lock:
+        _remember(key, tile)
+    return tile
+
+
+def store_tiles(pending_tiles):
+    """Persist the tiles a speculative read_region(..., pending_tiles=...) decoded."""
+    for key, tile in pending_tiles.items():
+        _save_tile(key, tile)
+        with _lock:
+            _remember(key, tile)
+
+
+def read_region(image, location_0, level, size, pending_tiles=None):
+    """
+    Drop-in replacement for image.read_region(location_0, level, size) that assembles the
+    region from cached tiles. Falls back to a direct read when the slide path is unknown.
+    With pending_tiles (a dict), newly decoded tiles are collected there instead of cached.
+    """
+    slide_key = get_slide_key(image) if config.TILE_CACHE_ENABLED else None
+    if slide_key is None:
+        return image.read_region(location_0, level, size)
+    tile_size = config.TILE_CACHE_TILE_SIZE
+    downsample = image.level_downsamples[level]
+    left, top = int(location_0[0] / downsample), int(location_0[1] / downsample)
+    width, height = size
+    canvas = np.zeros((height, width, 4), dtype=np.uint8)
+    for row in range(top // tile_size, (top + height - 1) // tile_size + 1):
+        for col in range(left // tile_size, (left + width - 1) // tile_size + 1):
+            tile = get_tile(image, slide_key, level, col, row, pending_tiles)
+            # Overlap of this tile with the requested region, in level coordinates
+            x_start, y_start = max(left, col * tile_size), max(top, row * tile_size)
+            x_end = min(left + width, (col + 1) * tile_size)
+            y_end = min(top + height, (row + 1) * tile_size)
+            canvas[y_start - top:y_end - top, x_start - left:x_end - left] = tile[
+                y_start - row * tile_size:y_end - row * tile_size,
+                x_start - col * tile_size:x_end - col * tile_size,
+            ]
+    return Image.fromarray(canvas, "RGBA")
+
+
+def get_tile_cache_stats():
+    return dict(_stats, memory_tiles=len(_memory_tiles), memory_bytes=_memory_bytes)
@@ -0,0 +1,122 @@
+import random
+from collections import OrderedDict
+import numpy as np
+import config
+from src.subtyping import overview_store
+
+# Per-slide tissue masks computed from the cached overview (no extra slide reads).
+# A TissueMask keeps the flat tissue indices and a coarse grid of per-cell tissue fractions,
+# so candidate generators can draw any number of tissue coordinates in one vectorized call.
+
+_mask_cache = OrderedDict()
+
+
+def get_rng(rng=None):
+    # Without an explicit rng (Generator or seed), draw the seed from the global `random` state,
+    # so runs seeded with random.seed(...) sample the same coordinates
+    if isinstance(rng, np.random.Generator):
+        return rng
+    return np.random.default_rng(random.getrandbits(64) if rng is None else rng)
+
+
+class TissueMask:
+    def __init__(self, mask, cell_size=32):
+        self.mask = mask
+        self.height, self.width = mask.shape
+        self.cell_size = cell_size
+        self.tissue_indices = np.flatnonzero(mask)
+        self.grid_cols = -(-self.width // cell_size)
+        self.grid_rows = -(-self.height // cell_size)
+        cell_ids = self._cell_ids(self.tissue_indices)
+        cell_counts = np.bincount(cell_ids, minlength=self.grid_rows * self.grid_cols)
+        self.cell_fraction = (cell_counts / float(cell_size * cell_size)).reshape(self.grid_rows, self.grid_cols)
+        self._pools = {}
+
+    @property
+    def num_tissue(self):
+        return len(self.tissue_indices)
+
+    def _cell_ids(self, flat_indices):
+        rows, cols = np.divmod(flat_indices, self.width)
+        return (rows // self.cell_size) * self.grid_cols + cols // self.cell_size
+
+    def tissue_fraction(self, x, y):
+        # x, y are normalized slide coordinates
+        col = min(int(x * self.width) // self.cell_size, self.grid_cols - 1)
+        row = min(int(y * self.height) // self.cell_size, self.grid_rows - 1)
+        return float(self.cell_fraction[row, col])
+
+    def _get_pool(self, bounds):
+        # Tissue indices inside `bounds`, grouped by grid cell for stratified draws
+        if bounds not in self._pools:
+            indices = self.tissue_indices
+            if bounds is not None:
+                low, high = bounds
+                rows, cols = np.divmod(indices, self.width)
+                inside = (
+                    (cols >= low * self.width) & (cols < high * self.width)
+                    & (rows >= low * self.height) & (rows < high * self.height)
+                )
+                indices = indices[inside]
+            cell_ids = self._cell_ids(indices)
+            order = np.argsort(cell_ids, kind="stable")
+            indices = indices[order]
+            _, cell_starts, cell_counts = np.unique(cell_ids[order], return_index=True, return_counts=True)
+            self._pools[bounds] = (indices, cell_starts, cell_counts)
+        return self._pools[bounds]
+
+    def sample_pixels(self, n, rng=None, stratified=False, bounds=None):
+        """
+        Draw n tissue pixels as an (n, 2) array of (x, y) mask coordinates.
+        stratified=True spreads the draws over distinct grid cells (weighted by tissue area).
+        bounds=(low, high) restricts both normalized axes to [low, high).
+        """
+        rng = get_rng(rng)
+        indices, cell_starts, cell_counts = self._get_pool(bounds)
+        if len(indices) == 0 or n <= 0:
+            return np.empty((0, 2), dtype=np.int64)
+        if stratified:
+            weights = cell_counts / cell_counts.sum()
+            num_distinct = min(n, len(cell_counts))
+            cells = rng.choice(len(cell_counts), size=num_distinct, replace=False, p=weights)
+            if num_distinct < n:
+                extra = rng.choice(len(cell_counts), size=n - num_distinct, replace=True, p=weights)
+                cells = np.concatenate([cells, extra])
+            picks = cell_starts[cells] + (rng.random(n) * cell_counts[cells]).astype(np.int64)
+        else:
+            picks = rng.integers(len(indices), size=n)
+        rows, cols = np.divmod(indices[picks], self.width)
+        return np.stack([cols, rows], axis=1)
+
+    def sample(self, n, rng=None, stratified=False, bounds=None):
+        # Normalized (x, y) slide coordinates, jittered uniformly inside each mask pixel
+        rng = get_rng(rng)
+        pixels = self.sample_pixels(n, rng=rng, stratified=stratified, bounds=bounds)
+        jitter = rng.random(pixels.shape)
+        return (pixels + jitter) / np.array([self.width, self.height], dtype=float)
+
+
+def compute_mask(gray, method="otsu", aod_threshold=0.05):
+    if method == "otsu":
+        # Non-blank regions are darker than the Otsu threshold
+        from skimage.filters import threshold_otsu
+        return gray <= threshold_otsu(gray)
+    elif method == "aod":
+        # AOD as in slide_utils.calculate_aod: log10(255 / (gray + 1)) > aod_threshold
+        return gray < 255 / (10 ** aod_threshold) - 1
+    raise ValueError(f"Unknown tissue mask method: {method}")
+
+
+def get_tissue_mask(image, size=(2048, 2048), method="otsu", aod_threshold=0.05):
+    key = overview_store.get_overview_key(image, size)
+    cache_key = (key, method, aod_threshold) if key is not None else None
+    if cache_key is not None and cache_key in _mask_cache:
+        _mask_cache.move_to_end(cache_key)
+        return _mask_cache[cache_key]
+    gray = np.array(overview_store.get_overview(image, size).convert("L"))
+    tissue_mask = TissueMask(compute_mask(gray, method, aod_threshold))
+    if cache_key is not None:
+        _mask_cache[cache_key] = tissue_mask
+        while len(_mask_cache) > config.TISSUE_MASK_CACHE_ITEMS:
+            _mask_cache.popitem(last=False)
+    return tissue_mask
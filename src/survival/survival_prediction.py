@@ -6,6 +6,9 @@ import pandas as pd
 from sksurv.metrics import concordance_index_censored
 import numpy as np
 from src.subtyping.slide_utils import get_oncotree_code
+from utils import metadata_store
+from utils import llm_batch
+from utils import call_ledger
 from utils.openai_client import get_openai_response_base64_with_multiple_images
 
 def generate_few_shot_examples(base_dir, cancer_type):
@@ -56,19 +59,13 @@ def generate_survival_prediction_prompt(cancer_type, few_shot_examples):
     return prompt
 
 def get_survival_info(sample_id):
-    df = pd.read_csv(config.META_DATA_DIR)
-    result = df[df['Patient ID'] == sample_id[:12]]
-    if result.empty:
-        return None, None
-    survival_months = result.iloc[0]['Overall Survival (Months)']
-    survival_status = result.iloc[0]['Overall Survival Status']
-    if pd.isna(survival_months) or pd.isna(survival_status):
-        return None, None
-    is_deceased = "DECEASED" in str(survival_status)
-    return float(survival_months), is_deceased
-
-
-def get_risk_levels(cancer_type, input_dir, mode, n=10):
+    return metadata_store.get_survival_info(sample_id)
+
+
+def get_risk_levels(cancer_type, input_dir, mode, n=10, batch=False):
+    if batch:
+        return llm_batch.run_in_batch(get_risk_levels, cancer_type, input_dir, mode, n,
+                                      name=f"survival_{cancer_type}_{mode}")
     few_shot_examples = generate_few_shot_examples(
         os.path.join(config.ROOT_DIR, "data/survival_examples"), cancer_type)
     final_prompt = generate_survival_prediction_prompt(cancer_type, few_shot_examples)
@@ -101,7 +98,12 @@ def get_risk_levels(cancer_type, input_dir, mode, n=10):
         roi_image_paths = few_shot_images + roi_image_paths
 
         try:
-            response = get_openai_response_base64_with_multiple_images(final_prompt, roi_image_paths)
+            with call_ledger.call_site(task="survival", stage=f"risk_level_{mode}", sample_id=sample_id, cancer_type=cancer_type):
+                response = get_openai_response_base64_with_multiple_images(final_prompt, roi_image_paths, task="survival")
+            if llm_batch.is_collecting():
+                if idx > n and n != -1:
+                    break
+                continue
             if not response:
                 raise ValueError("Empty response")
             pred_label = int(response)
@@ -2,21 +2,10 @@ import os
 import json
 import config
 from utils.file_utils import find_svs_file
+from src.vqa.questions import extract_all_sample_id
 
 def extract_all_sample_ids_to_txt(output_file="sample_ids.txt"):
-    data_dir = os.path.join(config.ROOT_DIR, "data", "question_list")
-    file_names = ["WsiVQA_train.json", "WsiVQA_val.json", "WsiVQA_test.json"]
-    sample_ids = set()
-    for file_name in file_names:
-        file_path = os.path.join(data_dir, file_name)
-        if not os.path.exists(file_path):
-            print(f"Warning: {file_path} not found.")
-            continue
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            for item in data:
-                if "Id" in item:
-                    sample_ids.add(item["Id"])
+    sample_ids = extract_all_sample_id()
     with open(output_file, "w") as f:
         for sample_id in sorted(sample_ids):
             f.write(sample_id + "\n")
@@ -1,54 +1,101 @@
 import os
 import json
+import pickle
 from collections import defaultdict
 import config
 from utils.file_utils import find_svs_file
 import random
 
-def get_vqa_for_sample(sample_id):
-    data_dir = os.path.join(config.ROOT_DIR, "data/question_list")
-    file_names = ["WsiVQA_train.json", "WsiVQA_val.json", "WsiVQA_test.json"]
-    vqa_data = []
-    for file_name in file_names:
+VQA_SPLITS = {
+    "train": "WsiVQA_train.json",
+    "val": "WsiVQA_val.json",
+    "test": "WsiVQA_test.json",
+}
+
+_vqa_index = None
+
+def _get_vqa_file_mtimes(data_dir):
+    mtimes = {}
+    for split, file_name in VQA_SPLITS.items():
         file_path = os.path.join(data_dir, file_name)
-        if not os.path.exists(file_path):
+        mtimes[split] = os.path.getmtime(file_path) if os.path.exists(file_path) else None
+    return mtimes
+
+def _build_vqa_index(data_dir, mtimes):
+    questions_by_id = defaultdict(list)
+    ids_by_split = {}
+    for split, file_name in VQA_SPLITS.items():
+        file_path = os.path.join(data_dir, file_name)
+        if mtimes[split] is None:
             print(f"Warning: {file_path} not found.")
+            ids_by_split[split] = []
             continue
         with open(file_path, "r", encoding="utf-8") as f:
             data = json.load(f)
-            for item in data:
-                if item["Id"] == sample_id:
-                    if "Question" not in item or "Choice" not in item:
-                        # print(f"Warning: Missing 'Question' or 'Choice' in sample {sample_id}: {item}")
-                        continue
-                    question_text = item["Question"]
-                    answer_text = item["Answer"]
-                    choices = item["Choice"] if isinstance(item["Choice"], list) else []
-                    vqa_data.append({
-                        "question": question_text,
-                        "choices": choices,
-                        "answer": answer_text
-                    })
-    return vqa_data
+        split_ids = {}
+        for item in data:
+            if "Id" not in item:
+                continue
+            split_ids.setdefault(item["Id"], None)  # keeps first-seen order
+            if "Question" not in item or "Choice" not in item:
+                continue
+            questions_by_id[item["Id"]].append({
+                "question": item["Question"],
+                "choices": item["Choice"] if isinstance(item["Choice"], list) else [],
+                "answer": item["Answer"],
+                "split": split,
+            })
+        ids_by_split[split] = list(split_ids)
+    return {"mtimes": mtimes, "questions_by_id": dict(questions_by_id), "ids_by_split": ids_by_split}
 
-def extract_all_sample_id(num_samples=-1):
+def get_vqa_index():
+    # Parsed once per process; persisted as a pickle that is rebuilt when any WsiVQA file changes
+    global _vqa_index
+    if _vqa_index is not None:
+        return _vqa_index
     data_dir = os.path.join(config.ROOT_DIR, "data/question_list")
-    file_names = ["WsiVQA_train.json", "WsiVQA_val.json", "WsiVQA_test.json"]
+    cache_path = config.VQA_INDEX_CACHE_PATH
+    mtimes = _get_vqa_file_mtimes(data_dir)
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as f:
+                cached = pickle.load(f)
+            if cached.get("mtimes") == mtimes:
+                _vqa_index = cached
+                return _vqa_index
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+            print(f"Warning: Failed to load VQA index {cache_path}: {e}")
+    _vqa_index = _build_vqa_index(data_dir, mtimes)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(_vqa_index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Warning: Failed to save VQA index {cache_path}: {e}")
+    return _vqa_index
+
+def get_vqa_for_sample(sample_id, splits=None):
+    questions = get_vqa_index()["questions_by_id"].get(sample_id, [])
+    return [
+        {"question": qa["question"], "choices": qa["choices"], "answer": qa["answer"]}
+        for qa in questions
+        if splits is None or qa["split"] in splits
+    ]
+
+def extract_all_sample_id(num_samples=-1, splits=None):
+    ids_by_split = get_vqa_index()["ids_by_split"]
     sample_ids = set()
-    for file_name in file_names:
-        file_path = os.path.join(data_dir, file_name)
-        if not os.path.exists(file_path):
-            print(f"Warning: {file_path} not found.")
+    for split in VQA_SPLITS:
+        if splits is not None and split not in splits:
             continue
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            for item in data:
-                if "Id" in item:
-                    sample_ids.add(item["Id"])
-                if num_samples != -1 and len(sample_ids) >= num_samples:
-                    print(f"Reached extraction limit: {num_samples} samples.")
-                    return sample_ids
-        print(f"Added from {file_name}")
+        for sample_id in ids_by_split[split]:
+            sample_ids.add(sample_id)
+            if num_samples != -1 and len(sample_ids) >= num_samples:
+                print(f"Reached extraction limit: {num_samples} samples.")
+                return sample_ids
+        print(f"Added from {VQA_SPLITS[split]}")
     print(f"Total unique sample IDs extracted: {len(sample_ids)}")
     return sample_ids
 
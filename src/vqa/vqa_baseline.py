@@ -1,12 +1,11 @@
 import os
 import json
 import random
-import openslide
+from utils import slide_pool
 import numpy as np
 from src.subtyping.subtyping_baseline import process_random_roi, process_gpt_selected_roi
 from src.vqa.vqa_evaluate import evaluate_vqa
 from src.vqa.questions import get_vqa_for_sample
-from src.subtyping.roi_agent import ROIAgent
 import src.subtyping.slide_utils
 import config
 from src.vqa.questions import extract_all_sample_id, get_selected_svs_files
@@ -17,7 +16,7 @@ from utils.file_utils import initialize_directories, get_svs_files_from_folders
 def process_slide(file_path, cancer_type, output_path, baseline_type, final_prompt):
     file_name = os.path.basename(file_path)
     sample_id = os.path.basename(file_name).split('.')[0]
-    image = openslide.OpenSlide(file_path)
+    image = slide_pool.open_slide(file_path)
     if baseline_type == "random":
         result = process_random_roi(image, sample_id, cancer_type, output_path, final_prompt)
     elif baseline_type == "gpt":
@@ -1,12 +1,13 @@
 import os
 import json
 import config
-import openslide
+from utils import slide_pool
 import signal
 import multiprocessing
 import random
 from src.subtyping.roi_agent import ROIAgent
-from utils.openai_client import azure_config_list
+from utils import llm_router
+from utils import response_cache
 from src.subtyping.subtyping_evaluate import (
     save_results
 )
@@ -35,13 +36,13 @@ def process_vqa_slide(file_path, cancer_type, output_path, overwrite):
             if os.path.exists(result_path):
                 print(f"result.json already exists for {sample_id}.")
                 return None
-        image = openslide.OpenSlide(file_path)
+        image = slide_pool.open_slide(file_path)
         # Perform VQA using ROI Agent
         roi_agent = ROIAgent(
             image=image,
             cancer_type=cancer_type,
             name="VQA ROI Agent",
-            llm_config={"config_list": [azure_config_list[0]], "max_tokens": 3000},
+            llm_config={"config_list": llm_router.get_config_list(sample_id), "max_tokens": 3000},
             n_iters=10,
             mode="multiple",
             task="vqa"
@@ -100,7 +101,9 @@ def evaluate_vqa(sample_id, vqa_questions, analysis_result):
 def retry_evaluation(file_path, cancer_type, output_path, max_retries=5, accuracy_threshold=0.3, overwrite=False):
     for attempt in range(max_retries):
         print(f"Processing {file_path} (Attempt {attempt + 1}/{max_retries})")
-        evaluation_result = process_vqa_slide(file_path, cancer_type, output_path, overwrite)
+        # A retry must draw new answers rather than replay the cached ones
+        with response_cache.cache_mode(response_cache.get_cache_mode() if attempt == 0 else "bypass"):
+            evaluation_result = process_vqa_slide(file_path, cancer_type, output_path, overwrite)
         if evaluation_result is None:
             return None
         accuracy = evaluation_result.get("accuracy", 0)
@@ -0,0 +1,238 @@
+import os
+import time
+import asyncio
+import threading
+import weakref
+import httpx
+import config
+from utils import response_cache
+from utils import rate_limiter
+from utils import llm_router
+from utils import hedging
+from utils import call_ledger
+from utils import singleflight
+from utils.openai_client import (
+    get_failover_errors,
+    get_cached_response,
+    build_text_messages,
+    build_image_messages,
+)
+
+# Async counterparts of utils/openai_client with one HTTP connection pool (shared by the clients
+# for all deployments) and a semaphore (config.LLM_MAX_CONCURRENCY) per event loop. The sync
+# facade at the bottom runs requests on a shared background loop, so a single process can keep
+# hundreds of calls in flight. With config.LLM_HEDGE_ENABLED, slow requests are hedged
+# (see utils/hedging); utils.openai_client.create_chat_completion then runs through here too.
+
+_loop_state = weakref.WeakKeyDictionary()  # event loop -> (http client, {deployment index: client}, semaphore)
+_background_loop = None
+_background_lock = threading.Lock()
+
+
+def _create_http_client():
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=config.LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=config.LLM_MAX_CONNECTIONS,
+        ),
+        timeout=httpx.Timeout(config.LLM_REQUEST_TIMEOUT, connect=10.0),
+    )
+
+
+def _get_loop_state():
+    # httpx connection pools and semaphores are bound to the loop that created them
+    loop = asyncio.get_running_loop()
+    if loop not in _loop_state:
+        _loop_state[loop] = (_create_http_client(), {}, asyncio.Semaphore(config.LLM_MAX_CONCURRENCY))
+    return _loop_state[loop]
+
+
+def _get_async_client(index):
+    http_client, clients, _ = _get_loop_state()
+    if index not in clients:
+        clients[index] = llm_router.create_client(index, use_async=True, http_client=http_client)
+    return clients[index]
+
+
+async def _request(index, messages, temperature, model, call_info):
+    # One rate-limited request to deployment `index`; updates router and hedging statistics
+    request_kwargs = {"model": llm_router.get_deployment(index).get("model", model), "messages": messages}
+    if temperature is not None:
+        request_kwargs["temperature"] = temperature
+    async_client = _get_async_client(index)
+    latency = []
+
+    async def send_request():
+        started_at = time.time()
+        result = await async_client.chat.completions.create(**request_kwargs)
+        latency.append(time.time() - started_at)
+        return result
+
+    try:
+        response = await rate_limiter.async_call(
+            send_request, messages, call_info, llm_router.get_max_retries(index), index)
+    except get_failover_errors():
+        llm_router.record(index, error=True)
+        raise
+    llm_router.record(index, latency[-1])
+    hedging.record_latency(latency[-1])
+    call_info["deployment"], call_info["api_latency"] = index, latency[-1]
+    return response
+
+
+async def _hedged_request(index, messages, temperature, model, call_info):
+    primary = asyncio.ensure_future(_request(index, messages, temperature, model, call_info))
+    hedge = None
+    hedge_delay = hedging.start_request()
+    if hedge_delay is None:
+        return await primary
+    started_at = time.time()
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+        if done:
+            return primary.result()
+        hedge_index = index
+        if llm_router.get_deployment_count() > 1:
+            hedge_index = llm_router.pick(exclude={index})
+        estimated_tokens = rate_limiter.estimate_tokens(messages)
+        headroom = rate_limiter.has_headroom(estimated_tokens, config.LLM_HEDGE_MIN_HEADROOM, hedge_index)
+        if not hedging.try_start_hedge(headroom):
+            return await primary
+        call_info["hedged"] = True
+        hedge = asyncio.ensure_future(_request(hedge_index, messages, temperature, model, call_info))
+        pending = {primary, hedge}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    hedging.record_outcome(task is hedge, hedge_delay, time.time() - started_at)
+                    return task.result()
+        return primary.result()  # both failed: surface the primary's error
+    finally:
+        # Cancel the loser (or both, if we are cancelled ourselves)
+        for task in (primary, hedge):
+            if task is not None and not task.done():
+                task.cancel()
+
+
+async def _complete(messages, temperature, model, sticky_key, cache_key, started_at, store=True, validate=None):
+    _, _, semaphore = _get_loop_state()
+    tried = set()
+    call_info = {"attempts": 0, "deployment": None, "api_latency": None, "hedged": False}
+    try:
+        async with semaphore:
+            while True:
+                index = llm_router.pick(sticky_key, exclude=tried)
+                try:
+                    response = await _hedged_request(index, messages, temperature, model, call_info)
+                except get_failover_errors() as e:
+                    tried.add(index)
+                    if len(tried) >= llm_router.get_deployment_count():
+                        raise
+                    print(f"LLM deployment {index} failed ({type(e).__name__}); retrying on another deployment")
+                    continue
+                break
+    except Exception as e:
+        call_ledger.record(messages, model, started_at, outcome=f"error:{type(e).__name__}", **call_info)
+        raise
+    call_ledger.record(messages, model, started_at, response=response, **call_info)
+    response_text = response.choices[0].message.content
+    if store and (validate is None or validate(response_text)):
+        response_cache.put(cache_key, response_text, model)
+    return response_text
+
+
+async def async_create_chat_completion(messages, temperature=None, model="gpt-4o", sticky_key=None, coalesce=None,
+                                       cache=None, validate=None):
+    # cache / validate: see utils.openai_client.create_chat_completion
+    started_at = time.time()
+    cache_key = response_cache.make_key(model, temperature, messages)
+    use_cache = response_cache.is_cacheable(temperature, cache)
+    cached_response = get_cached_response(cache_key, use_cache, validate)
+    if cached_response is not None:
+        call_ledger.record(messages, model, started_at, outcome="cache_hit")
+        return cached_response
+    if not singleflight.is_eligible(temperature, coalesce):
+        return await _complete(messages, temperature, model, sticky_key, cache_key, started_at, use_cache, validate)
+    response_text, coalesced = await singleflight.async_do(
+        cache_key, lambda: _complete(messages, temperature, model, sticky_key, cache_key, started_at, use_cache, validate),
+        use_cache)
+    if coalesced:
+        call_ledger.record(messages, model, started_at, outcome="coalesced")
+    return response_text
+
+
+async def async_get_openai_response_text_only(prompt, temp=0.5, cache=None, validate=None):
+    try:
+        return await async_create_chat_completion(build_text_messages(prompt), temperature=temp, cache=cache,
+                                                  validate=validate)
+    except Exception as e:
+        print(f"Error in OpenAI API request: {e}")
+        return None
+
+
+async def async_get_openai_response_base64(prompt, image_path, task=None):
+    try:
+        # Reading and encoding images is blocking file I/O; keep it off the event loop
+        messages = await asyncio.to_thread(build_image_messages, prompt, [image_path], task)
+        return await async_create_chat_completion(messages)
+    except Exception as e:
+        print(f"Error in OpenAI API request: {e}")
+        return None
+
+
+async def async_get_openai_response_base64_with_multiple_images(prompt, image_paths, task=None):
+    try:
+        messages = await asyncio.to_thread(build_image_messages, prompt, image_paths, task)
+        return await async_create_chat_completion(messages, temperature=0.5)
+    except Exception as e:
+        print(f"Error in OpenAI API request: {e}")
+        return None
+
+
+def _get_background_loop():
+    global _background_loop
+    with _background_lock:
+        if _background_loop is None or _background_loop.is_closed():
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name="openai-async-loop", daemon=True).start()
+    return _background_loop
+
+
+def _reset_after_fork():
+    # A forked child (e.g. a slide pool worker) has no loop thread; it starts its own on first use
+    global _background_loop, _background_lock, _loop_state
+    _background_loop = None
+    _background_lock = threading.Lock()
+    _loop_state = weakref.WeakKeyDictionary()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def run_sync(coroutine):
+    """Run a coroutine on the shared background loop and wait for its result."""
+    # The loop thread does not see this thread's call site; carry it over for the ledger
+    coroutine = call_ledger.bind(coroutine)
+    return asyncio.run_coroutine_threadsafe(coroutine, _get_background_loop()).result()
+
+
+async def _gather(coroutines):
+    return await asyncio.gather(*coroutines)
+
+
+def gather_sync(coroutines):
+    """Run many coroutines concurrently (bounded by LLM_MAX_CONCURRENCY); results keep input order."""
+    return run_sync(_gather(list(coroutines)))
+
+
+def get_openai_responses_text_only(prompts, temp=0.5):
+    return gather_sync(async_get_openai_response_text_only(prompt, temp) for prompt in prompts)
+
+
+def get_openai_responses_with_images(requests, task=None):
+    # requests: list of (prompt, image_paths)
+    return gather_sync(
+        async_get_openai_response_base64_with_multiple_images(prompt, image_paths, task)
+        for prompt, image_paths in requests
+    )
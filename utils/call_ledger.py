@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import time
+import contextvars
+from contextlib import contextmanager
+import config
+
+# Append-only ledger of LLM calls (config.LLM_LEDGER_PATH, one JSON object per line).
+# Every request made through utils.openai_client / utils.async_openai_client, and every ROIAgent
+# iteration made through autogen, is recorded with its call site (task, stage, sample_id,
+# cancer_type, iteration), tokens, image count and payload bytes, latency, attempts and outcome.
+# Call sites are set by the pipelines with call_site(...):
+#
+#   with call_ledger.call_site(task="report", stage="generate", sample_id=sample_id):
+#       ...
+#
+# Summary of cost and latency percentiles:
+#
+#   python -m utils.call_ledger [ledger.jsonl] [group column ...]   # default: task cancer_type stage
+
+CALL_SITE_FIELDS = ("task", "stage", "sample_id", "cancer_type", "iteration")
+
+_call_site = contextvars.ContextVar("llm_call_site", default={})
+
+
+@contextmanager
+def call_site(**fields):
+    """Attach call-site fields to LLM calls made inside the block (nested blocks add fields)."""
+    token = _call_site.set(dict(_call_site.get(), **fields))
+    try:
+        yield
+    finally:
+        _call_site.reset(token)
+
+
+def get_call_site():
+    return dict(_call_site.get())
+
+
+async def bind(coroutine, site=None):
+    # Run coroutine under the call site of the caller (event loop threads do not inherit it)
+    token = _call_site.set(get_call_site() if site is None else site)
+    try:
+        return await coroutine
+    finally:
+        _call_site.reset(token)
+
+
+def describe_messages(messages):
+    num_images, image_bytes = 0, 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            continue
+        for part in content or []:
+            if part.get("type") == "image_url":
+                num_images += 1
+                image_bytes += len(part["image_url"]["url"])
+    return num_images, image_bytes
+
+
+def get_autogen_usage(agent):
+    """(prompt tokens, completion tokens) used so far by an autogen agent's client."""
+    summary = getattr(getattr(agent, "client", None), "actual_usage_summary", None) or {}
+    usages = [usage for usage in summary.values() if isinstance(usage, dict)]
+    return (sum(usage.get("prompt_tokens", 0) for usage in usages),
+            sum(usage.get("completion_tokens", 0) for usage in usages))
+
+
+def write(entry):
+    if not config.LLM_LEDGER_ENABLED:
+        return
+    line = (json.dumps(entry, default=str) + "\n").encode("utf-8")
+    try:
+        os.makedirs(os.path.dirname(config.LLM_LEDGER_PATH), exist_ok=True)
+        # A single O_APPEND write keeps lines from concurrent workers intact
+        fd = os.open(config.LLM_LEDGER_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print(f"Warning: Failed to write LLM ledger entry: {e}")
+
+
+def record(messages, model, started_at, outcome="ok", response=None, deployment=None, attempts=0,
+           api_latency=None, **extra):
+    if not config.LLM_LEDGER_ENABLED:
+        return
+    usage = getattr(response, "usage", None)
+    num_images, image_bytes = describe_messages(messages) if messages is not None else (0, 0)
+    entry = {"timestamp": time.time(), "pid": os.getpid()}
+    entry.update({field: None for field in CALL_SITE_FIELDS})
+    entry.update(get_call_site())
+    entry.update({
+        "model": model,
+        "deployment": deployment,
+        "outcome": outcome,
+        "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+        "images": num_images,
+        "image_bytes": image_bytes,
+        "latency": round(time.time() - started_at, 4),
+        "api_latency": None if api_latency is None else round(api_latency, 4),
+        "attempts": attempts,
+        "retries": max(0, attempts - 1),
+    })
+    entry.update(extra)
+    write(entry)
+
+
+def load(path=None):
+    import pandas as pd
+    return pd.read_json(path or config.LLM_LEDGER_PATH, lines=True)
+
+
+def summarize(ledger, group_by=("task", "cancer_type", "stage")):
+    group_by = [column for column in group_by if column in ledger.columns]
+    ledger = ledger.copy()
+    for column in group_by:
+        ledger[column] = ledger[column].fillna("-")
+    ledger["cost"] = (ledger["prompt_tokens"] * config.LLM_PRICE_INPUT_PER_M
+                      + ledger["completion_tokens"] * config.LLM_PRICE_OUTPUT_PER_M) / 1e6
+    ledger["error"] = ledger["outcome"].str.startswith("error")
+    ledger["cache_hit"] = ledger["outcome"] == "cache_hit"
+    grouped = ledger.groupby(group_by) if group_by else ledger.groupby(lambda _: "all")
+    summary = grouped.agg(
+        calls=("outcome", "size"),
+        errors=("error", "sum"),
+        cache_hits=("cache_hit", "sum"),
+        retries=("retries", "sum"),
+        prompt_tokens=("prompt_tokens", "sum"),
+        completion_tokens=("completion_tokens", "sum"),
+        images=("images", "sum"),
+        image_mb=("image_bytes", lambda values: values.sum() / 1e6),
+        cost_usd=("cost", "sum"),
+        latency_p50=("latency", lambda values: values.quantile(0.5)),
+        latency_p90=("latency", lambda values: values.quantile(0.9)),
+        latency_p99=("latency", lambda values: values.quantile(0.99)),
+        latency_total=("latency", "sum"),
+    )
+    return summary.round(3)
+
+
+if __name__ == "__main__":
+    import pandas as pd
+    path = sys.argv[1] if len(sys.argv) > 1 else config.LLM_LEDGER_PATH
+    group_by = sys.argv[2:] or ["task", "cancer_type", "stage"]
+    ledger = load(path)
+    if "sample_id" in ledger.columns:
+        samples = ledger.dropna(subset=["sample_id"]).groupby("sample_id")
+        print(f"{len(ledger)} calls, {samples.ngroups} samples, "
+              f"{ledger['latency'].sum():.0f}s total call time, "
+              f"{samples['latency'].sum().mean() if samples.ngroups else 0:.1f}s per sample")
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 250):
+        print(summarize(ledger, group_by))
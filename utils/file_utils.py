@@ -1,38 +1,26 @@
 import config
 import os
+from utils import slide_catalog
 
 def find_svs_file(sample_id, cancer_type):
-    for folder in config.CANCER_FOLDER_MAP.get(cancer_type, []):
-        folder_path = os.path.join(config.DATA_DIR, folder)
-        for root, _, files in os.walk(folder_path):  # Recursively search all subdirectories
-            for file in files:
-                if file.startswith(sample_id) and file.endswith(".svs"):
-                    return os.path.join(root, file)  # Return the first matching file
+    svs_path = slide_catalog.find_slide(sample_id, config.CANCER_FOLDER_MAP.get(cancer_type, []))
+    if svs_path:
+        return svs_path
     print(f"WARNING: No SVS file found for {sample_id} in {cancer_type}.")
     return None
 
 def get_svs_files_from_folders(cancer_folder_map, cancer_type):
     # cancer_folder_map: config.CANCER_FOLDER_MAP
-    svs_files = []
-    for folder in cancer_folder_map.get(cancer_type, []):
-        folder_path = os.path.join(config.DATA_DIR, folder)
-        for root, _, files in os.walk(folder_path):
-            for file in files:
-                if file.endswith(".svs"):
-                    svs_files.append(os.path.join(root, file))
+    svs_files = slide_catalog.get_slide_paths(cancer_folder_map.get(cancer_type, []))
     if not svs_files:
         raise ValueError(f"No SVS files found for cancer type: {cancer_type}")
     return svs_files
 
 def get_svs_files_from_repo(tcga_repo):
-    svs_files = []
     repo_path = os.path.join(config.DATA_DIR, tcga_repo)
     if not os.path.exists(repo_path):
         raise ValueError(f"TCGA repository {tcga_repo} does not exist: {repo_path}")
-    for root, _, files in os.walk(repo_path):
-        for file in files:
-            if file.endswith(".svs"):
-                svs_files.append(os.path.join(root, file))
+    svs_files = slide_catalog.get_slide_paths([tcga_repo])
     if not svs_files:
         print(f"Warning: No SVS files found in {tcga_repo}")
     return svs_files
@@ -58,7 +46,7 @@ def count_samples_per_cancer_type(cancer_type):
             print(f"Warning: {folder_path} does not exist. Skipping...")
             repo_counts[folder] = 0
             continue
-        sample_count = sum(len([f for f in files if f.endswith(".svs")]) for _, _, files in os.walk(folder_path))
+        sample_count = len(slide_catalog.get_slide_paths([folder]))
         repo_counts[folder] = sample_count
         total_samples += sample_count
     cancer_counts[cancer_type] = {
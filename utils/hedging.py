@@ -0,0 +1,67 @@
+import threading
+from collections import deque
+import config
+
+# Bookkeeping for hedged LLM requests (used by utils.async_openai_client).
+# When a request has not finished after the config.LLM_HEDGE_PERCENTILE latency of recent calls,
+# a duplicate is sent (to another deployment when there is one) and the first answer wins.
+# Hedges are capped at config.LLM_HEDGE_MAX_RATE of all requests and are only sent while the
+# shared rate limiter has headroom, so hedging never eats into the budget of primary requests.
+#
+# saved_seconds is an estimate: for each hedge win, the mean latency of past calls slower than
+# the hedge delay (the expected finish of the straggler) minus the time the hedge took to win.
+
+_lock = threading.Lock()
+_latencies = deque(maxlen=config.LLM_HEDGE_WINDOW)
+_stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "skipped_rate": 0, "skipped_budget": 0, "saved_seconds": 0.0}
+
+
+def record_latency(latency):
+    with _lock:
+        _latencies.append(latency)
+
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percentile / 100 * (len(values) - 1))))]
+
+
+def start_request():
+    """Count a request and return its hedge delay in seconds, or None if it should not be hedged."""
+    with _lock:
+        _stats["requests"] += 1
+        if not config.LLM_HEDGE_ENABLED or len(_latencies) < config.LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return _percentile(_latencies, config.LLM_HEDGE_PERCENTILE)
+
+
+def try_start_hedge(has_headroom):
+    with _lock:
+        if _stats["hedged"] >= config.LLM_HEDGE_MAX_RATE * _stats["requests"]:
+            _stats["skipped_rate"] += 1
+            return False
+        if not has_headroom:
+            _stats["skipped_budget"] += 1
+            return False
+        _stats["hedged"] += 1
+        return True
+
+
+def record_outcome(hedge_won, hedge_delay, elapsed):
+    if not hedge_won:
+        return
+    with _lock:
+        _stats["hedge_wins"] += 1
+        stragglers = [latency for latency in _latencies if latency > hedge_delay]
+        if stragglers:
+            _stats["saved_seconds"] += max(0.0, sum(stragglers) / len(stragglers) - elapsed)
+
+
+def get_hedging_stats():
+    with _lock:
+        stats = dict(_stats)
+        hedge_delay = _percentile(_latencies, config.LLM_HEDGE_PERCENTILE) if _latencies else None
+    stats["hedge_rate"] = stats["hedged"] / stats["requests"] if stats["requests"] else 0.0
+    stats["hedge_win_rate"] = stats["hedge_wins"] / stats["hedged"] if stats["hedged"] else 0.0
+    stats["hedge_delay"] = hedge_delay
+    return stats
@@ -0,0 +1,192 @@
+import io
+import os
+import base64
+import hashlib
+from collections import OrderedDict
+from PIL import Image
+import config
+
+# Encoded image payloads (data URLs) for multimodal requests.
+# Files are identified by (real path, mtime, size), so a hot image such as a few-shot example
+# or an overview is read and encoded once per process. Payloads are stored by content hash
+# and payload policy, so identical images under different paths share one entry. With
+# config.IMAGE_PAYLOAD_DISK_CACHE enabled, encoded payloads are also kept under
+# config.IMAGE_PAYLOAD_CACHE_DIR for other workers and later runs. In-memory PIL images (e.g. the
+# ROIAgent's per-iteration renders) are encoded directly, without a PNG file round trip.
+#
+# Payload policies (config.IMAGE_PAYLOAD_POLICIES, chosen per task) re-encode images as
+# JPEG/WebP and downscale them to the model's effective resolution before upload:
+#   format          "original" (send file bytes unchanged), "png", "jpeg" or "webp"
+#   quality         JPEG/WebP quality
+#   max_side        longest side limit in pixels
+#   max_short_side  shortest side limit in pixels
+
+MIME_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp"}
+FORMAT_MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+_content_hashes = {}  # (real path, mtime_ns, size) -> content hash
+_payloads = OrderedDict()  # (content hash, policy) -> (data URL, original size in bytes)
+_payload_bytes = 0
+_stats = {"hits": 0, "disk_hits": 0, "encoded": 0, "original_bytes": 0, "sent_bytes": 0}
+
+
+def get_payload_policy(task=None):
+    policies = config.IMAGE_PAYLOAD_POLICIES
+    policy = dict(policies.get("default", {"format": "original"}))
+    policy.update(policies.get(task, {}))
+    return policy
+
+
+def _policy_signature(policy):
+    return tuple(sorted(policy.items()))
+
+
+def _remember(cache_key, entry):
+    global _payload_bytes
+    if cache_key in _payloads:
+        _payloads.move_to_end(cache_key)
+        return
+    _payloads[cache_key] = entry
+    _payload_bytes += len(entry[0])
+    while _payload_bytes > config.IMAGE_PAYLOAD_CACHE_BYTES and len(_payloads) > 1:
+        _, evicted = _payloads.popitem(last=False)
+        _payload_bytes -= len(evicted[0])
+
+
+def _disk_path(file_key, signature):
+    digest = hashlib.sha1(repr((file_key, signature)).encode("utf-8")).hexdigest()
+    return os.path.join(config.IMAGE_PAYLOAD_CACHE_DIR, f"{digest}.txt")
+
+
+def encode_image_bytes(image_bytes, mime_type="image/png"):
+    return f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+
+
+def get_target_size(size, policy):
+    width, height = size
+    scale = 1.0
+    if policy.get("max_side"):
+        scale = min(scale, policy["max_side"] / max(width, height))
+    if policy.get("max_short_side"):
+        scale = min(scale, policy["max_short_side"] / min(width, height))
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def optimize_image(image, policy):
+    # Returns (encoded bytes, mime type) for a PIL image under the given policy
+    image_format = policy.get("format", "png")
+    if image_format == "original":
+        image_format = "png"
+    target_size = get_target_size(image.size, policy)
+    if target_size != image.size:
+        image = image.resize(target_size, Image.LANCZOS)
+    if image_format == "jpeg" and image.mode != "RGB":
+        # JPEG has no alpha channel: composite transparent areas on white
+        background = Image.new("RGB", image.size, "white")
+        if image.mode in ("RGBA", "LA"):
+            background.paste(image, mask=image.split()[-1])
+        else:
+            background.paste(image.convert("RGB"))
+        image = background
+    buffer = io.BytesIO()
+    save_kwargs = {}
+    if image_format in ("jpeg", "webp"):
+        save_kwargs["quality"] = policy.get("quality", 90)
+    image.save(buffer, format=image_format.upper(), **save_kwargs)
+    return buffer.getvalue(), FORMAT_MIME_TYPES[image_format]
+
+
+def encode_image(image_bytes, policy, default_mime_type="image/png"):
+    if policy.get("format", "original") == "original":
+        return encode_image_bytes(image_bytes, default_mime_type)
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.load()
+        optimized_bytes, mime_type = optimize_image(image, policy)
+    if len(optimized_bytes) >= len(image_bytes) and image.size == get_target_size(image.size, policy):
+        return encode_image_bytes(image_bytes, default_mime_type)  # re-encoding would not help
+    return encode_image_bytes(optimized_bytes, mime_type)
+
+
+def _record_usage(original_bytes, data_url):
+    # Both sizes are base64 payload lengths, i.e. what the request body would carry
+    original_payload = 4 * ((original_bytes + 2) // 3)
+    sent_payload = len(data_url) - data_url.index(",") - 1
+    _stats["original_bytes"] += original_payload
+    _stats["sent_bytes"] += sent_payload
+    return original_payload, sent_payload
+
+
+def get_pil_image_payload(image, task=None):
+    """Return (data URL, original payload size, sent payload size) for a PIL image."""
+    policy = get_payload_policy(task)
+    if policy.get("format", "original") == "original":
+        policy = dict(policy, format="png")
+    image_bytes, mime_type = optimize_image(image, policy)
+    data_url = encode_image_bytes(image_bytes, mime_type)
+    _stats["encoded"] += 1
+    # There is no file to compare with: the original size is the size sent
+    return (data_url, *_record_usage(len(image_bytes), data_url))
+
+
+def get_image_payload(image_path, task=None):
+    """
+    Return (data URL, original payload size, sent payload size) for image_path under the
+    task's payload policy. image_path may also be a PIL image.
+    """
+    if isinstance(image_path, Image.Image):
+        return get_pil_image_payload(image_path, task)
+    policy = get_payload_policy(task)
+    signature = _policy_signature(policy)
+    stat = os.stat(image_path)
+    file_key = (os.path.realpath(image_path), stat.st_mtime_ns, stat.st_size)
+    content_hash = _content_hashes.get(file_key)
+    if (content_hash, signature) in _payloads:
+        _payloads.move_to_end((content_hash, signature))
+        _stats["hits"] += 1
+        data_url, original_bytes = _payloads[(content_hash, signature)]
+        return (data_url, *_record_usage(original_bytes, data_url))
+
+    disk_path = _disk_path(file_key, signature) if config.IMAGE_PAYLOAD_DISK_CACHE else None
+    if disk_path and os.path.exists(disk_path):
+        try:
+            with open(disk_path, "r", encoding="utf-8") as f:
+                content_hash, data_url = f.read().split("\n", 1)
+            _content_hashes[file_key] = content_hash
+            _remember((content_hash, signature), (data_url, stat.st_size))
+            _stats["disk_hits"] += 1
+            return (data_url, *_record_usage(stat.st_size, data_url))
+        except (OSError, ValueError) as e:
+            print(f"Warning: Failed to read cached payload {disk_path}: {e}")
+
+    with open(image_path, "rb") as image_file:
+        image_bytes = image_file.read()
+    content_hash = hashlib.sha256(image_bytes).hexdigest()
+    _content_hashes[file_key] = content_hash
+    if (content_hash, signature) in _payloads:  # same content already encoded from another path
+        _payloads.move_to_end((content_hash, signature))
+        _stats["hits"] += 1
+        data_url, original_bytes = _payloads[(content_hash, signature)]
+        return (data_url, *_record_usage(original_bytes, data_url))
+
+    default_mime_type = MIME_TYPES.get(os.path.splitext(image_path)[1].lower(), "image/png")
+    data_url = encode_image(image_bytes, policy, default_mime_type)
+    _stats["encoded"] += 1
+    _remember((content_hash, signature), (data_url, len(image_bytes)))
+    if disk_path:
+        try:
+            os.makedirs(config.IMAGE_PAYLOAD_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{disk_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(f"{content_hash}\n{data_url}")
+            os.replace(tmp_path, disk_path)
+        except OSError as e:
+            print(f"Warning: Failed to cache payload {disk_path}: {e}")
+    return (data_url, *_record_usage(len(image_bytes), data_url))
+
+
+def get_image_data_url(image_path, task=None):
+    return get_image_payload(image_path, task)[0]
+
+
+def get_payload_cache_stats():
+    return dict(_stats, cached_payloads=len(_payloads), cached_bytes=_payload_bytes)
@@ -0,0 +1,93 @@
+import os
+import re
+import sys
+import argparse
+import subprocess
+import config
+
+# Import-time benchmark for the modules pool workers and quick-start scripts load.
+# Each module is imported in a fresh interpreter with `python -X importtime`, so the numbers are
+# cold-start costs. Modules slower than the budget (config.IMPORT_TIME_BUDGET_SECONDS) make the
+# command exit with status 1, and the slowest dependencies are listed to show where time goes.
+#
+#   python -m utils.import_benchmark                      # default modules below
+#   python -m utils.import_benchmark src.report.report --top 20 --budget 0.3
+
+DEFAULT_MODULES = [
+    "utils.openai_client",
+    "utils.async_openai_client",
+    "src.subtyping.slide_utils",
+    "src.subtyping.roi_agent",
+    "src.subtyping.subtyping_baseline",
+    "src.report.report",
+    "src.survival.survival_prediction",
+    "src.inference.extract_roi_embedding",
+]
+
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _importtime(statement):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=PROJECT_ROOT, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            yield match.group(4), len(match.group(3)), int(match.group(2)) / 1e6
+
+
+def measure(module, repeat=3):
+    """Best-of-`repeat` cold import of module; returns (seconds, {module: cumulative seconds}) or raises."""
+    # Modules loaded by interpreter startup (site, encodings, ...) are not part of the import
+    startup = {name for name, _, _ in _importtime("pass")}
+    best = None
+    for _ in range(repeat):
+        total, top_level = 0.0, {}
+        for name, indent, cumulative in _importtime(f"import {module}"):
+            if name in startup:
+                continue
+            if indent == 1:
+                # Modules imported directly by the `import` statement
+                total += cumulative
+            top_level[name] = cumulative
+        if best is None or total < best[0]:
+            best = (total, top_level)
+    return best
+
+
+def main(modules, budget, top, repeat):
+    over_budget = []
+    for module in modules:
+        try:
+            seconds, imports = measure(module, repeat)
+        except RuntimeError as e:
+            print(f"{module:45s}  import failed: {e}")
+            continue
+        flag = "  OVER BUDGET" if seconds > budget else ""
+        print(f"{module:45s} {seconds * 1000:8.1f} ms{flag}")
+        if top:
+            # Heaviest third-party packages (cumulative time of their top-level module)
+            packages = {name: t for name, t in imports.items() if "." not in name and name != module}
+            for name, t in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+                print(f"    {name:41s} {t * 1000:8.1f} ms")
+        if seconds > budget:
+            over_budget.append(module)
+    if over_budget:
+        print(f"{len(over_budget)} module(s) over the {budget:.2f}s import budget: {', '.join(over_budget)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure cold import time of project modules")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--budget", type=float, default=config.IMPORT_TIME_BUDGET_SECONDS)
+    parser.add_argument("--top", type=int, default=5, help="slowest packages to list per module")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    sys.exit(main(args.modules, args.budget, args.top, args.repeat))
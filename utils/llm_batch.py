@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import uuid
+import random
+import threading
+from contextlib import contextmanager
+import numpy as np
+import config
+from utils import response_cache
+
+# Offline batch mode for bulk LLM stages (reports, checklist / GPT evaluation, survival risk levels).
+#
+# run_in_batch(stage_fn, ...) runs a stage twice:
+#   1. collect: every chat completion that misses the response cache is queued instead of sent
+#      (create_chat_completion returns None, and stages skip writing outputs for it)
+#   2. the queued requests are written as OpenAI Batch JSONL (custom_id = response cache key),
+#      submitted through a backend, polled, and the results are stored in the response cache
+#   3. replay: the stage runs again; its requests are now cache hits, so it writes its normal
+#      output files. Requests that failed in the batch are sent synchronously.
+# Random state is restored between passes so stages that sample inputs pick the same ones.
+#
+# Backends (config.LLM_BATCH_BACKEND):
+#   "openai" - the Batch API of the first deployment in azure_config_list
+#   "local"  - file-based stand-in that works through the batch with the regular client
+
+BATCH_ENDPOINT = "/chat/completions"
+
+_pending = None  # custom_id -> request body while collecting
+_pending_lock = threading.Lock()
+
+
+@contextmanager
+def collecting():
+    global _pending
+    _pending = {}
+    try:
+        yield _pending
+    finally:
+        _pending = None
+
+
+def is_collecting():
+    return _pending is not None
+
+
+def add_request(custom_id, model, temperature, messages):
+    body = {"model": config.LLM_BATCH_MODEL or model, "messages": messages}
+    if temperature is not None:
+        body["temperature"] = temperature
+    with _pending_lock:
+        _pending[custom_id] = body
+
+
+def write_batch_files(requests, batch_dir):
+    """Write requests as Batch JSONL, split to stay under the per-file request and size limits."""
+    os.makedirs(batch_dir, exist_ok=True)
+    paths, f, count, size = [], None, 0, 0
+    for custom_id, body in requests.items():
+        line = json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}) + "\n"
+        line_size = len(line.encode("utf-8"))
+        if f is None or count >= config.LLM_BATCH_MAX_REQUESTS or size + line_size > config.LLM_BATCH_MAX_BYTES:
+            if f is not None:
+                f.close()
+            paths.append(os.path.join(batch_dir, f"input_{len(paths)}.jsonl"))
+            f, count, size = open(paths[-1], "w", encoding="utf-8"), 0, 0
+        f.write(line)
+        count += 1
+        size += line_size
+    if f is not None:
+        f.close()
+    return paths
+
+
+class LocalBatchBackend:
+    """Stand-in for the Batch API: processes the JSONL on a background thread into local files."""
+
+    def __init__(self, root_dir=None):
+        self.root_dir = root_dir or os.path.join(config.LLM_BATCH_DIR, "local_backend")
+
+    def _batch_dir(self, batch_id):
+        return os.path.join(self.root_dir, batch_id)
+
+    def _write_status(self, batch_id, status):
+        path = os.path.join(self._batch_dir(batch_id), "status.json")
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(status, f)
+        os.replace(f"{path}.tmp", path)
+
+    def submit(self, input_path):
+        batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+        os.makedirs(self._batch_dir(batch_id), exist_ok=True)
+        self._write_status(batch_id, {"status": "in_progress"})
+        threading.Thread(target=self._process, args=(batch_id, input_path), daemon=True).start()
+        return batch_id
+
+    def _process(self, batch_id, input_path):
+        from utils import async_openai_client
+        with open(input_path, "r", encoding="utf-8") as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+
+        async def run_one(request):
+            body = request["body"]
+            try:
+                content = await async_openai_client.async_create_chat_completion(
+                    body["messages"], body.get("temperature"), body["model"])
+            except Exception as e:
+                return {"custom_id": request["custom_id"], "response": None,
+                        "error": {"code": type(e).__name__, "message": str(e)}}
+            return {
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "body": {
+                    "object": "chat.completion", "model": body["model"],
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": content}}],
+                }},
+                "error": None,
+            }
+
+        try:
+            results = async_openai_client.gather_sync(run_one(request) for request in requests)
+            output_path = os.path.join(self._batch_dir(batch_id), "output.jsonl")
+            with open(output_path, "w", encoding="utf-8") as f:
+                for result in results:
+                    f.write(json.dumps(result) + "\n")
+            self._write_status(batch_id, {"status": "completed", "output_path": output_path})
+        except Exception as e:
+            self._write_status(batch_id, {"status": "failed", "error": str(e)})
+
+    def get_status(self, batch_id):
+        with open(os.path.join(self._batch_dir(batch_id), "status.json"), "r", encoding="utf-8") as f:
+            return json.load(f)["status"]
+
+    def download(self, batch_id, output_path):
+        with open(os.path.join(self._batch_dir(batch_id), "status.json"), "r", encoding="utf-8") as f:
+            source_path = json.load(f)["output_path"]
+        with open(source_path, "rb") as src, open(output_path, "wb") as dst:
+            dst.write(src.read())
+        return output_path
+
+
+class OpenAIBatchBackend:
+    """OpenAI / Azure OpenAI Batch API (Azure needs a global-batch deployment, see LLM_BATCH_MODEL)."""
+
+    def __init__(self, deployment_index=0):
+        from utils import llm_router
+        self.client = llm_router.get_client(deployment_index)
+
+    def submit(self, input_path):
+        with open(input_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window="24h")
+        return batch.id
+
+    def get_status(self, batch_id):
+        return self.client.batches.retrieve(batch_id).status
+
+    def download(self, batch_id, output_path):
+        batch = self.client.batches.retrieve(batch_id)
+        with open(output_path, "w", encoding="utf-8") as f:
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    f.write(self.client.files.content(file_id).text)
+        return output_path
+
+
+BATCH_BACKENDS = {"local": LocalBatchBackend, "openai": OpenAIBatchBackend}
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def get_backend(name=None):
+    name = name or config.LLM_BATCH_BACKEND
+    if name not in BATCH_BACKENDS:
+        raise ValueError(f"Unknown batch backend: {name}")
+    return BATCH_BACKENDS[name]()
+
+
+def ingest(output_path):
+    """Store batch results in the response cache; returns (succeeded, failed)."""
+    succeeded, failed = 0, 0
+    with open(output_path, "r", encoding="utf-8") as f, response_cache.cache_mode("readwrite"):
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get("response") or {}
+            if response.get("status_code") != 200:
+                failed += 1
+                continue
+            body = response["body"]
+            response_cache.put(result["custom_id"], body["choices"][0]["message"]["content"], body.get("model"))
+            succeeded += 1
+    return succeeded, failed
+
+
+def submit_and_wait(input_paths, batch_dir, backend=None, poll_interval=None):
+    backend = backend or get_backend()
+    poll_interval = config.LLM_BATCH_POLL_INTERVAL if poll_interval is None else poll_interval
+    batch_ids = [backend.submit(path) for path in input_paths]
+    with open(os.path.join(batch_dir, "batches.json"), "w", encoding="utf-8") as f:
+        json.dump(batch_ids, f)
+    print(f"Submitted {len(batch_ids)} batch(es): {', '.join(batch_ids)}")
+    remaining = list(batch_ids)
+    succeeded, failed = 0, 0
+    while remaining:
+        for batch_id in list(remaining):
+            status = backend.get_status(batch_id)
+            if status not in FINAL_STATUSES:
+                continue
+            remaining.remove(batch_id)
+            if status != "completed":
+                print(f"Warning: Batch {batch_id} ended with status {status}")
+                continue
+            output_path = backend.download(batch_id, os.path.join(batch_dir, f"{batch_id}_output.jsonl"))
+            batch_succeeded, batch_failed = ingest(output_path)
+            succeeded += batch_succeeded
+            failed += batch_failed
+        if remaining:
+            time.sleep(poll_interval)
+    return succeeded, failed
+
+
+def run_in_batch(stage_fn, *args, name="stage", backend=None, poll_interval=None, **kwargs):
+    """Run stage_fn(*args, **kwargs) with its LLM requests sent as an offline batch (see above)."""
+    random_state, np_random_state = random.getstate(), np.random.get_state()
+    # The replay reads every answer from the response cache, whatever the request's temperature
+    with response_cache.cache_all_temperatures():
+        with collecting() as requests:
+            stage_fn(*args, **kwargs)
+        if requests:
+            batch_dir = os.path.join(config.LLM_BATCH_DIR, f"{name}_{time.strftime('%Y%m%d_%H%M%S')}")
+            input_paths = write_batch_files(requests, batch_dir)
+            print(f"[{name}] {len(requests)} requests queued for batch processing in {batch_dir}")
+            succeeded, failed = submit_and_wait(input_paths, batch_dir, backend, poll_interval)
+            print(f"[{name}] Batch results: {succeeded} succeeded, {failed} failed")
+        random.setstate(random_state)
+        np.random.set_state(np_random_state)
+        return stage_fn(*args, **kwargs)
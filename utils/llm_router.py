@@ -0,0 +1,163 @@
+import time
+import random
+import threading
+from collections import OrderedDict
+import config
+
+# Routes LLM requests across the deployments in utils.openai_client.azure_config_list.
+# Each entry may carry an optional "weight" (default 1). A deployment is picked at random with
+# probability proportional to weight / latency (EWMA of recent calls), deployments with
+# config.LLM_CIRCUIT_FAILURES consecutive failures are skipped for config.LLM_CIRCUIT_COOLDOWN
+# seconds, and a sticky key (e.g. a sample ID) keeps one agent conversation on one deployment.
+# Entries with "api_type": "openai" (or no api_type) are OpenAI-compatible endpoints, e.g. a local stub.
+
+ROUTING_KEYS = ("weight",)  # router-only keys, stripped before handing entries to autogen
+LATENCY_SMOOTHING = 0.2
+MAX_STICKY_KEYS = 4096
+
+_deployments = []
+_health = []
+_clients = {}
+_sticky = OrderedDict()  # sticky key -> deployment index
+_lock = threading.Lock()
+
+
+def set_deployments(config_list):
+    global _deployments, _health
+    with _lock:
+        _deployments = list(config_list)
+        _health = [
+            {"requests": 0, "errors": 0, "consecutive_failures": 0, "latency": None, "open_until": 0.0}
+            for _ in _deployments
+        ]
+        _clients.clear()
+        _sticky.clear()
+
+
+def get_deployment(index):
+    return _deployments[index]
+
+
+def get_deployment_count():
+    return len(_deployments)
+
+
+def _is_available(index, now):
+    return _health[index]["open_until"] <= now
+
+
+def _score(index):
+    health = _health[index]
+    known = [h["latency"] for h in _health if h["latency"] is not None]
+    latency = health["latency"] or (sum(known) / len(known) if known else 1.0)
+    return _deployments[index].get("weight", 1) / max(latency, 1e-3)
+
+
+def pick(sticky_key=None, exclude=()):
+    """Return the index of the deployment to use for the next request."""
+    with _lock:
+        if not _deployments:
+            raise RuntimeError("No LLM deployments configured")
+        now = time.time()
+        if sticky_key is not None and sticky_key in _sticky:
+            index = _sticky[sticky_key]
+            if index not in exclude and _is_available(index, now):
+                _sticky.move_to_end(sticky_key)
+                return index
+        candidates = [i for i in range(len(_deployments)) if i not in exclude and _is_available(i, now)]
+        if not candidates:
+            # Every circuit is open: try the one that recovers first
+            remaining = [i for i in range(len(_deployments)) if i not in exclude] or list(range(len(_deployments)))
+            candidates = [min(remaining, key=lambda i: _health[i]["open_until"])]
+        index = random.choices(candidates, weights=[_score(i) for i in candidates])[0]
+        if sticky_key is not None:
+            _sticky[sticky_key] = index
+            _sticky.move_to_end(sticky_key)
+            while len(_sticky) > MAX_STICKY_KEYS:
+                _sticky.popitem(last=False)
+        return index
+
+
+def record(index, latency=None, error=False):
+    with _lock:
+        health = _health[index]
+        health["requests"] += 1
+        if error:
+            health["errors"] += 1
+            health["consecutive_failures"] += 1
+            if health["consecutive_failures"] >= config.LLM_CIRCUIT_FAILURES:
+                # Open (or re-open after a failed half-open trial) the circuit
+                health["open_until"] = time.time() + config.LLM_CIRCUIT_COOLDOWN
+                print(f"Warning: LLM deployment {index} ({_deployments[index].get('base_url')}) "
+                      f"unhealthy; pausing for {config.LLM_CIRCUIT_COOLDOWN}s")
+            return
+        health["consecutive_failures"] = 0
+        health["open_until"] = 0.0
+        if latency is not None:
+            if health["latency"] is None:
+                health["latency"] = latency
+            else:
+                health["latency"] += LATENCY_SMOOTHING * (latency - health["latency"])
+
+
+def get_max_retries(index):
+    """Retries of connection errors, timeouts and 5xx on this deployment (its "max_retries" entry)."""
+    return _deployments[index].get("max_retries", config.LLM_TRANSIENT_MAX_RETRIES)
+
+
+def create_client(index, use_async=False, http_client=None):
+    from openai import AzureOpenAI, AsyncAzureOpenAI, OpenAI, AsyncOpenAI
+    entry = _deployments[index]
+    # The SDK does not retry: utils.rate_limiter retries 429s against the shared budget, and the
+    # entry's "max_retries" (get_max_retries) for connection errors, timeouts and 5xx
+    client_kwargs = {"max_retries": 0}
+    if http_client is not None:
+        client_kwargs["http_client"] = http_client
+    if entry.get("api_type", "openai") == "azure":
+        if entry.get("azure_ad_token_provider") is not None:
+            client_kwargs["azure_ad_token_provider"] = entry["azure_ad_token_provider"]
+        else:
+            client_kwargs["api_key"] = entry.get("api_key")
+        client_class = AsyncAzureOpenAI if use_async else AzureOpenAI
+        return client_class(api_version=entry.get("api_version"), azure_endpoint=entry["base_url"], **client_kwargs)
+    client_class = AsyncOpenAI if use_async else OpenAI
+    return client_class(base_url=entry.get("base_url"), api_key=entry.get("api_key", "EMPTY"), **client_kwargs)
+
+
+def get_client(index):
+    # Sync clients are shared by all threads; async clients are owned by utils.async_openai_client
+    with _lock:
+        if index not in _clients:
+            _clients[index] = create_client(index)
+        return _clients[index]
+
+
+def get_config_list(sticky_key=None):
+    """
+    autogen config_list with the routed deployment first and the other healthy deployments as
+    fallbacks (autogen tries entries in order when a request fails).
+    """
+    first = pick(sticky_key)
+    now = time.time()
+    order = [first] + [i for i in range(len(_deployments)) if i != first and _is_available(i, now)]
+    # As in create_client, the SDK does not retry: ROIAgent sends autogen's requests through
+    # utils.rate_limiter (InstructorAgent.route_clients), which applies the entry's "max_retries"
+    return [dict({k: v for k, v in _deployments[i].items() if k not in ROUTING_KEYS}, max_retries=0) for i in order]
+
+
+def find_deployment(entry):
+    """Index of the deployment a config_list entry was built from (by base_url and model), or None."""
+    for index, deployment in enumerate(_deployments):
+        if deployment.get("base_url") == entry.get("base_url") and deployment.get("model") == entry.get("model"):
+            return index
+    return None
+
+
+def get_router_stats():
+    with _lock:
+        now = time.time()
+        return [
+            dict(health, base_url=entry.get("base_url"), model=entry.get("model"),
+                 weight=entry.get("weight", 1), circuit_open=health["open_until"] > now)
+            for entry, health in zip(_deployments, _health)
+        ]
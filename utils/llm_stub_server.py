@@ -0,0 +1,225 @@
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# Local OpenAI-compatible chat completions server for offline runs and load tests.
+# Accepts OpenAI (/v1/chat/completions) and Azure (/openai/deployments/<name>/chat/completions)
+# paths, text and image inputs, and answers with responses the project's parsers accept:
+# ROI coordinates (<<x=..., y=..., level=...>>), oncotree codes, VQA answers, risk digits,
+# checklist JSON arrays, evaluation scores and report text.
+#
+#   python -m utils.llm_stub_server --profile azure --port 8000
+#
+# and set config.LLM_BACKEND = "stub" (config.LLM_STUB_URL) to point the clients at it.
+# GET /stats returns request counts by status and the peak number of concurrent requests.
+
+# latency: lognormal around median_seconds (sigma), plus per_image_seconds per input image
+# error_rates: probability of answering 429 / 500; 429s carry Retry-After: retry_after_seconds
+PROFILES = {
+    "fast": {
+        "latency": {"median_seconds": 0.05, "sigma": 0.2, "per_image_seconds": 0.0},
+        "error_rates": {"429": 0.0, "500": 0.0},
+        "retry_after_seconds": 1,
+    },
+    "azure": {
+        "latency": {"median_seconds": 3.0, "sigma": 0.7, "per_image_seconds": 0.5},
+        "error_rates": {"429": 0.02, "500": 0.005},
+        "retry_after_seconds": 5,
+    },
+    "flaky": {
+        "latency": {"median_seconds": 1.0, "sigma": 1.2, "per_image_seconds": 0.2},
+        "error_rates": {"429": 0.15, "500": 0.05},
+        "retry_after_seconds": 2,
+    },
+}
+
+REPORT_TEXT = (
+    "SURGICAL PATHOLOGY REPORT\n"
+    "FINAL DIAGNOSIS: Invasive carcinoma, moderately differentiated. Margins are free of tumor.\n"
+    "MICROSCOPIC DESCRIPTION: Sections show infiltrating tumor cells arranged in nests and cords "
+    "with moderate nuclear pleomorphism. Lymphovascular invasion is not identified."
+)
+
+
+def _prompt_text(messages):
+    texts, num_images = [], 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                texts.append(part["text"])
+            elif part.get("type") == "image_url":
+                num_images += 1
+    return "\n".join(texts), num_images
+
+
+def scripted_response(prompt, rng, rules=()):
+    """Answer in the format the prompt asks for (custom rules are tried first)."""
+    for rule in rules:
+        if re.search(rule["match"], prompt):
+            return rule["response"]
+    if "JSON array of 0s and 1s" in prompt:
+        num_questions = len(re.findall(r"^Q\d+:", prompt, re.MULTILINE))
+        return json.dumps([rng.choice([0, 1]) for _ in range(num_questions)])
+    if "score from 0 to 10" in prompt:
+        return str(rng.randint(0, 10))
+    if "risk level (0, 1, or 2)" in prompt:
+        return str(rng.randint(0, 2))
+    if "Answers:" in prompt:
+        choices = re.findall(r"^Choices: (.*)$", prompt, re.MULTILINE)
+        return ", ".join(rng.choice(line.split(", ")).strip() for line in choices)
+    if "classification word" in prompt:
+        labels = re.findall(r"'([A-Z]{2,8})'", prompt.split("classification word", 1)[1])
+        return rng.choice(labels) if labels else "UNKNOWN"
+    if "`x=..., y=...`" in prompt:
+        # Candidates come before the instructions (which contain example coordinates)
+        candidates = re.findall(r"\(x=([\d.]+), y=([\d.]+)\)", prompt.split("`x=..., y=...`", 1)[0])
+        x, y = rng.choice(candidates) if candidates else (f"{rng.uniform(0.1, 0.9):.2f}", f"{rng.uniform(0.1, 0.9):.2f}")
+        return f"x={x}, y={y}"
+    if "<<x" in prompt or "ROI iteration" in prompt:
+        candidates = re.findall(r"\(x=([\d.]+), y=([\d.]+), level=(\d+)\)", prompt)
+        if candidates:
+            x, y, level = rng.choice(candidates)
+        else:
+            x, y, level = f"{rng.uniform(0.1, 0.9):.2f}", f"{rng.uniform(0.1, 0.9):.2f}", rng.randint(0, 2)
+        return f"The region shows dense tumor cells. <<x={x}, y={y}, level={level}>>"
+    if "pathology report" in prompt:
+        return REPORT_TEXT
+    return "OK"
+
+
+class StubState:
+    def __init__(self, profile, seed=None, rules=()):
+        self.profile = profile
+        self.rules = list(rules)
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "200": 0, "429": 0, "500": 0, "in_flight": 0, "peak_in_flight": 0}
+
+    def draw(self, prompt, num_images):
+        # One lock-protected draw so runs with a fixed seed are reproducible
+        with self.lock:
+            latency = self.profile["latency"]
+            delay = self.rng.lognormvariate(0, latency["sigma"]) * latency["median_seconds"]
+            delay += num_images * latency.get("per_image_seconds", 0.0)
+            roll = self.rng.random()
+            error_rates = self.profile["error_rates"]
+            if roll < error_rates.get("429", 0.0):
+                status = 429
+            elif roll < error_rates.get("429", 0.0) + error_rates.get("500", 0.0):
+                status = 500
+            else:
+                status = 200
+            content = scripted_response(prompt, self.rng, self.rules) if status == 200 else None
+        return delay, status, content
+
+    def enter(self):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["in_flight"] += 1
+            self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.stats["in_flight"])
+
+    def leave(self, status):
+        with self.lock:
+            self.stats["in_flight"] -= 1
+            self.stats[str(status)] += 1
+
+
+def make_handler(state):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlparse(self.path).path == "/stats":
+                with state.lock:
+                    self._send_json(200, dict(state.stats))
+            else:
+                self._send_json(200, {"status": "ok"})
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not urlparse(self.path).path.endswith("/chat/completions"):
+                self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                return
+            state.enter()
+            prompt, num_images = _prompt_text(request.get("messages", []))
+            delay, status, content = state.draw(prompt, num_images)
+            time.sleep(delay)
+            try:
+                if status == 429:
+                    retry_after = str(state.profile.get("retry_after_seconds", 1))
+                    self._send_json(429, {"error": {"code": "429", "message": "Rate limit exceeded (stub)"}},
+                                    {"Retry-After": retry_after})
+                elif status == 500:
+                    self._send_json(500, {"error": {"code": "500", "message": "Internal server error (stub)"}})
+                else:
+                    prompt_tokens = len(prompt) // 4 + 765 * num_images
+                    completion_tokens = len(content) // 4 + 1
+                    self._send_json(200, {
+                        "id": f"chatcmpl-stub-{state.stats['requests']}",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": request.get("model", "gpt-4o"),
+                        "choices": [{"index": 0, "finish_reason": "stop",
+                                     "message": {"role": "assistant", "content": content}}],
+                        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                  "total_tokens": prompt_tokens + completion_tokens},
+                    })
+            finally:
+                state.leave(status)
+
+    return StubHandler
+
+
+def serve(host="127.0.0.1", port=8000, profile="fast", seed=None, rules=()):
+    if isinstance(profile, str):
+        profile = PROFILES[profile]
+    server = ThreadingHTTPServer((host, port), make_handler(StubState(profile, seed, rules)))
+    server.daemon_threads = True
+    print(f"LLM stub server listening on http://{host}:{port}/v1")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stub server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--profile", default="fast",
+                        help=f"one of {', '.join(PROFILES)} or a JSON file with the same keys")
+    parser.add_argument("--rules", default=None,
+                        help='JSON file with scripted responses: [{"match": regex, "response": text}, ...]')
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    profile = args.profile
+    if profile not in PROFILES:
+        with open(profile, "r", encoding="utf-8") as f:
+            profile = json.load(f)
+    rules = []
+    if args.rules:
+        with open(args.rules, "r", encoding="utf-8") as f:
+            rules = json.load(f)
+    serve(args.host, args.port, profile, args.seed, rules)
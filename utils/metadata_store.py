@@ -0,0 +1,136 @@
+import os
+import glob
+import hashlib
+import numpy as np
+import config
+
+# Process-wide view of the pan-cancer clinical CSV (config.META_DATA_DIR).
+# The columns we use are cached next to the outputs as Feather (memory-mapped on read), one file
+# per CSV (path, size and mtime in the file name), so pointing META_DATA_DIR at another CSV or
+# changing it rebuilds the cache; lookups go through a dict keyed by Patient ID.
+# pandas is imported on first use: slide_utils (and every pool worker) imports this module.
+
+METADATA_COLUMNS = [
+    "Patient ID",
+    "Oncotree Code",
+    "TCGA PanCanAtlas Cancer Type Acronym",
+    "Overall Survival (Months)",
+    "Overall Survival Status",
+]
+
+_table = None
+_index = None
+
+
+def get_cache_path(csv_path):
+    stat = os.stat(csv_path)
+    raw_key = f"{os.path.realpath(csv_path)}|{stat.st_mtime_ns}|{stat.st_size}"
+    root, extension = os.path.splitext(config.METADATA_CACHE_PATH)
+    return f"{root}.{hashlib.sha1(raw_key.encode('utf-8')).hexdigest()[:16]}{extension}"
+
+
+def _remove_stale_caches(cache_path):
+    root, extension = os.path.splitext(config.METADATA_CACHE_PATH)
+    for path in glob.glob(f"{root}.*{extension}"):
+        if path != cache_path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _read_csv(csv_path):
+    import pandas as pd
+    df = pd.read_csv(csv_path, usecols=lambda column: column in METADATA_COLUMNS)
+    # Keep the first row per patient, as the per-call lookups did with iloc[0]
+    df = df.drop_duplicates(subset="Patient ID", keep="first").reset_index(drop=True)
+    return df
+
+
+def load_metadata_table(reload=False):
+    global _table, _index
+    if _table is not None and not reload:
+        return _table
+    csv_path = config.META_DATA_DIR
+    cache_path = get_cache_path(csv_path)
+    df = None
+    try:
+        if os.path.exists(cache_path):
+            from pyarrow import feather
+            df = feather.read_feather(cache_path, memory_map=True)
+    except (ImportError, OSError, ValueError) as e:
+        print(f"Warning: Failed to read metadata cache {cache_path}: {e}")
+    if df is None:
+        df = _read_csv(csv_path)
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            df.to_feather(tmp_path)
+            os.replace(tmp_path, cache_path)
+            _remove_stale_caches(cache_path)
+        except (ImportError, OSError) as e:  # Feather needs pyarrow; the CSV path still works without it
+            print(f"Warning: Failed to write metadata cache {cache_path}: {e}")
+    _table = df
+    _index = {patient_id: row for row, patient_id in enumerate(df["Patient ID"])}
+    return _table
+
+
+def get_record(sample_id):
+    df = load_metadata_table()
+    row = _index.get(sample_id[:12])
+    if row is None:
+        return None
+    return df.iloc[row].to_dict()
+
+
+def get_oncotree_code(sample_id):
+    record = get_record(sample_id)
+    if record is None:
+        return "None"
+    return record["Oncotree Code"]
+
+
+def get_survival_info(sample_id):
+    record = get_record(sample_id)
+    if record is None:
+        return None, None
+    survival_months = record["Overall Survival (Months)"]
+    survival_status = record["Overall Survival Status"]
+    import pandas as pd
+    if pd.isna(survival_months) or pd.isna(survival_status):
+        return None, None
+    is_deceased = "DECEASED" in str(survival_status)
+    return float(survival_months), is_deceased
+
+
+def lookup_batch(sample_ids):
+    """
+    Vectorized lookup for many samples at once. Returns a DataFrame aligned with sample_ids
+    with columns: patient_id, oncotree_code, survival_months, is_deceased (NaN / None when missing).
+    """
+    import pandas as pd
+    df = load_metadata_table()
+    patient_ids = [sample_id[:12] for sample_id in sample_ids]
+    rows = np.array([_index.get(patient_id, -1) for patient_id in patient_ids], dtype=np.int64)
+    found = rows >= 0
+    matched = df.iloc[rows[found]]
+
+    oncotree_codes = np.full(len(rows), "None", dtype=object)
+    oncotree_codes[found] = matched["Oncotree Code"].to_numpy(dtype=object)
+    survival_months = np.full(len(rows), np.nan)
+    survival_months[found] = pd.to_numeric(matched["Overall Survival (Months)"], errors="coerce").to_numpy()
+    status = pd.Series([None] * len(rows), dtype=object)
+    status[found] = matched["Overall Survival Status"].to_numpy(dtype=object)
+    is_deceased = status.where(status.isna(), status.astype(str).str.contains("DECEASED"))
+    # Same rule as get_survival_info: both fields are needed for a usable survival label
+    incomplete = np.isnan(survival_months) | status.isna().to_numpy()
+    survival_months[incomplete] = np.nan
+    is_deceased[incomplete] = None
+
+    return pd.DataFrame({
+        "sample_id": list(sample_ids),
+        "patient_id": patient_ids,
+        "oncotree_code": oncotree_codes,
+        "survival_months": survival_months,
+        "is_deceased": is_deceased.to_numpy(dtype=object),
+    })
@@ -1,99 +1,217 @@
 import os
-import requests
-import base64
-from azure.identity import DefaultAzureCredential, get_bearer_token_provider
-from openai import AzureOpenAI
-import openai
+import time
+import config
+from utils import response_cache
+from utils import image_payload
+from utils import rate_limiter
+from utils import llm_router
+from utils import llm_batch
+from utils import call_ledger
+from utils import singleflight
 
 # Option A: Azure Managed Identity (recommended on servers)
 managed_identity_client_id = "YOUR_MANAGED_IDENTITY_CLIENT_ID"  # TODO
-token_provider = get_bearer_token_provider(
-    DefaultAzureCredential(managed_identity_client_id=managed_identity_client_id), "https://cognitiveservices.azure.com/.default")
 AZURE_ENDPOINT = "https://<your-openai-resource>.openai.azure.com/"  # TODO
 API_VERSION = "YOUR_API_VERSION"  # TODO if needed
-client = AzureOpenAI(
-    api_version=API_VERSION,
-    azure_endpoint=AZURE_ENDPOINT,
-    azure_ad_token_provider=token_provider
-)
-# Azure API configurations
-azure_config_list = [
-    {
-        "model": "gpt-4o",
-        "api_type": "azure",
-        "max_retries": 10,
-        "azure_ad_token_provider": token_provider,
-        "base_url": AZURE_ENDPOINT,
-        "api_version": API_VERSION,
-    },
-]
+
+# Nothing is created at import: the Azure credential is built on the first token request and the
+# openai clients on the first chat completion (utils.llm_router), so pool workers and scripts
+# that never call the API do not pay for azure.identity / openai.
+_token_provider = None
+
+
+def get_token_provider():
+    global _token_provider
+    if _token_provider is None:
+        from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+        _token_provider = get_bearer_token_provider(
+            DefaultAzureCredential(managed_identity_client_id=managed_identity_client_id), "https://cognitiveservices.azure.com/.default")
+    return _token_provider
+
+
+def token_provider():
+    return get_token_provider()()
+
+
+def __getattr__(name):
+    # Backwards compatible module attribute: the client of the first deployment, created on use
+    if name == "client":
+        return llm_router.get_client(0)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+if config.LLM_BACKEND == "stub":
+    # Local stub server (python -m utils.llm_stub_server): no Azure credentials are used
+    azure_config_list = [
+        {
+            "model": "gpt-4o",
+            "api_key": "stub",
+            "base_url": config.LLM_STUB_URL,
+        },
+    ]
+else:
+    # Azure API configurations. Requests are spread over all entries by utils.llm_router;
+    # add "weight" to an entry to change its share of the traffic.
+    azure_config_list = [
+        {
+            "model": "gpt-4o",
+            "api_type": "azure",
+            "max_retries": 10,
+            "azure_ad_token_provider": token_provider,
+            "base_url": AZURE_ENDPOINT,
+            "api_version": API_VERSION,
+        },
+    ]
+llm_router.set_deployments(azure_config_list)
+
+def get_failover_errors():
+    # Errors after which a request is retried on another deployment
+    import openai
+    return (openai.APIConnectionError, openai.InternalServerError, openai.RateLimitError)
 
 # Option B: OpenAI API Key (good for local/personal use)
-# Uncomment the following two lines for replacement
+# Uncomment the following three lines for replacement
 # OPENAI_API_KEY = "YOUR_AZURE_OPENAI_API_KEY"  # TODO
-# client = openai.OpenAI(api_key=OPENAI_API_KEY)
+# azure_config_list = [{"model": "gpt-4o", "api_key": OPENAI_API_KEY}]
+# llm_router.set_deployments(azure_config_list)
 
-def get_openai_response_text_only(prompt, temp=0.5):
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=temp,
+def build_text_messages(prompt):
+    return [{"role": "user", "content": prompt}]
+
+def build_image_messages(prompt, image_paths, task=None):
+    # task selects the image payload policy (config.IMAGE_PAYLOAD_POLICIES)
+    message_content = [{"type": "text", "text": prompt}]
+    original_bytes, sent_bytes = 0, 0
+    for image_path in image_paths:
+        data_url, image_original_bytes, image_sent_bytes = image_payload.get_image_payload(image_path, task)
+        original_bytes += image_original_bytes
+        sent_bytes += image_sent_bytes
+        message_content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": data_url
+                },}
         )
-        return response.choices[0].message.content
+    if sent_bytes < original_bytes:
+        saved = original_bytes - sent_bytes
+        print(f"Image payload ({task or 'default'}): {len(image_paths)} images, "
+              f"{original_bytes} -> {sent_bytes} bytes ({saved / original_bytes:.0%} saved)")
+    return [{"role": "user", "content": message_content}]
+
+def send_to_deployment(index, request_fn, messages, call_info):
+    """
+    request_fn() (one chat completion on deployment `index`) within the shared rate limits, with the
+    deployment's health recorded in the router. Also used for the autogen clients of ROIAgent.
+    """
+    call_info["deployment"] = index
+
+    def send_request():
+        started_at = time.time()
+        result = request_fn()
+        call_info["api_latency"] = time.time() - started_at
+        return result
+
+    try:
+        # 429s, connection errors and 5xx are retried by the shared rate limiter, not the SDK
+        response = rate_limiter.call(send_request, messages, call_info, llm_router.get_max_retries(index), index)
+    except get_failover_errors():
+        llm_router.record(index, error=True)
+        raise
+    llm_router.record(index, call_info["api_latency"])
+    return response
+
+def _send_with_failover(messages, temperature, model, sticky_key, call_info):
+    tried = set()
+    while True:
+        index = llm_router.pick(sticky_key, exclude=tried)
+        request_kwargs = {"model": llm_router.get_deployment(index).get("model", model), "messages": messages}
+        if temperature is not None:
+            request_kwargs["temperature"] = temperature
+        try:
+            return send_to_deployment(index, lambda: llm_router.get_client(index).chat.completions.create(**request_kwargs),
+                                      messages, call_info)
+        except get_failover_errors() as e:
+            tried.add(index)
+            if len(tried) >= llm_router.get_deployment_count():
+                raise
+            print(f"LLM deployment {index} failed ({type(e).__name__}); retrying on another deployment")
+
+def _complete(messages, temperature, model, sticky_key, cache_key, started_at, store=True, validate=None):
+    if config.LLM_HEDGE_ENABLED:
+        # Hedging needs cancellable requests: run on the async client's background loop
+        from utils import async_openai_client
+        return async_openai_client.run_sync(async_openai_client.async_create_chat_completion(
+            messages, temperature, model, sticky_key, coalesce=False, cache=store, validate=validate))
+    call_info = {"attempts": 0, "deployment": None, "api_latency": None}
+    try:
+        response = _send_with_failover(messages, temperature, model, sticky_key, call_info)
+    except Exception as e:
+        call_ledger.record(messages, model, started_at, outcome=f"error:{type(e).__name__}", **call_info)
+        raise
+    call_ledger.record(messages, model, started_at, response=response, **call_info)
+    response_text = response.choices[0].message.content
+    if store and (validate is None or validate(response_text)):
+        response_cache.put(cache_key, response_text, model)
+    return response_text
+
+def get_cached_response(cache_key, use_cache, validate=None):
+    if not use_cache:
+        return None
+    cached_response = response_cache.get(cache_key)
+    if cached_response is not None and validate is not None and not validate(cached_response):
+        response_cache.invalidate(cache_key)
+        return None
+    return cached_response
+
+def create_chat_completion(messages, temperature=None, model="gpt-4o", sticky_key=None, coalesce=None, cache=None,
+                           validate=None):
+    # coalesce: share one upstream call with identical in-flight requests (utils/singleflight);
+    # None applies the default (temperature 0, or config.LLM_COALESCE_ALL_TEMPERATURES)
+    # cache: use the response cache; None applies the default (temperature 0, see response_cache)
+    # validate: response_text -> bool; answers that fail it are not cached (a cached one is dropped)
+    started_at = time.time()
+    cache_key = response_cache.make_key(model, temperature, messages)
+    use_cache = response_cache.is_cacheable(temperature, cache)
+    cached_response = get_cached_response(cache_key, use_cache, validate)
+    if cached_response is not None:
+        call_ledger.record(messages, model, started_at, outcome="cache_hit")
+        return cached_response
+    if llm_batch.is_collecting():
+        # Queued for an offline batch (utils/llm_batch); the stage is replayed once results are in
+        llm_batch.add_request(cache_key, model, temperature, messages)
+        call_ledger.record(messages, model, started_at, outcome="queued")
+        return None
+    if not singleflight.is_eligible(temperature, coalesce):
+        return _complete(messages, temperature, model, sticky_key, cache_key, started_at, use_cache, validate)
+    response_text, coalesced = singleflight.do(
+        cache_key, lambda: _complete(messages, temperature, model, sticky_key, cache_key, started_at, use_cache, validate),
+        use_cache)
+    if coalesced:
+        call_ledger.record(messages, model, started_at, outcome="coalesced")
+    return response_text
+
+def get_openai_response_text_only(prompt, temp=0.5, coalesce=None, cache=None, validate=None):
+    try:
+        return create_chat_completion(build_text_messages(prompt), temperature=temp, coalesce=coalesce, cache=cache,
+                                      validate=validate)
     except Exception as e:
         print(f"Error in OpenAI API request: {e}")
         return None
 
 
 
-def get_openai_response_base64(prompt, image_path):
+def get_openai_response_base64(prompt, image_path, task=None, coalesce=None):
     try:
-        with open(image_path, "rb") as image_file:
-            img_b64_str = base64.b64encode(image_file.read()).decode("utf-8")
-        response = client.chat.completions.create(
-            model="gpt-4o", 
-            messages=[{
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{img_b64_str}"
-                            },
-                        },],}],
-        )
-        return response.choices[0].message.content
+        return create_chat_completion(build_image_messages(prompt, [image_path], task), coalesce=coalesce)
     except Exception as e:
         print(f"Error in OpenAI API request: {e}")
         return None
 
-def get_openai_response_base64_with_multiple_images(prompt, image_paths):
+def get_openai_response_base64_with_multiple_images(prompt, image_paths, task=None, coalesce=None):
     try:
-        images_b64 = []
-        for image_path in image_paths:
-            with open(image_path, "rb") as image_file:
-                img_b64_str = base64.b64encode(image_file.read()).decode("utf-8")
-                images_b64.append(img_b64_str)
-        message_content = [{"type": "text", "text": prompt}]
-        for img_b64_str in images_b64:
-            message_content.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/png;base64,{img_b64_str}"
-                    },}
-            )
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            temperature=0.5,
-            messages=[{
-                    "role": "user",
-                    "content": message_content,
-                }],
-        )
-        print(response.choices[0].message.content)
-        return response.choices[0].message.content
+        response_text = create_chat_completion(build_image_messages(prompt, image_paths, task), temperature=0.5, coalesce=coalesce)
+        print(response_text)
+        return response_text
     except Exception as e:
         print(f"Error in OpenAI API request: {e}")
-        return None
\ No newline at end of file
+        return None
@@ -0,0 +1,344 @@
+import os
+import io
+import json
+import time
+import math
+import fcntl
+import base64
+import asyncio
+import threading
+from contextlib import contextmanager
+from PIL import Image
+import config
+
+# Rate limiter shared by every process on this machine that calls the LLM API.
+# Each deployment (utils.llm_router index) has two token buckets (requests and tokens per minute,
+# config.LLM_RPM_LIMIT / LLM_TPM_LIMIT) in config.LLM_RATE_STATE_PATH under an flock, so VQA
+# workers and baselines draw from one budget per deployment. A 429 blocks that deployment in all
+# processes for its Retry-After and halves this process's concurrency limit; successful calls
+# raise it again by about one per window (AIMD). Connection errors,
+# timeouts and 5xx responses are retried with exponential backoff (the SDK clients do not retry).
+#
+#   python -m utils.rate_limiter   # print the shared bucket state
+
+DEFAULT_IMAGE_TOKENS = 765  # a 1024 x 1024 image in high-detail mode
+
+_condition = threading.Condition()
+_concurrency_limit = float(config.LLM_MAX_CONCURRENCY)
+_in_flight = 0
+_stats = {"requests": 0, "throttled": 0, "retries": 0, "transient_errors": 0, "waited_seconds": 0.0}
+
+
+def get_transient_errors():
+    # Errors retried on the same deployment before failing over (APITimeoutError is an APIConnectionError)
+    import openai
+    return (openai.APIConnectionError, openai.InternalServerError)
+
+
+def _image_tokens(url, detail="auto"):
+    # GPT-4o vision pricing: fit in 2048 x 2048, shortest side to 768, 170 tokens per 512 px tile + 85
+    if detail == "low":
+        return 85
+    try:
+        header = base64.b64decode(url.split(",", 1)[1][:65536])  # enough for PNG / JPEG headers
+        width, height = Image.open(io.BytesIO(header)).size
+    except Exception:
+        return DEFAULT_IMAGE_TOKENS
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 170 * math.ceil(width / 512) * math.ceil(height / 512) + 85
+
+
+def estimate_tokens(messages):
+    """Estimated tokens a request counts against the TPM quota (prompt + reserved completion)."""
+    tokens = config.LLM_ESTIMATED_COMPLETION_TOKENS
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += len(content) // 4 + 4
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                tokens += len(part["text"]) // 4 + 4
+            elif part.get("type") == "image_url":
+                image_url = part["image_url"]
+                tokens += _image_tokens(image_url["url"], image_url.get("detail", "auto"))
+    return tokens
+
+
+def _refill(state, now):
+    if not state:
+        state.update({"requests": config.LLM_RPM_LIMIT, "tokens": config.LLM_TPM_LIMIT, "updated_at": now,
+                      "blocked_until": 0.0, "throttled": 0})
+    # Refill both buckets for the time since the last update
+    elapsed = max(0.0, now - state["updated_at"])
+    state["requests"] = min(config.LLM_RPM_LIMIT, state["requests"] + elapsed * config.LLM_RPM_LIMIT / 60)
+    state["tokens"] = min(config.LLM_TPM_LIMIT, state["tokens"] + elapsed * config.LLM_TPM_LIMIT / 60)
+    state["updated_at"] = now
+    return state
+
+
+@contextmanager
+def _locked_states():
+    # {deployment key: bucket state} for all deployments
+    os.makedirs(os.path.dirname(config.LLM_RATE_STATE_PATH), exist_ok=True)
+    with open(config.LLM_RATE_STATE_PATH, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            states = json.loads(f.read())
+        except ValueError:
+            states = {}
+        if "updated_at" in states:
+            states = {}  # single-bucket state written by an older version
+        now = time.time()
+        for state in states.values():
+            _refill(state, now)
+        yield states
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps(states))
+        f.flush()
+
+
+@contextmanager
+def _locked_state(deployment=None):
+    # Buckets of one deployment; None is the bucket of requests sent outside the router
+    with _locked_states() as states:
+        key = "default" if deployment is None else str(deployment)
+        if key not in states:
+            states[key] = _refill({}, time.time())
+        yield states[key]
+
+
+def _reserve(estimated_tokens, deployment=None):
+    # Take one request and estimated_tokens from the deployment's buckets; returns 0 or seconds to wait
+    estimated_tokens = min(estimated_tokens, config.LLM_TPM_LIMIT)
+    with _locked_state(deployment) as state:
+        now = state["updated_at"]
+        if now < state["blocked_until"]:
+            return state["blocked_until"] - now
+        wait = max(
+            (1 - state["requests"]) * 60 / config.LLM_RPM_LIMIT,
+            (estimated_tokens - state["tokens"]) * 60 / config.LLM_TPM_LIMIT,
+        )
+        if wait > 0:
+            return wait
+        state["requests"] -= 1
+        state["tokens"] -= estimated_tokens
+        return 0
+
+
+def _try_enter():
+    global _in_flight
+    with _condition:
+        if _in_flight >= int(_concurrency_limit):
+            return False
+        _in_flight += 1
+        return True
+
+
+def _leave():
+    global _in_flight
+    with _condition:
+        _in_flight -= 1
+        _condition.notify_all()
+
+
+def acquire(estimated_tokens, deployment=None):
+    global _in_flight
+    started_at = time.time()
+    with _condition:
+        while _in_flight >= int(_concurrency_limit):
+            _condition.wait()
+        _in_flight += 1
+    try:
+        while True:
+            wait = _reserve(estimated_tokens, deployment)
+            if wait <= 0:
+                break
+            time.sleep(min(wait, 1.0))
+    except BaseException:
+        _leave()
+        raise
+    _stats["waited_seconds"] += time.time() - started_at
+
+
+async def async_acquire(estimated_tokens, deployment=None):
+    started_at = time.time()
+    while not _try_enter():
+        await asyncio.sleep(0.05)
+    try:
+        while True:
+            wait = _reserve(estimated_tokens, deployment)
+            if wait <= 0:
+                break
+            await asyncio.sleep(min(wait, 1.0))
+    except BaseException:
+        _leave()
+        raise
+    _stats["waited_seconds"] += time.time() - started_at
+
+
+def release(estimated_tokens, used_tokens=None, throttled=False, retry_after=None, deployment=None):
+    global _concurrency_limit
+    with _condition:
+        if throttled:
+            _concurrency_limit = max(1.0, _concurrency_limit / 2)
+        else:
+            _concurrency_limit = min(float(config.LLM_MAX_CONCURRENCY), _concurrency_limit + 1 / _concurrency_limit)
+    _leave()
+    if not throttled and used_tokens is None:
+        return
+    with _locked_state(deployment) as state:
+        if used_tokens is not None:
+            # Return the unused part of the estimate (or charge the overrun)
+            state["tokens"] = min(config.LLM_TPM_LIMIT, state["tokens"] + estimated_tokens - used_tokens)
+        if throttled:
+            state["blocked_until"] = max(state["blocked_until"], state["updated_at"] + retry_after)
+            state["throttled"] += 1
+
+
+def has_headroom(estimated_tokens, reserve, deployment=None):
+    """True if a request fits now while leaving `reserve` (a fraction) of the deployment's budgets unused."""
+    with _condition:
+        if _in_flight >= int(_concurrency_limit):
+            return False
+    with _locked_state(deployment) as state:
+        if state["updated_at"] < state["blocked_until"]:
+            return False
+        return (state["requests"] - 1 >= reserve * config.LLM_RPM_LIMIT
+                and state["tokens"] - estimated_tokens >= reserve * config.LLM_TPM_LIMIT)
+
+
+def get_retry_after(error, attempt):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return min(60.0, 2.0 ** attempt)
+
+
+def _used_tokens(response):
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+
+def _transient_backoff(error, transient_attempt, max_retries):
+    # Seconds to wait before retrying a transient error, or None when the retries are used up
+    _stats["transient_errors"] += 1
+    if transient_attempt >= max_retries:
+        return None
+    _stats["retries"] += 1
+    delay = min(get_retry_after(error, transient_attempt), config.LLM_TRANSIENT_MAX_BACKOFF)
+    print(f"LLM request failed ({type(error).__name__}); retrying in {delay:.1f}s "
+          f"(attempt {transient_attempt + 1}/{max_retries})")
+    return delay
+
+
+def call(request_fn, messages, call_info=None, max_retries=None, deployment=None):
+    """
+    Run request_fn() (one chat completion to `deployment`) within its rate limits, retrying on 429
+    and, up to max_retries times (default config.LLM_TRANSIENT_MAX_RETRIES), on connection errors,
+    timeouts and 5xx.
+    call_info, if given, is a dict whose "attempts" count is incremented per request sent.
+    """
+    import openai
+    max_retries = config.LLM_TRANSIENT_MAX_RETRIES if max_retries is None else max_retries
+    estimated_tokens = estimate_tokens(messages)
+    # 429s and transient errors have separate retry budgets; every exit raises or returns a response
+    attempt = transient_attempt = 0
+    while True:
+        acquire(estimated_tokens, deployment)
+        if call_info is not None:
+            call_info["attempts"] = call_info.get("attempts", 0) + 1
+        _stats["requests"] += 1
+        try:
+            response = request_fn()
+        except get_transient_errors() as e:
+            _leave()
+            delay = _transient_backoff(e, transient_attempt, max_retries)
+            if delay is None:
+                raise
+            transient_attempt += 1
+            time.sleep(delay)
+            continue
+        except openai.RateLimitError as e:
+            retry_after = get_retry_after(e, attempt)
+            release(estimated_tokens, throttled=True, retry_after=retry_after, deployment=deployment)
+            _stats["throttled"] += 1
+            if attempt >= config.LLM_RATE_LIMIT_MAX_RETRIES:
+                raise
+            attempt += 1
+            _stats["retries"] += 1
+            print(f"Rate limited; retrying in {retry_after:.1f}s (attempt {attempt})")
+            continue
+        except BaseException:
+            _leave()
+            raise
+        release(estimated_tokens, used_tokens=_used_tokens(response), deployment=deployment)
+        return response
+
+
+async def async_call(request_fn, messages, call_info=None, max_retries=None, deployment=None):
+    """Async counterpart of call(); request_fn() returns an awaitable."""
+    import openai
+    max_retries = config.LLM_TRANSIENT_MAX_RETRIES if max_retries is None else max_retries
+    estimated_tokens = estimate_tokens(messages)
+    # 429s and transient errors have separate retry budgets; every exit raises or returns a response
+    attempt = transient_attempt = 0
+    while True:
+        await async_acquire(estimated_tokens, deployment)
+        if call_info is not None:
+            call_info["attempts"] = call_info.get("attempts", 0) + 1
+        _stats["requests"] += 1
+        try:
+            response = await request_fn()
+        except get_transient_errors() as e:
+            _leave()
+            delay = _transient_backoff(e, transient_attempt, max_retries)
+            if delay is None:
+                raise
+            transient_attempt += 1
+            await asyncio.sleep(delay)
+            continue
+        except openai.RateLimitError as e:
+            retry_after = get_retry_after(e, attempt)
+            release(estimated_tokens, throttled=True, retry_after=retry_after, deployment=deployment)
+            _stats["throttled"] += 1
+            if attempt >= config.LLM_RATE_LIMIT_MAX_RETRIES:
+                raise
+            attempt += 1
+            _stats["retries"] += 1
+            print(f"Rate limited; retrying in {retry_after:.1f}s (attempt {attempt})")
+            continue
+        except BaseException:
+            _leave()
+            raise
+        release(estimated_tokens, used_tokens=_used_tokens(response), deployment=deployment)
+        return response
+
+
+def get_rate_limiter_state():
+    with _locked_states() as states:
+        shared_states = {key: dict(state) for key, state in states.items()}
+    deployments = {
+        key: dict(
+            available_requests=round(state["requests"], 1),
+            available_tokens=int(state["tokens"]),
+            blocked_for=round(max(0.0, state["blocked_until"] - state["updated_at"]), 1),
+            throttled_total=state["throttled"],
+        )
+        for key, state in sorted(shared_states.items())
+    }
+    return dict(_stats, concurrency_limit=int(_concurrency_limit), in_flight=_in_flight, deployments=deployments)
+
+
+if __name__ == "__main__":
+    print(json.dumps(get_rate_limiter_state(), indent=2))
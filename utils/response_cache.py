@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import contextmanager
+import config
+
+# Content-addressed cache of chat completion responses.
+# The key hashes model, temperature and the full message list (prompt text and the base64
+# image payloads), so re-running a stage with identical inputs is served from
+# config.LLM_CACHE_PATH. Entries are evicted by age and by total size (least recently used first).
+#
+# Which requests use the cache (is_cacheable): the caller's cache=True/False, else every request
+# while config.LLM_CACHE_ALL_TEMPERATURES is set (the default), else only temperature 0 (and every
+# request inside cache_all_temperatures(), for offline batches). Nothing is cached in "bypass" mode.
+# Callers that validate answers pass validate=...; answers that fail it are not stored, and a
+# stored one that fails it is invalidated and requested again.
+#
+# Modes (config.LLM_CACHE_MODE, or temporarily via cache_mode(...)):
+#   "readwrite" - serve hits and store new responses
+#   "readonly"  - serve hits, never write (e.g. shared cache on a read-only mount)
+#   "bypass"    - neither read nor write
+
+CACHE_MODES = ("readwrite", "readonly", "bypass")
+EVICTION_INTERVAL = 100  # writes between eviction passes
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    model TEXT,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access);
+CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at);
+"""
+
+_local = threading.local()
+_mode_override = threading.local()
+_cache_all_temperatures = False
+_writes_since_eviction = 0
+_stats = {"hits": 0, "misses": 0, "writes": 0, "evicted": 0, "invalidated": 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name, value=1):
+    with _stats_lock:
+        _stats[name] += value
+
+
+def get_cache_mode():
+    mode = getattr(_mode_override, "mode", None) or config.LLM_CACHE_MODE
+    if mode not in CACHE_MODES:
+        raise ValueError(f"Unknown LLM cache mode: {mode}")
+    return mode
+
+
+@contextmanager
+def cache_mode(mode):
+    """Temporarily switch the cache mode for the current thread, e.g. cache_mode("bypass")."""
+    if mode not in CACHE_MODES:
+        raise ValueError(f"Unknown LLM cache mode: {mode}")
+    previous = getattr(_mode_override, "mode", None)
+    _mode_override.mode = mode
+    try:
+        yield
+    finally:
+        _mode_override.mode = previous
+
+
+def is_cacheable(temperature, cache=None):
+    # Decided in the caller's thread (cache_mode is per thread) and passed on as cache=...
+    if get_cache_mode() == "bypass":
+        return False
+    if cache is not None:
+        return cache
+    return temperature == 0 or config.LLM_CACHE_ALL_TEMPERATURES or _cache_all_temperatures
+
+
+@contextmanager
+def cache_all_temperatures():
+    """Cache requests at every temperature inside the block (all threads), e.g. for batch replay."""
+    global _cache_all_temperatures
+    previous = _cache_all_temperatures
+    _cache_all_temperatures = True
+    try:
+        yield
+    finally:
+        _cache_all_temperatures = previous
+
+
+def _connect():
+    # One connection per thread and process (the async facade runs on its own thread)
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "pid", None) != os.getpid():
+        os.makedirs(os.path.dirname(config.LLM_CACHE_PATH), exist_ok=True)
+        conn = sqlite3.connect(config.LLM_CACHE_PATH, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        _local.conn, _local.pid = conn, os.getpid()
+    return conn
+
+
+def make_key(model, temperature, messages):
+    payload = json.dumps(
+        {"model": model, "temperature": temperature, "messages": messages},
+        sort_keys=True, ensure_ascii=False, separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def get(key):
+    mode = get_cache_mode()
+    if mode == "bypass":
+        return None
+    try:
+        conn = _connect()
+        row = conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None and mode == "readwrite":
+            with conn:
+                conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+    except sqlite3.Error as e:
+        print(f"Warning: LLM cache read failed: {e}")
+        return None
+    if row is None:
+        _count("misses")
+        return None
+    _count("hits")
+    return row[0]
+
+
+def put(key, response, model=None):
+    global _writes_since_eviction
+    if response is None or get_cache_mode() != "readwrite":
+        return
+    now = time.time()
+    try:
+        conn = _connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, response, model, len(response.encode("utf-8")), now, now),
+            )
+        with _stats_lock:
+            _stats["writes"] += 1
+            _writes_since_eviction += 1
+            run_eviction = _writes_since_eviction >= EVICTION_INTERVAL
+            if run_eviction:
+                _writes_since_eviction = 0
+        if run_eviction:
+            evict()
+    except sqlite3.Error as e:
+        print(f"Warning: LLM cache write failed: {e}")
+
+
+def invalidate(key):
+    """Delete the entry for key (e.g. an answer the caller could not parse)."""
+    if get_cache_mode() != "readwrite":
+        return
+    try:
+        conn = _connect()
+        with conn:
+            removed = conn.execute("DELETE FROM responses WHERE key = ?", (key,)).rowcount
+    except sqlite3.Error as e:
+        print(f"Warning: LLM cache invalidation failed: {e}")
+        return
+    _count("invalidated", removed)
+
+
+def evict(max_bytes=None, max_age_days=None):
+    max_bytes = config.LLM_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    max_age_days = config.LLM_CACHE_MAX_AGE_DAYS if max_age_days is None else max_age_days
+    conn = _connect()
+    removed = 0
+    with conn:
+        if max_age_days is not None:
+            cutoff = time.time() - max_age_days * 86400
+            removed += conn.execute("DELETE FROM responses WHERE created_at < ?", (cutoff,)).rowcount
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if max_bytes is not None and total > max_bytes:
+            excess = total - max_bytes
+            freed = 0
+            stale_keys = []
+            for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+                if freed >= excess:
+                    break
+                stale_keys.append((key,))
+                freed += size
+            conn.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+            removed += len(stale_keys)
+    _count("evicted", removed)
+    return removed
+
+
+def get_cache_stats():
+    with _stats_lock:
+        return dict(_stats, mode=get_cache_mode())
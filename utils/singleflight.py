@@ -0,0 +1,188 @@
+import os
+import time
+import fcntl
+import asyncio
+import threading
+import config
+from utils import response_cache
+
+# Coalescing of identical in-flight chat completions (keyed by the response cache key).
+# Within a process, the first caller of a key is the leader and later callers wait for its result.
+# Across processes, the leader holds an flock on config.LLM_COALESCE_DIR/<key>.lock; a leader in
+# another process that finds the lock taken waits for it and then reads the answer from the shared
+# response cache (only in "readwrite" cache mode, which is what makes the answer visible to it).
+# If the first leader failed, the waiter finds no cache entry and sends the request itself.
+# Requests whose answer is not stored (response_cache.is_cacheable false, passed as cached=False)
+# are coalesced within the process only.
+#
+# Requests are coalesced at temperature 0, when config.LLM_COALESCE_ALL_TEMPERATURES is set,
+# or when the caller opts in with coalesce=True (identical requests at other temperatures are
+# answered from the response cache anyway once the first one has finished).
+
+LOCK_POLL_INTERVAL = 0.05
+
+_lock = threading.Lock()
+_inflight = {}  # key -> _Call (sync callers of this process)
+_async_inflight = {}  # (event loop, key) -> asyncio.Future
+_stats = {"leaders": 0, "coalesced": 0, "coalesced_remote": 0, "lock_timeouts": 0}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def is_eligible(temperature, coalesce=None):
+    if not config.LLM_COALESCE_ENABLED:
+        return False
+    if coalesce is not None:
+        return coalesce
+    return temperature == 0 or config.LLM_COALESCE_ALL_TEMPERATURES
+
+
+def _shares_across_processes(cached):
+    return cached and response_cache.get_cache_mode() == "readwrite"
+
+
+def _try_lock(key):
+    """Open and lock <key>.lock without blocking; returns (fd, path), or None if another process holds it."""
+    os.makedirs(config.LLM_COALESCE_DIR, exist_ok=True)
+    path = os.path.join(config.LLM_COALESCE_DIR, f"{key}.lock")
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        try:
+            # The previous holder unlinks the file before unlocking; retry if we locked a stale inode
+            if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                return fd, path
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+def _unlock(handle):
+    fd, path = handle
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    os.close(fd)
+
+
+def _lead(key, fn, cached):
+    """Run fn() as this process's leader for key; returns (result, coalesced)."""
+    if not _shares_across_processes(cached):
+        return fn(), False
+    deadline = time.time() + config.LLM_COALESCE_WAIT_TIMEOUT
+    waited = False
+    handle = _try_lock(key)
+    while handle is None:
+        if time.time() > deadline:
+            _stats["lock_timeouts"] += 1
+            return fn(), False
+        waited = True
+        time.sleep(LOCK_POLL_INTERVAL)
+        handle = _try_lock(key)
+    try:
+        if waited:
+            result = response_cache.get(key)
+            if result is not None:
+                _stats["coalesced_remote"] += 1
+                return result, True
+        return fn(), False
+    finally:
+        _unlock(handle)
+
+
+def do(key, fn, cached=True):
+    """
+    Return (fn() or the result of an identical in-flight call, whether the result was shared).
+    cached: fn() stores its result in the response cache, so other processes can wait for it.
+    """
+    with _lock:
+        call = _inflight.get(key)
+        is_leader = call is None
+        if is_leader:
+            call = _inflight[key] = _Call()
+    if not is_leader:
+        _stats["coalesced"] += 1
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result, True
+    _stats["leaders"] += 1
+    try:
+        call.result, coalesced = _lead(key, fn, cached)
+        return call.result, coalesced
+    except BaseException as e:
+        call.error = e
+        raise
+    finally:
+        with _lock:
+            _inflight.pop(key, None)
+        call.done.set()
+
+
+async def _async_lead(key, coroutine_fn, cached):
+    if not _shares_across_processes(cached):
+        return await coroutine_fn(), False
+    deadline = time.time() + config.LLM_COALESCE_WAIT_TIMEOUT
+    waited = False
+    handle = _try_lock(key)
+    while handle is None:
+        if time.time() > deadline:
+            _stats["lock_timeouts"] += 1
+            return await coroutine_fn(), False
+        waited = True
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
+        handle = _try_lock(key)
+    try:
+        if waited:
+            result = response_cache.get(key)
+            if result is not None:
+                _stats["coalesced_remote"] += 1
+                return result, True
+        return await coroutine_fn(), False
+    finally:
+        _unlock(handle)
+
+
+async def async_do(key, coroutine_fn, cached=True):
+    """Async counterpart of do(); coroutine_fn() returns the coroutine to run as leader."""
+    inflight_key = (asyncio.get_running_loop(), key)
+    while inflight_key in _async_inflight:
+        future = _async_inflight[inflight_key]
+        try:
+            # shield: a cancelled follower must not cancel the leader's request
+            result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise  # this follower was cancelled
+            continue  # the leader was cancelled: take over
+        _stats["coalesced"] += 1
+        return result, True
+    future = _async_inflight[inflight_key] = asyncio.get_running_loop().create_future()
+    _stats["leaders"] += 1
+    try:
+        result, coalesced = await _async_lead(key, coroutine_fn, cached)
+        future.set_result(result)
+        return result, coalesced
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except BaseException as e:
+        future.set_exception(e)
+        future.exception()  # mark retrieved when there are no followers
+        raise
+    finally:
+        _async_inflight.pop(inflight_key, None)
+
+
+def get_singleflight_stats():
+    return dict(_stats)
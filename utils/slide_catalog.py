@@ -0,0 +1,184 @@
+import os
+import bisect
+import sqlite3
+import config
+
+# Persistent SVS index under config.SLIDE_CATALOG_PATH.
+# Each TCGA repo folder (e.g. TCGA-BRCA) is refreshed at most once per process; a refresh
+# only re-lists directories whose mtime changed since the last scan, so on an unchanged
+# mount it costs one stat() per directory instead of a full os.walk per lookup.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS slides (
+    path TEXT PRIMARY KEY,
+    repo TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    sample_id TEXT NOT NULL,
+    patient_id TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS slides_repo_name ON slides (repo, file_name);
+CREATE INDEX IF NOT EXISTS slides_dir ON slides (dir);
+CREATE INDEX IF NOT EXISTS slides_patient ON slides (patient_id);
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    repo TEXT NOT NULL,
+    parent TEXT,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS dirs_repo ON dirs (repo);
+"""
+
+_refreshed_repos = set()
+_repo_entries = {}  # repo -> (sorted file names, paths in the same order)
+
+
+def _connect(catalog_path=None):
+    catalog_path = catalog_path or config.SLIDE_CATALOG_PATH
+    os.makedirs(os.path.dirname(catalog_path), exist_ok=True)
+    conn = sqlite3.connect(catalog_path, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def _scan_dir(dir_path):
+    subdirs, slides = [], []
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.is_symlink():  # os.walk does not follow links either
+                    subdirs.append(entry.path)
+            elif entry.name.endswith(".svs"):
+                stat = entry.stat()
+                slides.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    return subdirs, slides
+
+
+def _refresh_repo(conn, repo):
+    repo_path = os.path.join(config.DATA_DIR, repo)
+    known = {}
+    children = {}
+    for path, parent, mtime_ns in conn.execute("SELECT path, parent, mtime_ns FROM dirs WHERE repo = ?", (repo,)):
+        known[path] = mtime_ns
+        children.setdefault(parent, []).append(path)
+
+    seen = set()
+    rescanned = 0
+    stack = [(repo_path, None)]
+    with conn:
+        while stack:
+            dir_path, parent = stack.pop()
+            try:
+                mtime_ns = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+            seen.add(dir_path)
+            if known.get(dir_path) == mtime_ns:
+                # Directory listing unchanged: reuse stored files and subdirectories
+                stack.extend((child, dir_path) for child in children.get(dir_path, []))
+                continue
+            subdirs, slides = _scan_dir(dir_path)
+            rescanned += 1
+            conn.execute("DELETE FROM slides WHERE dir = ?", (dir_path,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO slides VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (os.path.join(dir_path, name), repo, dir_path, name, name.split('.')[0], name[:12], size, file_mtime_ns)
+                    for name, size, file_mtime_ns in slides
+                ],
+            )
+            conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)", (dir_path, repo, parent, mtime_ns))
+            stack.extend((subdir, dir_path) for subdir in subdirs)
+
+        stale_dirs = [(path,) for path in known if path not in seen]
+        conn.executemany("DELETE FROM slides WHERE dir = ?", stale_dirs)
+        conn.executemany("DELETE FROM dirs WHERE path = ?", stale_dirs)
+    return rescanned
+
+
+def refresh_catalog(repos=None, force=False):
+    """
+    Bring the catalog up to date for the given TCGA repo folders (default: all folders in
+    config.CANCER_FOLDER_MAP). Returns the number of directories that had to be re-listed.
+    """
+    if repos is None:
+        repos = sorted({repo for folders in config.CANCER_FOLDER_MAP.values() for repo in folders})
+    pending = [repo for repo in repos if force or repo not in _refreshed_repos]
+    if not pending:
+        return 0
+    rescanned = 0
+    conn = _connect()
+    try:
+        for repo in pending:
+            rescanned += _refresh_repo(conn, repo)
+            _refreshed_repos.add(repo)
+            _repo_entries.pop(repo, None)
+    finally:
+        conn.close()
+    return rescanned
+
+
+def _get_repo_entries(repo):
+    refresh_catalog([repo])
+    if repo not in _repo_entries:
+        conn = _connect()
+        try:
+            rows = conn.execute(
+                "SELECT file_name, path FROM slides WHERE repo = ? ORDER BY file_name, path", (repo,)
+            ).fetchall()
+        finally:
+            conn.close()
+        _repo_entries[repo] = ([row[0] for row in rows], [row[1] for row in rows])
+    return _repo_entries[repo]
+
+
+def find_slide(sample_id, repos):
+    # Same matching rule as the former os.walk search: file name starts with sample_id
+    for repo in repos:
+        names, paths = _get_repo_entries(repo)
+        idx = bisect.bisect_left(names, sample_id)
+        if idx < len(names) and names[idx].startswith(sample_id):
+            return paths[idx]
+    return None
+
+
+def find_slides(sample_ids, repos):
+    return {sample_id: find_slide(sample_id, repos) for sample_id in sample_ids}
+
+
+def get_slide_paths(repos):
+    slide_paths = []
+    for repo in repos:
+        slide_paths.extend(_get_repo_entries(repo)[1])
+    return slide_paths
+
+
+def get_slide_records(repos=None, patient_id=None):
+    refresh_catalog(repos)
+    query = "SELECT path, repo, sample_id, patient_id, size, mtime_ns FROM slides"
+    clauses, params = [], []
+    if repos is not None:
+        clauses.append(f"repo IN ({', '.join('?' * len(repos))})")
+        params.extend(repos)
+    if patient_id is not None:
+        clauses.append("patient_id = ?")
+        params.append(patient_id[:12])
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    conn = _connect()
+    try:
+        rows = conn.execute(query + " ORDER BY path", params).fetchall()
+    finally:
+        conn.close()
+    keys = ["path", "repo", "sample_id", "patient_id", "size", "mtime_ns"]
+    return [dict(zip(keys, row)) for row in rows]
+
+
+if __name__ == "__main__":
+    num_rescanned = refresh_catalog(force=True)
+    print(f"Re-listed {num_rescanned} directories.")
+    for cancer_type, folders in config.CANCER_FOLDER_MAP.items():
+        print(f"{cancer_type}: {len(get_slide_paths(folders))} slides")
@@ -0,0 +1,72 @@
+import os
+from collections import OrderedDict
+import openslide
+import config
+
+# Per-process pool of OpenSlide handles with LRU eviction.
+# All pooled handles share one openslide.OpenSlideCache, so tile-cache memory stays within
+# config.SLIDE_CACHE_BYTES per worker no matter how many slides a long run touches.
+# State is rebuilt after fork: handles inherited from a parent process are never reused.
+
+_pool = OrderedDict()  # real path -> (mtime_ns, handle)
+_shared_cache = None
+_pool_pid = None
+_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def _reset_if_forked():
+    global _pool, _shared_cache, _pool_pid
+    if _pool_pid != os.getpid():
+        _pool = OrderedDict()
+        _shared_cache = None
+        _pool_pid = os.getpid()
+        for key in _stats:
+            _stats[key] = 0
+
+
+def _get_shared_cache():
+    global _shared_cache
+    if _shared_cache is None and hasattr(openslide, "OpenSlideCache"):  # openslide-python >= 1.3
+        _shared_cache = openslide.OpenSlideCache(config.SLIDE_CACHE_BYTES)
+    return _shared_cache
+
+
+def open_slide(file_path):
+    """
+    Return a pooled handle for file_path. Handles are shared between tasks in the same
+    process; do not close them directly (use close_all instead).
+    """
+    _reset_if_forked()
+    key = os.path.realpath(file_path)
+    mtime_ns = os.stat(key).st_mtime_ns
+    if key in _pool:
+        cached_mtime_ns, handle = _pool[key]
+        if cached_mtime_ns == mtime_ns:
+            _pool.move_to_end(key)
+            _stats["hits"] += 1
+            return handle
+        del _pool[key]  # Slide was replaced on disk
+        handle.close()
+    _stats["misses"] += 1
+    handle = openslide.OpenSlide(file_path)
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None and hasattr(handle, "set_cache"):
+        handle.set_cache(shared_cache)
+    _pool[key] = (mtime_ns, handle)
+    while len(_pool) > config.SLIDE_POOL_SIZE:
+        _, (_, evicted) = _pool.popitem(last=False)
+        evicted.close()
+        _stats["evictions"] += 1
+    return handle
+
+
+def close_all():
+    _reset_if_forked()
+    while _pool:
+        _, (_, handle) = _pool.popitem(last=False)
+        handle.close()
+
+
+def get_pool_stats():
+    _reset_if_forked()
+    return dict(_stats, open_handles=len(_pool))